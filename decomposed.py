@@ -0,0 +1,176 @@
+import taichi as ti
+import tomli
+import os
+import shutil
+import csv
+import multiprocessing as mp
+import queue
+import numpy as np
+from tools.statistic_handler import StatisticHandler
+
+# Headless run with the domain split into tiles, one worker process per tile.
+# Workers exchange halo particles before the collision substeps and hand over
+# particles that crossed into another tile after each update.
+
+def tile_report(env):
+    env.rebuild_grid_cells_kernel()  # Owned cells only, for the statistics
+    return (env.fibroHandler.count[None], env.ecmHandler.live_count(), env.fibroHandler.grid_count_numpy(),
+            env.statisticHandler.read_summary(), env.statisticHandler.read_edge_profile())
+
+def run_worker(rank, config, channels, reports, seed=0, samples=None, sample_interval=None):
+    ti.init(arch=ti.cpu, random_seed=seed * 1000 + rank, offline_cache=True)
+    try:
+        simulate_tile(rank, config, channels, reports, samples, sample_interval)
+    except BaseException:
+        channels[2].abort()  # The other tiles would wait for this one at the next exchange
+        raise
+
+def simulate_tile(rank, config, channels, reports, samples, sample_interval):
+    # With a samples queue the tiles report every sample_interval steps instead, and rank 0 puts
+    # the trajectory of validate.METRICS there rather than writing data.csv
+    from env import Env
+    from tools.decomposition_handler import DecompositionHandler
+
+    env = Env(config)
+    if env.LINEAGE_LOG:
+        env.lineageHandler.open(f'data/lineage_{rank}.bin')
+    env.experimental_setup()
+    tiles = DecompositionHandler(env, rank, channels)
+    tiles.keep_own_tile()
+
+    if samples is not None:
+        sample_tiles(env, tiles, reports, samples, sample_interval)
+        tiles.close()
+        return
+
+    csv_file = None
+    if rank == 0:
+        csv_file = open('data/data.csv', 'a')
+        csv_writer = csv.DictWriter(csv_file, fieldnames=fieldnames + env.statisticHandler.get_metric_columns())
+        edge_file = open('data/edge_profile.csv', 'a')
+        edge_writer = csv.DictWriter(edge_file, fieldnames=env.statisticHandler.get_edge_profile_columns())
+
+    status = env.refresh_status()
+    while status["step"] < env.END_STEP:
+        status = step_tiles(env, tiles)
+        step = status["step"] - 1
+
+        if status["flags"] & env.DATA_DUE:
+            report = tile_report(env)
+            if rank != 0:
+                reports.put(report)
+            else:
+                # Tiles own disjoint cells, so their grids add up to the full domain
+                tile_reports = [report] + [reports.get() for _ in range(tiles.TILE_COUNT - 1)]
+                grid_count_np = np.sum([r[2] for r in tile_reports], axis=0)
+                if env.INITIAL_WOUND_AREA is None:
+                    env.INITIAL_WOUND_AREA = env.statisticHandler.get_wound_area(grid_count_np)
+
+                info = {
+                    "step": step,
+                    "fibroblast_count": sum(r[0] for r in tile_reports),
+                    "ecm_count": sum(r[1] for r in tile_reports),
+                    "wound_width": env.statisticHandler.get_average_wound_width(grid_count_np)
+                }
+                info.update(env.statisticHandler.get_wound_columns(grid_count_np))
+                info.update(env.statisticHandler.get_summary(np.sum([r[3] for r in tile_reports], axis=0), step))
+                csv_writer.writerow(info)
+                csv_file.flush()
+
+                edge_np = np.min([r[4][0] for r in tile_reports], axis=0)
+                radial_count_np = np.sum([r[4][1] for r in tile_reports], axis=0)
+                edge_writer.writerow(env.statisticHandler.get_edge_profile((edge_np, radial_count_np), step))
+                edge_file.flush()
+                print("Step: " + str(step) + " | Cells: " + str(sum(r[0] for r in tile_reports)))
+
+    tiles.close()
+    env.lineageHandler.close()
+    if csv_file is not None:
+        csv_file.close()
+        edge_file.close()
+
+def step_tiles(env, tiles):
+    owned = tiles.exchange_halos()
+    env.simulate_substeps()
+    tiles.drop_halos(owned)
+
+    env.reserve_capacity()  # Halos and migration change the counts, so this reads them fresh
+    env.update_kernel()
+    status = env.read_status()
+    tiles.migrate()
+
+    env.rebuild_grid_ecm_kernel()
+    return status
+
+def sample_tiles(env, tiles, reports, samples, sample_interval):
+    # Samples before the step, like validate.run_scenario
+    trajectory = {"fibroblast_count": [], "ecm_count": [], "wound_area": [], "wound_width": []}
+    step = env.refresh_status()["step"]
+    while step < env.END_STEP:
+        if step % sample_interval == 0:
+            report = tile_report(env)
+            if tiles.rank != 0:
+                reports.put(report)
+            else:
+                tile_reports = [report] + [reports.get() for _ in range(tiles.TILE_COUNT - 1)]
+                grid_count_np = np.sum([r[2] for r in tile_reports], axis=0)
+                trajectory["fibroblast_count"].append(sum(r[0] for r in tile_reports))
+                trajectory["ecm_count"].append(sum(r[1] for r in tile_reports))
+                trajectory["wound_area"].append(env.statisticHandler.get_wound_area(grid_count_np))
+                trajectory["wound_width"].append(env.statisticHandler.get_average_wound_width(grid_count_np))
+        step = step_tiles(env, tiles)["step"]
+    if tiles.rank == 0:
+        samples.put(trajectory)
+
+def run_tiles(config, seed=0, sample_interval=None):
+    # Runs one worker per tile and waits for them. With a sample_interval, returns the sampled trajectory
+    from tools.decomposition_handler import header_size
+
+    tile_count = config["decomposition"]["tiles_x"] * config["decomposition"]["tiles_y"]
+    ctx = mp.get_context("spawn")
+    channels = (f"fiss_tiles_{os.getpid()}_{seed}", ctx.RawArray("q", header_size(tile_count)), ctx.Barrier(tile_count))
+    reports = ctx.Queue()
+    samples = ctx.Queue() if sample_interval is not None else None
+    workers = [ctx.Process(target=run_worker, args=(rank, config, channels, reports, seed, samples, sample_interval))
+               for rank in range(tile_count)]
+
+    for worker in workers:
+        worker.start()
+    trajectory = None
+    while samples is not None and trajectory is None and all(worker.exitcode in [None, 0] for worker in workers):
+        try:  # Before joining, a full queue keeps its writer alive
+            trajectory = samples.get(timeout=1)
+        except queue.Empty:
+            pass
+    for worker in workers:
+        worker.join()
+    if any(worker.exitcode != 0 for worker in workers):
+        raise Exception("A tile worker failed, see its output above.")
+    return trajectory
+
+
+fieldnames = ["step", "fibroblast_count", "ecm_count", "wound_area", "wound_width"]
+
+if __name__ == "__main__":
+    if not os.path.exists("config.toml"):
+        shutil.copyfile("defaultconfig.toml", "config.toml")
+        print(f"Created config.toml from defaultconfig.toml")
+
+    with open('config.toml', 'rb') as f:
+        config = tomli.load(f)
+
+    if config["experiment"]["end_step"] == -1:
+        raise Exception("Decomposed runs need a finite end_step.")
+
+    if config["environment"]["periodic"]:
+        raise Exception("Periodic boundaries are not supported in decomposed runs.")
+
+    os.makedirs("data", exist_ok=True)
+    metric_columns = StatisticHandler.metric_columns(config["data_collection"]["metrics"])
+    with open('data/data.csv', 'w') as csv_file:
+        csv.DictWriter(csv_file, fieldnames=fieldnames + metric_columns).writeheader()
+    with open('data/edge_profile.csv', 'w') as edge_file:
+        csv.DictWriter(edge_file, fieldnames=StatisticHandler.edge_profile_columns(
+            config["data_collection"]["edge_angle_bins"], config["data_collection"]["edge_radius_bins"])).writeheader()
+
+    run_tiles(config)
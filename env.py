@@ -7,6 +7,10 @@ from tools.save_handler import SaveHandler
 from particle.ecm import ECMHandler
 from particle.fibroblast import FibroblastHandler
 from tools.statistic_handler import StatisticHandler
+from tools.lineage_handler import LineageHandler
+from tools.share_handler import ShareHandler
+from tools.wound_handler import WoundHandler
+from tools.wound_shape import load_wound_mask
 
 
 @ti.data_oriented
@@ -19,45 +23,100 @@ class Env:
         self.INITIAL_MODE = config["experiment"]["initial_mode"]
         self.INITIAL_WOUND = config["experiment"]["initial_wound"]
         self.WOUND_WIDTH = config["experiment"]["wound_width"]
+        self.WOUND_CENTER = (0.5, 0.5)
+        self.WOUND_THRESHOLD = 0.10  # Gridcells below this fraction of max_image_pixel_cells are wound
+        self.WOUND_SHAPE_FILE = config["experiment"]["wound_shape_file"]
+        self.WOUND_MASK_RES = 256
         self.END_STEP = config["experiment"]["end_step"]
 
         self.CAPTURE_DATA = config["data_collection"]["capture_data"]
         self.DATA_PATH = config["data_collection"]["data_path"]
         self.MAX_IMAGE_PIXEL_CELLS = config["data_collection"]["max_image_pixel_cells"]
+        self.IMAGE_RESOLUTION = config["data_collection"]["image_resolution"]
+        self.IMAGE_BLUR = config["data_collection"]["image_blur"]
+        self.IMAGE_CONTENT = config["data_collection"]["image_content"]
+        self.STATE_INTERVAL = config["data_collection"]["state_interval"]
+        self.SHARE_INTERVAL = config["data_collection"]["share_interval"]
+        self.SHARE_NAME = config["data_collection"]["share_name"]
+        if self.IMAGE_CONTENT not in ["cells", "cycling", "ecm"]:
+            raise Exception("Invalid image content: " + self.IMAGE_CONTENT)
         self.SAVE_VIDEO = config["data_collection"]["save_video"]
         self.VIDEO_FRAME_RATE = config["data_collection"]["video_frame_rate"]
+        self.METRICS = config["data_collection"]["metrics"]
+        self.EDGE_ANGLE_BINS = config["data_collection"]["edge_angle_bins"]
+        self.EDGE_RADIUS_BINS = config["data_collection"]["edge_radius_bins"]
+        self.LINEAGE_LOG = config["data_collection"]["lineage_log"]
+        self.LINEAGE_BUFFER_SIZE = config["data_collection"]["lineage_buffer_size"]
 
         self.MAX_CELL_COUNT = config["cells"]["max_cell_count"]
+        self.INITIAL_CELL_CAPACITY = config["cells"]["initial_cell_capacity"]
         self.CELL_RADIUS_UM = config["cells"]["cell_radius"]
         self.CELL_RADIUS = self.CELL_RADIUS_UM/self.DOMAIN_SIZE
+        self.CELL_CYCLE_JITTER = 5  # Cycle durations differ from cell_cycle_duration by less than this
         if self.CELL_RADIUS <= 0.0002: self.CELL_RADIUS_SCALAR = 0.00024/self.CELL_RADIUS
-        self.CELL_REPULSION = config["cells"]["cell_repulsion"]
-        self.REPRODUCTION_OFFSET = config["cells"]["reproduction_offset"]
-        self.MAX_CELL_SPEED_UM = config["cells"]["max_cell_speed"]
-        self.MAX_CELL_SPEED = self.MAX_CELL_SPEED_UM/self.DOMAIN_SIZE
-        self.CELL_TURN_SPEED_RAD = config["cells"]["cell_turn_speed"]
-        self.CELL_TURN_SPEED = self.CELL_TURN_SPEED_RAD/(2*np.pi)
-        self.CELL_TURN_CHANCE = config["cells"]["cell_turn_chance"]
+
+        # Runtime parameters live in fields so they can change between steps without recompiling (see set_parameters)
+        self.CELL_REPULSION = ti.field(dtype=ti.f32, shape=())
+        self.REPRODUCTION_OFFSET = ti.field(dtype=ti.f32, shape=())
+        self.MAX_CELL_SPEED = ti.field(dtype=ti.f32, shape=())
+        self.CELL_TURN_SPEED = ti.field(dtype=ti.f32, shape=())
+        self.CELL_TURN_CHANCE = ti.field(dtype=ti.f32, shape=())
         self.CELL_CYCLE_DURATION = ti.field(dtype=ti.i32, shape=())
-        self.CCDPlaceholder = config["cells"]["cell_cycle_duration"]
 
-        self.INHIBITION_RADIUS = config["inhibition"]["inhibition_radius"]
-        self.INHIBITION_THRESHOLD = config["inhibition"]["inhibition_threshold"]
-        self.INHIBITION_EXIT_THRESHOLD = config["inhibition"]["inhibition_exit_threshold"]
-        self.INHIBITION_FACTOR = config["inhibition"]["inhibition_factor"]
+        self.INHIBITION_RADIUS = ti.field(dtype=ti.f32, shape=())
+        self.INHIBITION_THRESHOLD = ti.field(dtype=ti.f32, shape=())
+        self.INHIBITION_EXIT_THRESHOLD = ti.field(dtype=ti.f32, shape=())
+        self.INHIBITION_FACTOR = ti.field(dtype=ti.f32, shape=())
+
+        self.GENE_EXPRESSION = config["genes"]["gene_expression"]
+        self.GENE_DRIVEN_CYCLE = config["genes"]["gene_driven_cycle"]
+        self.GENE_SUBSTEPS = config["genes"]["gene_substeps"]
+        if self.GENE_DRIVEN_CYCLE and not self.GENE_EXPRESSION:
+            raise Exception("gene_driven_cycle needs gene_expression.")
+        if "genes" in self.METRICS and not self.GENE_EXPRESSION:
+            raise Exception("The genes metric needs gene_expression.")
+        self.GENE_THRESHOLD = ti.field(dtype=ti.f32, shape=())
+        self.GENE_DECAY = ti.field(dtype=ti.f32, shape=())
 
         self.SUBSTEPS = config["environment"]["substeps"]
+        self.ADAPTIVE_SUBSTEPS = config["environment"]["adaptive_substeps"]
+        self.MIN_SUBSTEPS = config["environment"]["min_substeps"]
+        self.MAX_SUBSTEPS = config["environment"]["max_substeps"]
+        self.OVERLAP_TOLERANCE = config["environment"]["overlap_tolerance"]
+        self.RELAXED_CHECK_INTERVAL = 2  # Substeps between reads of the relaxed flag in adaptive mode
         self.GRID_SCALE_FACTOR = config["environment"]["grid_scale_factor"]
         self.GRID_RES = int(1 / (self.CELL_RADIUS * 2 * self.GRID_SCALE_FACTOR))
         self.MAX_PARTICLES_PER_GRID_CELL = config["environment"]["max_particles_per_grid_cell"]
-        self.FRICTION = config["environment"]["friction"]
-
-        self.MIN_ECM_PERIOD = config["ecm"]["min_ecm_period"]
+        self.SPARSE_GRID = config["environment"]["sparse_grid"]
+        self.GRID_BLOCK_SIZE = 8  # Gridcells per side of a sparse grid block
+        self.GRID_BLOCKS = -(-self.GRID_RES // self.GRID_BLOCK_SIZE)  # Blocks per side, the last one may be padded
+        self.FRICTION = ti.field(dtype=ti.f32, shape=())
+        self.COMPACT_STORAGE = config["environment"]["compact_storage"]
+        self.PERIODIC = config["environment"]["periodic"]
+        self.SLEEPING_CELLS = config["environment"]["sleeping_cells"]
+        self.SLEEP_SPEED = ti.field(dtype=ti.f32, shape=())
+
+        # Per-particle storage types, narrowed where the stored values allow it
+        self.FLAG_DTYPE = ti.i8 if self.COMPACT_STORAGE else ti.i32
+        self.SHORT_DTYPE = ti.i16 if self.COMPACT_STORAGE else ti.i32
+        self.STEP_DTYPE = ti.i16 if self.COMPACT_STORAGE else ti.i32
+        self.MAX_STEP_AGE = 2**15 - 1 if self.COMPACT_STORAGE else 2**31 - 1  # Compact stamps wrap every 2^16 steps, older ages are held here
+        self.FRACTION_DTYPE = ti.f16 if self.COMPACT_STORAGE else ti.f32
+
+        self.MIN_ECM_PERIOD = ti.field(dtype=ti.i32, shape=())
         self.MAX_ECM_COUNT = config["ecm"]["max_ecm_count"]
-        self.ECM_DETECTION_RADIUS = config["ecm"]["ecm_detection_radius"]*self.CELL_RADIUS
-        self.ECM_THRESHOLD = config["ecm"]["ecm_threshold"]
-        self.ECM_AVOIDANCE_STRENGTH_UM = config["ecm"]["ecm_avoidance_strength"]
-        self.ECM_AVOIDANCE_STRENGTH = self.ECM_AVOIDANCE_STRENGTH_UM/self.DOMAIN_SIZE
+        self.INITIAL_ECM_CAPACITY = config["ecm"]["initial_ecm_capacity"]
+        self.ECM_DETECTION_RADIUS = ti.field(dtype=ti.f32, shape=())
+        self.ECM_THRESHOLD = ti.field(dtype=ti.i32, shape=())
+        self.ECM_AVOIDANCE_STRENGTH = ti.field(dtype=ti.f32, shape=())
+        self.ECM_LIFETIME = ti.field(dtype=ti.i32, shape=())
+
+        self.CROWDING_DIFFUSION = ti.field(dtype=ti.f32, shape=())
+        self.CROWDING_EXPONENT = ti.field(dtype=ti.f32, shape=())
+
+        self.TILES_X = config["decomposition"]["tiles_x"]
+        self.TILES_Y = config["decomposition"]["tiles_y"]
+        self.HALO_WIDTH = config["decomposition"]["halo_width"]
 
         self.PHASE_COLORS = np.array(config["display"]["phase_colors"], dtype=np.uint32)
         self.CELL_RADIUS_SCALAR = config["display"]["cell_radius_scalar"]
@@ -71,8 +130,36 @@ class Env:
         # Taichi counters
         self.step = ti.field(dtype=ti.i32, shape=()) # 0
 
+        # Packed status written on the device by every update, so the host can check it with a single read
+        self.STATUS_SLOTS = ["step", "cell_count", "ecm_count", "flags", "ecm_slots"]  # ecm_slots counts freed rows too
+        self.CELLS_FULL = 1
+        self.ECM_FULL = 2
+        self.GROW_DUE = 4  # Capacity may not cover the updates until the next status check
+        self.LINEAGE_FLUSH_DUE = 8
+        self.DATA_DUE = 16
+        self.IMAGE_DUE = 32
+        self.PRINT_DUE = 64
+        self.DATA_INTERVAL = 30
+        self.IMAGE_INTERVAL = 60
+        self.PRINT_INTERVAL = 10
+        # Steps between status reads in main.py. The other intervals are multiples of it, and set_parameters checks
+        # that it is no longer than a cell cycle or min_ecm_period, so each cell divides and deposits at most once between reads
+        self.STATUS_INTERVAL = 10
+        self.statusField = ti.field(dtype=ti.i32, shape=len(self.STATUS_SLOTS))
+
         # Data Collection
-        self.topoField = ti.field(dtype=ti.f32, shape=(self.GRID_RES, self.GRID_RES))
+        if self.SPARSE_GRID:
+            self.topoField = ti.field(dtype=ti.f32)
+            topoBuilder = ti.FieldsBuilder()
+            self.grid_block(topoBuilder).dense(ti.ij, self.GRID_BLOCK_SIZE).place(self.topoField)
+            self.topoTree = topoBuilder.finalize()
+        else:
+            self.topoField = ti.field(dtype=ti.f32, shape=(self.GRID_RES, self.GRID_RES))
+
+        # Wound shape loaded from file, 1 inside the wound
+        self.woundMaskField = ti.field(dtype=ti.i32, shape=(self.WOUND_MASK_RES, self.WOUND_MASK_RES))
+        if self.WOUND_SHAPE_FILE != "":
+            self.woundMaskField.from_numpy(load_wound_mask(self.WOUND_SHAPE_FILE, self.WOUND_MASK_RES).astype(np.int32))
 
         self.paused = False
 
@@ -83,12 +170,59 @@ class Env:
         self.saveHandler = SaveHandler({"fibroblast": self.fibroHandler, "ecm": self.ecmHandler})
         self.imagingHandler = ImagingHandler(self)
         self.statisticHandler = StatisticHandler(self)
+        self.lineageHandler = LineageHandler(self)
+        self.continuumHandler = None  # Created by surrogate.py, the only user of its grids
+        self.shareHandler = ShareHandler(self)
+        self.woundHandler = WoundHandler(self)
 
+        self.set_parameters(config)
         self.initialize_board()
 
+    def grid_block(self, fieldsBuilder):
+        # Pointer SNode over GRID_BLOCK_SIZE^2 blocks of gridcells; fields placed under it are padded to whole blocks
+        return fieldsBuilder.pointer(ti.ij, self.GRID_BLOCKS)
+
+    def set_parameters(self, config):
+        # Kernels read these at run time, so a new parameter set (or a mid-run change) needs no recompilation.
+        # Sizes, flags and the grid layout stay compile-time constants and need a new Env
+        if config["cells"]["cell_cycle_duration"] - self.CELL_CYCLE_JITTER < self.STATUS_INTERVAL:
+            raise Exception(f"cell_cycle_duration must be at least {self.STATUS_INTERVAL + self.CELL_CYCLE_JITTER} steps, "
+                            f"so no cell divides twice between status reads.")
+        if config["ecm"]["min_ecm_period"] < self.STATUS_INTERVAL:
+            raise Exception(f"min_ecm_period must be at least {self.STATUS_INTERVAL} steps, so no cell deposits twice between status reads.")
+        if config["cells"]["cell_cycle_duration"] + self.CELL_CYCLE_JITTER > self.MAX_STEP_AGE:
+            raise Exception(f"cell_cycle_duration can be at most {self.MAX_STEP_AGE - self.CELL_CYCLE_JITTER} steps with this compact_storage setting.")
+        if config["ecm"]["ecm_lifetime"] > self.MAX_STEP_AGE:
+            raise Exception(f"ecm_lifetime can be at most {self.MAX_STEP_AGE} steps with this compact_storage setting.")
+        self.CELL_REPULSION[None] = config["cells"]["cell_repulsion"]
+        self.REPRODUCTION_OFFSET[None] = config["cells"]["reproduction_offset"]
+        self.MAX_CELL_SPEED[None] = config["cells"]["max_cell_speed"]/self.DOMAIN_SIZE
+        self.CELL_TURN_SPEED[None] = config["cells"]["cell_turn_speed"]/(2*np.pi)
+        self.CELL_TURN_CHANCE[None] = config["cells"]["cell_turn_chance"]
+        self.CELL_CYCLE_DURATION[None] = config["cells"]["cell_cycle_duration"]
+
+        self.INHIBITION_RADIUS[None] = config["inhibition"]["inhibition_radius"]
+        self.INHIBITION_THRESHOLD[None] = config["inhibition"]["inhibition_threshold"]
+        self.INHIBITION_EXIT_THRESHOLD[None] = config["inhibition"]["inhibition_exit_threshold"]
+        self.INHIBITION_FACTOR[None] = config["inhibition"]["inhibition_factor"]
+
+        self.GENE_THRESHOLD[None] = config["genes"]["gene_threshold"]
+        self.GENE_DECAY[None] = config["genes"]["gene_decay"]
+
+        self.FRICTION[None] = config["environment"]["friction"]
+        self.SLEEP_SPEED[None] = config["environment"]["sleep_speed"]/self.DOMAIN_SIZE
+
+        self.MIN_ECM_PERIOD[None] = config["ecm"]["min_ecm_period"]
+        self.ECM_DETECTION_RADIUS[None] = config["ecm"]["ecm_detection_radius"]*self.CELL_RADIUS
+        self.ECM_THRESHOLD[None] = config["ecm"]["ecm_threshold"]
+        self.ECM_AVOIDANCE_STRENGTH[None] = config["ecm"]["ecm_avoidance_strength"]/self.DOMAIN_SIZE
+        self.ECM_LIFETIME[None] = config["ecm"]["ecm_lifetime"]
+
+        self.CROWDING_DIFFUSION[None] = config["surrogate"]["crowding_diffusion"]
+        self.CROWDING_EXPONENT[None] = config["surrogate"]["crowding_exponent"]
+
     @ti.kernel
     def initialize_board(self): # Board Init, assign taichi fields
-        self.CELL_CYCLE_DURATION[None] = self.CCDPlaceholder
         self.step[None] = 0
 
         self.fibroHandler.clear_fields()
@@ -105,19 +239,22 @@ class Env:
         if self.INITIAL_MODE == "single" and self.INITIAL_WOUND != "none":
             raise Exception("Wounds are not supported on the single cell initial setup.")
 
-        if self.INITIAL_WOUND not in ["none", "circle", "triangle", "square", "line"]:
+        if self.INITIAL_WOUND not in ["none", "circle", "triangle", "square", "line", "file"]:
             raise Exception("Invalid wound configuration: " + self.INITIAL_WOUND)
 
+        if self.INITIAL_WOUND == "file" and self.WOUND_SHAPE_FILE == "":
+            raise Exception("The file wound needs a wound_shape_file.")
+
         @ti.kernel
         def initial_wound_kernel():
-            shape = {"circle": 0, "square": 1, "triangle": 2, "line": 3}[self.INITIAL_WOUND]
+            shape = {"circle": 0, "square": 1, "triangle": 2, "line": 3, "file": 4}[self.INITIAL_WOUND]
 
-            self.fibroHandler.mark_for_deletion(0.5, 0.5, self.WOUND_WIDTH, shape)
+            self.fibroHandler.mark_for_deletion(self.WOUND_CENTER[0], self.WOUND_CENTER[1], self.WOUND_WIDTH, shape)
             self.fibroHandler.write_buffer()
             self.fibroHandler.copy_back_buffer()
             self.fibroHandler.rebuild_grid()
 
-            self.ecmHandler.mark_for_deletion(0.5, 0.5, self.WOUND_WIDTH, shape)
+            self.ecmHandler.mark_for_deletion(self.WOUND_CENTER[0], self.WOUND_CENTER[1], self.WOUND_WIDTH, shape)
             self.ecmHandler.write_buffer()
             self.ecmHandler.copy_back_buffer()
             self.ecmHandler.rebuild_grid()
@@ -125,6 +262,80 @@ class Env:
         if self.INITIAL_WOUND != "none":
             initial_wound_kernel()
 
+    def reserve_capacity(self, status=None):
+        # Every cell can divide and deposit ECM once until the next status check, so make room for the worst case
+        if status is None:
+            status = self.refresh_status()
+        if status["flags"] & self.GROW_DUE:
+            cell_count = status["cell_count"]
+            self.fibroHandler.reserve(2 * cell_count + 1)
+            self.ecmHandler.reserve(status["ecm_count"] + 2 * cell_count + 1)  # Daughters deposit too
+        if status["flags"] & self.LINEAGE_FLUSH_DUE:
+            self.lineageHandler.flush()
+
+    def simulate_substeps(self, substeps=None):
+        # Do multiple steps per frame for stability. In adaptive mode the relaxed flag is read every few substeps
+        # once the minimum has run, and no more kernels are launched after it is set
+        if substeps is None:
+            substeps = self.MAX_SUBSTEPS if self.ADAPTIVE_SUBSTEPS else self.SUBSTEPS
+        for substep in range(1, substeps + 1):
+            self.verlet_step_cells_kernel()
+            self.border_constraints_cell_kernel()
+            self.rebuild_grid_cells_kernel()
+            self.handle_collisions_cells_kernel()
+            if self.ADAPTIVE_SUBSTEPS and substep >= self.MIN_SUBSTEPS and (substep - self.MIN_SUBSTEPS) % self.RELAXED_CHECK_INTERVAL == 0:
+                if self.fibroHandler.relaxed[None]:
+                    break
+
+    def read_status(self):
+        return dict(zip(self.STATUS_SLOTS, self.statusField.to_numpy().tolist()))
+
+    def refresh_status(self):
+        # For counts changed outside of an update, e.g. by the scalpel
+        self.update_status_kernel()
+        return self.read_status()
+
+    @ti.func
+    def write_status(self, output_step):
+        # output_step is the step whose outputs are due, or -1 for none
+        cells = self.fibroHandler.count[None]
+        ecm_slots = self.ecmHandler.count[None]
+        ecm = ecm_slots - self.ecmHandler.freeCount[None]
+        flags = 0
+        if ti.static(self.fibroHandler.COUNT_LIMIT != -1):
+            if cells >= self.fibroHandler.COUNT_LIMIT - 1:
+                flags |= self.CELLS_FULL
+        if ti.static(self.ecmHandler.COUNT_LIMIT != -1):
+            if ecm >= self.ecmHandler.COUNT_LIMIT - 1:
+                flags |= self.ECM_FULL
+        # Handlers already at their hard cap can't grow, so they never make growth due
+        if ti.static(self.fibroHandler.MAX_COUNT != self.fibroHandler.COUNT_LIMIT):
+            if 2 * cells + 1 > self.fibroHandler.MAX_COUNT:
+                flags |= self.GROW_DUE
+        if ti.static(self.ecmHandler.MAX_COUNT != self.ecmHandler.COUNT_LIMIT):
+            if ecm + 2 * cells + 1 > self.ecmHandler.MAX_COUNT:
+                flags |= self.GROW_DUE
+        if ti.static(self.LINEAGE_LOG):
+            if self.fibroHandler.lineageLogCount[None] + cells > self.LINEAGE_BUFFER_SIZE:
+                flags |= self.LINEAGE_FLUSH_DUE
+        if output_step >= 0:
+            if output_step % self.DATA_INTERVAL == 0:
+                flags |= self.DATA_DUE
+            if output_step % self.IMAGE_INTERVAL == 0:
+                flags |= self.IMAGE_DUE
+            if output_step % self.PRINT_INTERVAL == 0:
+                flags |= self.PRINT_DUE
+
+        self.statusField[0] = self.step[None]
+        self.statusField[1] = cells
+        self.statusField[2] = ecm
+        self.statusField[3] = flags
+        self.statusField[4] = ecm_slots
+
+    @ti.kernel
+    def update_status_kernel(self):
+        self.write_status(-1)
+
     # CELL KERNELS
 
     @ti.kernel
@@ -148,8 +359,23 @@ class Env:
         self.fibroHandler.create(posX, posY)
 
     @ti.kernel
-    def delete_cells_kernel(self, mouse_x: ti.f32, mouse_y: ti.f32, size: ti.f32, shape: ti.i32):
+    def mark_cells_kernel(self, mouse_x: ti.f32, mouse_y: ti.f32, size: ti.f32, shape: ti.i32):
         self.fibroHandler.mark_for_deletion(mouse_x, mouse_y, size, shape)
+
+    @ti.kernel
+    def mark_cells_near_kernel(self, mouse_x: ti.f32, mouse_y: ti.f32, size: ti.f32, shape: ti.i32):
+        self.fibroHandler.mark_near_for_deletion(mouse_x, mouse_y, size, shape)
+
+    def delete_cells(self, mouse_x, mouse_y, size, shape):
+        # Only compacts when the scalpel hit something
+        self.mark_cells_near_kernel(mouse_x, mouse_y, size, shape)
+        if self.fibroHandler.gridOverflow[None]:
+            self.mark_cells_kernel(mouse_x, mouse_y, size, shape)
+        if self.fibroHandler.markedCount[None] > 0:
+            self.compact_cells_kernel()
+
+    @ti.kernel
+    def compact_cells_kernel(self):
         self.fibroHandler.write_buffer()
         self.fibroHandler.copy_back_buffer()
         self.fibroHandler.rebuild_grid()
@@ -165,15 +391,111 @@ class Env:
         self.ecmHandler.create(posX, posY)
 
     @ti.kernel
-    def delete_ecm_kernel(self, mouse_x: ti.f32, mouse_y: ti.f32, size: ti.f32, shape: ti.i32):
+    def mark_ecm_kernel(self, mouse_x: ti.f32, mouse_y: ti.f32, size: ti.f32, shape: ti.i32):
         self.ecmHandler.mark_for_deletion(mouse_x, mouse_y, size, shape)
+
+    @ti.kernel
+    def mark_ecm_near_kernel(self, mouse_x: ti.f32, mouse_y: ti.f32, size: ti.f32, shape: ti.i32):
+        self.ecmHandler.mark_near_for_deletion(mouse_x, mouse_y, size, shape)
+
+    def delete_ecm(self, mouse_x, mouse_y, size, shape):
+        # Only compacts when the scalpel hit something
+        self.mark_ecm_near_kernel(mouse_x, mouse_y, size, shape)
+        if self.ecmHandler.gridOverflow[None]:
+            self.mark_ecm_kernel(mouse_x, mouse_y, size, shape)
+        if self.ecmHandler.markedCount[None] > 0:
+            self.compact_ecm_kernel()
+
+    @ti.kernel
+    def compact_ecm_kernel(self):
         self.ecmHandler.write_buffer()
         self.ecmHandler.copy_back_buffer()
         self.ecmHandler.rebuild_grid()
 
     # LOGIC KERNELS
 
+    @ti.kernel
+    def summarize_kernel(self):
+        self.fibroHandler.summarize()
+
+    @ti.kernel
+    def profile_edge_kernel(self):
+        self.fibroHandler.profile_edge()
+
+    @ti.kernel
+    def render_image_kernel(self):
+        self.imagingHandler.render()
+
+    @ti.kernel
+    def load_wound_counts_kernel(self, counts: ti.types.ndarray()):
+        self.woundHandler.load_counts(counts)
+
+    @ti.kernel
+    def segment_wound_kernel(self, counts: ti.template()):
+        self.woundHandler.segment(counts)
+
+    @ti.kernel
+    def share_state_kernel(self, cell_pos: ti.types.ndarray(), cell_phase: ti.types.ndarray(),
+                           ecm_pos: ti.types.ndarray(), grid_count: ti.types.ndarray(), slot: ti.i32):
+        # Writes straight into the shared memory arrays of ShareHandler. The grid is the one of the last substep
+        for i in range(self.fibroHandler.count[None]):
+            for k in ti.static(range(2)):
+                cell_pos[i, k] = self.fibroHandler.posField[i][k]
+            cell_phase[i] = ti.cast(self.fibroHandler.phaseField[i], ti.i8)
+        for i in range(self.ecmHandler.count[None]):
+            for k in ti.static(range(2)):
+                ecm_pos[i, k] = self.ecmHandler.posField[i][k]
+        if ti.static(self.SPARSE_GRID):  # Only live blocks are copied, so zero the ones this slot held that are gone
+            for bx, by in ti.ndrange(self.GRID_BLOCKS, self.GRID_BLOCKS):
+                live = ti.is_active(self.fibroHandler.gridBlock, [bx, by])
+                if self.shareHandler.sharedBlockField[slot, bx, by] and not live:
+                    for a, b in ti.ndrange(self.GRID_BLOCK_SIZE, self.GRID_BLOCK_SIZE):
+                        x = bx * self.GRID_BLOCK_SIZE + a
+                        y = by * self.GRID_BLOCK_SIZE + b
+                        if x < self.GRID_RES and y < self.GRID_RES:
+                            grid_count[x, y] = 0
+                self.shareHandler.sharedBlockField[slot, bx, by] = ti.cast(live, ti.i8)
+        for x, y in self.fibroHandler.gridCount:
+            if x < self.GRID_RES and y < self.GRID_RES:
+                grid_count[x, y] = self.fibroHandler.gridCount[x, y]
+
+    # DECOMPOSITION KERNELS
+
+    @ti.kernel
+    def pack_rows_kernel(self, handler: ti.template(), tile: ti.i32, migrants: ti.i32,
+                         rows: ti.types.ndarray(dtype=ti.i32, ndim=2)) -> ti.i32:
+        # Writes straight into the shared memory segments of DecompositionHandler
+        return handler.pack_rows(tile, migrants, rows)
+
+    @ti.kernel
+    def unpack_rows_kernel(self, handler: ti.template(), rows: ti.types.ndarray(dtype=ti.i32, ndim=2), n: ti.i32):
+        handler.unpack_rows(rows, n)
+
+    @ti.kernel
+    def mark_foreign_kernel(self, handler: ti.template(), tile: ti.i32):
+        handler.mark_foreign(tile)
+
+    # SURROGATE KERNELS
+
+    @ti.kernel
+    def seed_continuum_kernel(self):
+        self.continuumHandler.seed()
+
+    @ti.kernel
+    def step_continuum_kernel(self):
+        self.continuumHandler.step()
+        self.step[None] += 1
+
+    @ti.kernel
+    def summarize_continuum_kernel(self):
+        self.continuumHandler.summarize()
+
     @ti.kernel
     def update_kernel(self):
         self.fibroHandler.update()
-        self.ecmHandler.update()
\ No newline at end of file
+        self.ecmHandler.update()
+
+        # Flags refer to the step just simulated, the status step is the next one
+        step = self.step[None]
+        self.step[None] = step + 1
+        self.write_status(step)
\ No newline at end of file
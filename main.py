@@ -1,3 +1,6 @@
+import time
+startup_time = time.perf_counter()
+
 import taichi as ti
 import tomli
 import os
@@ -11,9 +14,11 @@ import sys
 
 from env import Env
 
-plot_proc = subprocess.Popen([sys.executable, "plot.py"])
+plot_proc = None
 
 def cleanup():
+    if plot_proc is None:
+        return
     plot_proc.terminate()
     try:
         plot_proc.wait(timeout=3)
@@ -44,14 +49,15 @@ def command_server():
                 display_ecm = not display_ecm
             if cmd == "cycle_scalpel":
                 cycle_scalpel += 1
-                if cycle_scalpel == 4:
+                if cycle_scalpel == (5 if env.WOUND_SHAPE_FILE != "" else 4):
                     cycle_scalpel = 0
             conn.sendall(b'OK')
 
 
 atexit.register(cleanup)
 
-ti.init(arch=ti.gpu)
+# Compiled kernels are cached on disk; config constants are baked into the kernels, so each config gets its own entries
+ti.init(arch=ti.gpu, offline_cache=True)
 
 if not os.path.exists("config.toml"):
     shutil.copyfile("defaultconfig.toml", "config.toml")
@@ -60,6 +66,9 @@ if not os.path.exists("config.toml"):
 with open('config.toml', 'rb') as f:
     config = tomli.load(f)
 
+if config["data_collection"]["live_plot"]:
+    plot_proc = subprocess.Popen([sys.executable, "plot.py"])
+
 display_phase = True
 display_cells = True
 display_ecm = True
@@ -77,17 +86,33 @@ LMB_down = False
 
 hour = 0
 
-fieldnames = ["step", "fibroblast_count", "ecm_count", "wound_area", "wound_width"]
+fieldnames = ["step", "fibroblast_count", "ecm_count", "wound_area", "wound_width"] + env.statisticHandler.get_metric_columns()
+
+edge_fieldnames = env.statisticHandler.get_edge_profile_columns()
 
 with open('data/data.csv', 'w') as csv_file:
     csv_writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
     csv_writer.writeheader()
 
+with open('data/edge_profile.csv', 'w') as edge_file:
+    csv.DictWriter(edge_file, fieldnames=edge_fieldnames).writeheader()
+
+if env.LINEAGE_LOG:
+    env.lineageHandler.open('data/lineage.bin')
+
+if env.SHARE_INTERVAL > 0:
+    env.shareHandler.open(env.SHARE_NAME)
+
 env.experimental_setup()
+setup_time = time.perf_counter()
+
+status = env.refresh_status()
+step = status["step"] - 1  # Last simulated step, counted on the host between status reads
+cycle_duration = env.CELL_CYCLE_DURATION[None]
 
 # Main Loop
-with open('data/data.csv', 'a') as csv_file:
-    while gui.running and (env.END_STEP == -1 or env.step[None] < env.END_STEP):
+with open('data/data.csv', 'a') as csv_file, open('data/edge_profile.csv', 'a') as edge_file:
+    while gui.running and (env.END_STEP == -1 or step + 1 < env.END_STEP):
         if env.INITIAL_WOUND_AREA is None:
             env.INITIAL_WOUND_AREA = env.statisticHandler.get_wound_area()
 
@@ -99,9 +124,13 @@ with open('data/data.csv', 'a') as csv_file:
                 if e.key == ti.GUI.LMB:
                     LMB_down = True
                 if e.key == ti.GUI.RMB:
+                    status = env.refresh_status()  # The count may be from a few steps ago
+                    env.fibroHandler.reserve(status["cell_count"] + 2)
                     env.create_cell_kernel(mouse_pos[0], mouse_pos[1])
+                    status = env.refresh_status()
                 if e.key == ti.GUI.SPACE:
                     env.paused = not env.paused
+                    env.rebuild_grid_cells_kernel()  # The scalpel looks cells up in the grid, which goes stale during the update
                 if e.key == ti.GUI.ALT:
                     env.saveHandler.save_state()
                 if e.key == ti.GUI.ESCAPE:
@@ -112,32 +141,11 @@ with open('data/data.csv', 'a') as csv_file:
 
         # Deletion
         if env.paused and gui.is_pressed(ti.GUI.SHIFT) and LMB_down and mouse_pos is not None:
-            env.delete_cells_kernel(gui.get_cursor_pos()[0], gui.get_cursor_pos()[1], env.WOUND_WIDTH, cycle_scalpel)
-            env.delete_ecm_kernel(gui.get_cursor_pos()[0], gui.get_cursor_pos()[1], env.WOUND_WIDTH, cycle_scalpel)
-
-        if display_ecm:
-            if env.DRAW_ECM_LINES:
-                gui.lines(env.ecmHandler.ecmConnectPosField.to_numpy()[:env.ecmHandler.count[None]],
-                          env.ecmHandler.posField.to_numpy()[:env.ecmHandler.count[None]],
-                          radius=1,
-                          color=0x353355)
-            else:
-                gui.circles(
-                    env.ecmHandler.posField.to_numpy()[:env.ecmHandler.count[None]],
-                    radius=env.CELL_RADIUS * env.SCREEN_SIZE[0] * env.CELL_RADIUS_SCALAR,
-                    color=0x353355
-                )
-
-        if display_cells:
-            positions = env.fibroHandler.posField.to_numpy()[:env.fibroHandler.count[None]]
-            if display_phase:
-                gui.circles(
-                    positions,
-                    radius=env.CELL_RADIUS * env.SCREEN_SIZE[0] * env.CELL_RADIUS_SCALAR,
-                    color=env.PHASE_COLORS[env.fibroHandler.phaseField.to_numpy()[:env.fibroHandler.count[None]]]
-                )
-            else:
-                gui.circles(positions, radius=env.CELL_RADIUS * env.SCREEN_SIZE[0] * env.CELL_RADIUS_SCALAR, color=0xffffff)
+            env.delete_cells(gui.get_cursor_pos()[0], gui.get_cursor_pos()[1], env.WOUND_WIDTH, cycle_scalpel)
+            env.delete_ecm(gui.get_cursor_pos()[0], gui.get_cursor_pos()[1], env.WOUND_WIDTH, cycle_scalpel)
+            status = env.refresh_status()
+
+        env.imagingHandler.draw(gui, display_cells=display_cells, display_phase=display_phase, display_ecm=display_ecm)
 
         gui.show()
 
@@ -145,45 +153,63 @@ with open('data/data.csv', 'a') as csv_file:
             continue
 
         # env.clear_topo_field()
-        for _ in range(env.SUBSTEPS):  # Do multiple steps per frame for stability
-            env.verlet_step_cells_kernel()
-            env.border_constraints_cell_kernel()
-            env.rebuild_grid_cells_kernel()
-            env.handle_collisions_cells_kernel()
-
-        env.update_kernel()
+        env.simulate_substeps()
 
+        env.reserve_capacity(status)
+        env.update_kernel()  # Also advances the step counter on the device
         env.rebuild_grid_ecm_kernel()
-        if env.step[None] % 30 == 0:
-            sum = 0
-            count = int(env.GRID_RES/10)
-            for i in range(count):
-                sum += env.statisticHandler.get_wound_width(i)
-            avg = sum/count
 
+        step += 1
+
+        # Reading the status waits for the device, so only read it when the counts or flags are needed.
+        # Drawing syncs on its own, for the particles it shows
+        state_due = env.STATE_INTERVAL > 0 and step % env.STATE_INTERVAL == 0
+        share_due = env.SHARE_INTERVAL > 0 and step % env.SHARE_INTERVAL == 0
+        if step % env.STATUS_INTERVAL == 0 or state_due or share_due:
+            status = env.read_status()
+        else:
+            status["flags"] = 0  # Handled when they were read
+
+        if status["flags"] & env.DATA_DUE:
             csv_writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
             info = {
-                "step": env.step[None],
-                "fibroblast_count": env.fibroHandler.count[None],
-                "ecm_count": env.ecmHandler.count[None],
-                "wound_area": env.statisticHandler.get_wound_area(),
-                "wound_width": avg
+                "step": step,
+                "fibroblast_count": status["cell_count"],
+                "ecm_count": status["ecm_count"],
+                "wound_width": env.statisticHandler.get_average_wound_width()
             }
+            info.update(env.statisticHandler.get_wound_columns())
+            info.update(env.statisticHandler.get_summary(step=step))
             csv_writer.writerow(info)
             csv_file.flush()
             os.fsync(csv_file.fileno())
 
-        if env.CAPTURE_DATA and env.step[None] % 60 == 0:
-            env.imagingHandler.capture_image(f"{env.DATA_PATH}/images/experiment_{env.EXPERIMENT_TIMESTAMP}")
+            csv.DictWriter(edge_file, fieldnames=edge_fieldnames).writerow(env.statisticHandler.get_edge_profile(step=step))
+            edge_file.flush()
+
+        if env.CAPTURE_DATA and status["flags"] & env.IMAGE_DUE:
+            env.imagingHandler.capture_image(f"{env.DATA_PATH}/images/experiment_{env.EXPERIMENT_TIMESTAMP}", step)
+
+        if state_due:  # Trajectory for render.py
+            env.saveHandler.save_state(f"{env.DATA_PATH}/states/experiment_{env.EXPERIMENT_TIMESTAMP}/step_{step:06d}")
+
+        if share_due:  # Live view for ShareReader
+            env.shareHandler.publish(step, status)
 
         warn = ""
-        if env.fibroHandler.count[None] == env.MAX_CELL_COUNT:
+        if status["flags"] & env.CELLS_FULL:
             warn = " | Warning: Max Cell Count Reached!"
-        if env.step[None] % 10 == 0:
-            print("Step: " + str(env.step[None]) + " | Hour: " + str(round(hour)) + " | Cells: " + str(env.fibroHandler.count[None]) + warn)
+        if status["flags"] & env.PRINT_DUE:
+            print("Step: " + str(step) + " | Hour: " + str(round(hour)) + " | Cells: " + str(status["cell_count"]) + warn)
         # print(str(env.statisticHandler.get_wound_area()) + " µm")
-        hour += 24/env.CELL_CYCLE_DURATION[None]
-        env.step[None] += 1
+        hour += 24/cycle_duration
+
+        if step == 0:
+            now = time.perf_counter()
+            print(f"Startup: {setup_time - startup_time:.2f}s to set up, {now - setup_time:.2f}s for the first step")
+
+env.lineageHandler.close()
+env.shareHandler.close()
 
 if env.SAVE_VIDEO:
     env.imagingHandler.save_video(f"{env.DATA_PATH}/images/experiment_{env.EXPERIMENT_TIMESTAMP}")
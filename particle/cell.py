@@ -1,4 +1,5 @@
 import taichi as ti
+import numpy as np
 
 from particle.moving_particle import MovingParticleHandler
 
@@ -6,24 +7,74 @@ from particle.moving_particle import MovingParticleHandler
 class CellHandler(MovingParticleHandler):
     parent = MovingParticleHandler
 
-    def __init__(self, env, maxCount):
-        super().__init__(env, maxCount)
+    # Cell cycle genes, and the phase whose program expresses each (1 = G1/S, 2 = S, 3 = G2, 4 = M)
+    GENES = ["ORC1", "CCNE1", "CCNE2", "MCM6", "WEE1", "CDK1", "CCNF", "NUSAP1", "AURKA", "CCNA2", "CCNB2"]
+    GENE_PHASES = [1, 1, 1, 1, 2, 4, 3, 3, 4, 2, 4]
+
+    # Raw per-step aggregates, reduced on device and read back as one vector
+    SUMMARY_COLUMNS = ["g0", "g1", "s", "g2", "m",
+                       "inhibition_sum", "inhibition_sq_sum", "speed_sum", "speed_sq_sum"] + \
+                      [f"gene{k}_sum" for k in range(len(GENES))] + ["divisions", "deletions"]
+
+    def __init__(self, env, maxCount, initialCount):
+        super().__init__(env, maxCount, initialCount)
+
+        # Summary Statistics
+        self.summaryField = ti.field(dtype=ti.f32, shape=len(self.SUMMARY_COLUMNS))
+        self.divisionCount = ti.field(dtype=ti.i32, shape=())  # Divisions since the last summary
+
+        # Lineage
+        self.nextId = ti.field(dtype=ti.i32, shape=())  # Id given to the next new cell
+        self.lineageLogField = ti.Vector.field(3, dtype=ti.i32, shape=self.env.LINEAGE_BUFFER_SIZE)  # (id, parent id, birth step) per division
+        self.lineageLogCount = ti.field(dtype=ti.i32, shape=())
+        self.lineageLostCount = ti.field(dtype=ti.i32, shape=())  # Divisions that did not fit before the last flush
+
+        # Wound Edge Profile (polar bins around the wound center)
+        self.edgeRadiusField = ti.field(dtype=ti.f32, shape=self.env.EDGE_ANGLE_BINS)  # Closest cell to the center per sector
+        self.radialCountField = ti.field(dtype=ti.i32, shape=self.env.EDGE_RADIUS_BINS)  # Cells per distance bin
+
+        # Sleeping Regions (gridcells with no moving or cycling cells nearby)
+        if self.env.SLEEPING_CELLS:
+            self.activeGridField = ti.field(dtype=ti.i32, shape=(self.env.GRID_RES, self.env.GRID_RES))
+            self.awakeGridField = ti.field(dtype=ti.i32, shape=(self.env.GRID_RES, self.env.GRID_RES))
+
+    def allocate_fields(self):
+        CellHandler.parent.allocate_fields(self)
 
         # Fields
-        self.lastDivField = ti.field(dtype=ti.i32, shape=self.MAX_COUNT)
-        self.inhibitionField = ti.field(dtype=ti.f32, shape=self.MAX_COUNT)
-        self.neighborField = ti.field(dtype=ti.f32, shape=self.MAX_COUNT)
-        self.phaseField = ti.field(dtype=ti.i32, shape=self.MAX_COUNT)
-        self.mvmtField = ti.Vector.field(3, dtype=ti.f32, shape=self.MAX_COUNT)
-        self.cycleDurField = ti.field(dtype=ti.i32, shape=self.MAX_COUNT)  # Cycle duration
+        self.lastDivField = self.particle_field(self.env.STEP_DTYPE)
+        self.inhibitionField = self.particle_field(ti.f32)
+        self.neighborField = self.particle_field(self.env.FLAG_DTYPE)  # Neighbors within the inhibition radius last step
+        self.phaseField = self.particle_field(self.env.FLAG_DTYPE)
+        self.headingField = self.particle_field(ti.f32)  # Movement angle (in turns)
+        self.turnField = self.particle_field(self.env.FLAG_DTYPE)  # Turning state (-1, 0, 1)
+        self.speedField = self.particle_field(self.env.FRACTION_DTYPE)  # Speed (fraction of max cell speed)
+        self.cycleDurField = self.particle_field(self.env.SHORT_DTYPE)  # Cycle duration
+        self.daughterPosField = self.particle_field(ti.f32, 2)  # Position of the daughter created this step
+        self.idField = self.particle_field(ti.i32)  # Stable across compaction and reordering
+        self.parentIdField = self.particle_field(ti.i32)  # -1 for cells that were not born from a division
+        self.birthStepField = self.particle_field(ti.i32)
+        if self.env.GENE_EXPRESSION:
+            self.geneField = self.particle_field(self.env.FRACTION_DTYPE, len(self.GENES))  # Expression level per gene (0-1)
+        if self.env.SLEEPING_CELLS:
+            self.settledPosField = self.particle_field(ti.f32, 2)  # Position at the last activity check
 
         # Buffer Fields
-        self.lastDivFieldBuffer = ti.field(dtype=ti.i32, shape=self.MAX_COUNT)
-        self.inhibitionFieldBuffer = ti.field(dtype=ti.f32, shape=self.MAX_COUNT)
-        self.neighborFieldBuffer = ti.field(dtype=ti.f32, shape=self.MAX_COUNT)
-        self.phaseFieldBuffer = ti.field(dtype=ti.i32, shape=self.MAX_COUNT)
-        self.mvmtFieldBuffer = ti.Vector.field(3, dtype=ti.f32, shape=self.MAX_COUNT)
-        self.cycleDurFieldBuffer = ti.field(dtype=ti.i32, shape=self.MAX_COUNT)
+        self.lastDivFieldBuffer = self.particle_field(self.env.STEP_DTYPE)
+        self.inhibitionFieldBuffer = self.particle_field(ti.f32)
+        self.neighborFieldBuffer = self.particle_field(self.env.FLAG_DTYPE)
+        self.phaseFieldBuffer = self.particle_field(self.env.FLAG_DTYPE)
+        self.headingFieldBuffer = self.particle_field(ti.f32)
+        self.turnFieldBuffer = self.particle_field(self.env.FLAG_DTYPE)
+        self.speedFieldBuffer = self.particle_field(self.env.FRACTION_DTYPE)
+        self.cycleDurFieldBuffer = self.particle_field(self.env.SHORT_DTYPE)
+        self.idFieldBuffer = self.particle_field(ti.i32)
+        self.parentIdFieldBuffer = self.particle_field(ti.i32)
+        self.birthStepFieldBuffer = self.particle_field(ti.i32)
+        if self.env.GENE_EXPRESSION:
+            self.geneFieldBuffer = self.particle_field(self.env.FRACTION_DTYPE, len(self.GENES))
+        if self.env.SLEEPING_CELLS:
+            self.settledPosFieldBuffer = self.particle_field(ti.f32, 2)
 
     @ti.func
     def apply_locomotion(self, i: ti.i32):
@@ -34,24 +85,27 @@ class CellHandler(MovingParticleHandler):
             gridcell_y = ti.min(ti.max(int(self.posField[i][1] * self.env.GRID_RES), 0), self.env.GRID_RES - 1)
             ecm_centroid = ti.Vector([0.0, 0.0])
             for offset in ti.static(ti.grouped(ti.ndrange((-2, 3), (-2, 3)))):
-                cx = gridcell_x + offset[0]
-                cy = gridcell_y + offset[1]
+                cx = self.wrap_gridcell(gridcell_x + offset[0])
+                cy = self.wrap_gridcell(gridcell_y + offset[1])
                 if 0 <= cx < self.env.GRID_RES and 0 <= cy < self.env.GRID_RES:
                     count = self.env.ecmHandler.gridCount[cx, cy]
                     for j in range(count):
                         ecm_idx = self.env.ecmHandler.grid[cx, cy, j]
-                        dx = self.posField[i] - self.env.ecmHandler.posField[ecm_idx]
+                        dx = self.displacement(self.posField[i], self.env.ecmHandler.posField[ecm_idx])
                         dist = dx.norm()
-                        if dist < self.env.ECM_DETECTION_RADIUS:
-                            ecm_centroid += self.env.ecmHandler.posField[ecm_idx]
+                        if dist < self.env.ECM_DETECTION_RADIUS[None]:
+                            if ti.static(self.env.PERIODIC):  # Nearest image of the ECM particle
+                                ecm_centroid += self.posField[i] - dx
+                            else:
+                                ecm_centroid += self.env.ecmHandler.posField[ecm_idx]
                             ecm_count += 1
             if ecm_count > 0:
                 ecm_avg_pos = ecm_centroid/ecm_count
                 delta = self.posField[i] - ecm_avg_pos
                 if ti.math.length(delta) > 0.005:
-                    repulse_vec = ti.math.normalize(delta)*self.env.ECM_AVOIDANCE_STRENGTH
+                    repulse_vec = ti.math.normalize(delta)*self.env.ECM_AVOIDANCE_STRENGTH[None]
 
-        if ti.random() < self.env.CELL_TURN_CHANCE:
+        if ti.random() < self.env.CELL_TURN_CHANCE[None]:
             r = ti.random()
             val = 0
             if r < 1/3:
@@ -60,39 +114,202 @@ class CellHandler(MovingParticleHandler):
                 val = 0
             else:
                 val = 1
-            self.mvmtField[i][1] = val
-        self.mvmtField[i][0] += self.mvmtField[i][1] * self.env.CELL_TURN_SPEED
-        angle = self.mvmtField[i][0] * 2 * ti.math.pi
-        mvmtVector = self.mvmtField[i][2] * ti.Vector([ti.cos(angle), ti.sin(angle)])
+            self.turnField[i] = self.env.FLAG_DTYPE(val)
+        self.headingField[i] += self.turnField[i] * self.env.CELL_TURN_SPEED[None]
+        angle = self.headingField[i] * 2 * ti.math.pi
+        speed = ti.cast(self.speedField[i], ti.f32) * self.env.MAX_CELL_SPEED[None]
+        mvmtVector = speed * ti.Vector([ti.cos(angle), ti.sin(angle)])
         self.posField[i] += (mvmtVector+repulse_vec)/(ti.math.log(ecm_count+5)-0.6)
 
+    @ti.func
+    def count_neighbors(self):
+        # Contact inhibition, once per step so it does not depend on the number of collision substeps.
+        # Needs the cell grid from the last substep
+        radius = self.env.INHIBITION_RADIUS[None] * self.env.CELL_RADIUS
+        reach = int(ti.ceil(radius * self.env.GRID_RES))
+        if ti.static(self.env.PERIODIC):  # Don't visit a wrapped gridcell twice
+            reach = ti.min(reach, (self.env.GRID_RES - 1) // 2)
+        for i in range(self.count[None]):
+            if not self.is_awake(i):  # Sleeping cells keep their inhibition until a neighbor wakes them
+                continue
+            pos_i = self.posField[i]
+            gridcell_x = ti.min(ti.max(int(pos_i[0] * self.env.GRID_RES), 0), self.env.GRID_RES - 1)
+            gridcell_y = ti.min(ti.max(int(pos_i[1] * self.env.GRID_RES), 0), self.env.GRID_RES - 1)
+            neighbors = 0
+            for ox, oy in ti.ndrange((-reach, reach + 1), (-reach, reach + 1)):
+                cx = self.wrap_gridcell(gridcell_x + ox)
+                cy = self.wrap_gridcell(gridcell_y + oy)
+                if 0 <= cx < self.env.GRID_RES and 0 <= cy < self.env.GRID_RES:
+                    for j in range(ti.min(self.gridCount[cx, cy], self.env.MAX_PARTICLES_PER_GRID_CELL)):
+                        other = self.grid[cx, cy, j]
+                        if other != i:
+                            dist = self.displacement(pos_i, self.posField[other]).norm()
+                            if radius > dist > self.env.EPSILON:
+                                neighbors += 1
+
+            inhibition = self.inhibitionField[i] - self.env.INHIBITION_FACTOR[None]
+            if neighbors > 0:
+                inhibition = ti.min(self.inhibitionField[i] + neighbors * self.env.INHIBITION_FACTOR[None], self.env.INHIBITION_THRESHOLD[None])
+            self.inhibitionField[i] = inhibition
+            self.neighborField[i] = self.env.FLAG_DTYPE(ti.min(neighbors, 127))
+
     @ti.func
     def update(self):
         CellHandler.parent.update(self)
-        for i in range(self.count[None]):
+        self.count_neighbors()
+        n = self.count[None]
+        for i in range(n):
+            self.scanField[i] = 0
+            if not self.is_awake(i):
+                self.handle_sleeping(i)
+                continue
             self.apply_locomotion(i)
             self.handleCellDependentBehavior(i)
-            if self.neighborField[i] == 0:
-                self.inhibitionField[i] -= self.env.INHIBITION_FACTOR
-            self.neighborField[i] = 0
+        self.spawn(n)
+        if ti.static(self.env.SLEEPING_CELLS):
+            self.update_activity()
 
     @ti.func
-    def handleCellDependentBehavior(self, i: ti.i32):
-        self.handle_cell_cycle(i)
+    def spawn(self, n: ti.i32):
+        # Daughters marked during the update get consecutive slots after the first n cells
+        self.prefix_sum(self.scanField, n)
+        births = ti.min(self.scanTotal[None], self.spawn_slots(n))
+        log_start = self.lineageLogCount[None]
+        for i in range(n):
+            slot = self.spawn_slot(self.scanField, i)
+            if 0 <= slot < births:
+                self.initialize(n + slot, self.daughterPosField[i])
+                self.idField[n + slot] = self.nextId[None] + slot
+                self.parentIdField[n + slot] = self.idField[i]
+                if ti.static(self.env.GENE_EXPRESSION):
+                    self.geneField[n + slot] = self.geneField[i]
+                if ti.static(self.env.LINEAGE_LOG):
+                    if log_start + slot < self.env.LINEAGE_BUFFER_SIZE:
+                        self.lineageLogField[log_start + slot] = ti.Vector([self.nextId[None] + slot, self.idField[i], self.env.step[None]])
+        self.count[None] = n + births
+        self.nextId[None] += births
+        self.divisionCount[None] += births
+        if ti.static(self.env.LINEAGE_LOG):
+            logged = ti.min(births, self.env.LINEAGE_BUFFER_SIZE - log_start)
+            self.lineageLogCount[None] = log_start + logged
+            self.lineageLostCount[None] += births - logged
+
+    @ti.func
+    def create(self, posX: ti.f32, posY: ti.f32):
+        idx = CellHandler.parent.create(self, posX, posY)
+        if idx >= 0:
+            self.idField[idx] = ti.atomic_add(self.nextId[None], 1)
+        return idx
+
+    @ti.func
+    def is_awake(self, i):
+        awake = True
+        if ti.static(self.env.SLEEPING_CELLS):
+            gridcell_x = ti.min(ti.max(int(self.posField[i][0] * self.env.GRID_RES), 0), self.env.GRID_RES - 1)
+            gridcell_y = ti.min(ti.max(int(self.posField[i][1] * self.env.GRID_RES), 0), self.env.GRID_RES - 1)
+            awake = self.awakeGridField[gridcell_x, gridcell_y] == 1
+        return awake
+
+    @ti.func
+    def is_restless(self, i: ti.i32):
+        # Whether a cell still needs simulating: cycling, moving or not yet fully inhibited.
+        # Movement is the net drift over the whole step. Collisions jostle settled cells back and forth
+        # within a step, and waking on that spread through the tissue from every awake neighbor
+        drift = self.displacement(self.posField[i], self.settledPosField[i]).norm()
+        return self.phaseField[i] != 0 or self.speedField[i] > 0 or drift > self.env.SLEEP_SPEED[None] or self.inhibitionField[i] < self.env.INHIBITION_THRESHOLD[None]
+
+    @ti.func
+    def update_activity(self):
+        # A gridcell is active if it holds a restless cell
+        for gx, gy in self.activeGridField:
+            self.activeGridField[gx, gy] = 0
+
+        for i in range(self.count[None]):
+            if self.is_restless(i):
+                gridcell_x = ti.min(ti.max(int(self.posField[i][0] * self.env.GRID_RES), 0), self.env.GRID_RES - 1)
+                gridcell_y = ti.min(ti.max(int(self.posField[i][1] * self.env.GRID_RES), 0), self.env.GRID_RES - 1)
+                self.activeGridField[gridcell_x, gridcell_y] = 1
+            self.settledPosField[i] = self.posField[i]
+
+        # Cells next to an active gridcell are woken so contacts across the boundary are resolved
+        for gx, gy in self.awakeGridField:
+            awake = 0
+            for offset in ti.static(ti.grouped(ti.ndrange((-1, 2), (-1, 2)))):
+                cx = self.wrap_gridcell(gx + offset[0])
+                cy = self.wrap_gridcell(gy + offset[1])
+                if 0 <= cx < self.env.GRID_RES and 0 <= cy < self.env.GRID_RES:
+                    awake |= self.activeGridField[cx, cy]
+            self.awakeGridField[gx, gy] = awake
 
     @ti.func
-    def collide(self, i, other, dist):
-        CellHandler.parent.collide(self, i, other, dist)
-        if self.env.INHIBITION_RADIUS*self.env.CELL_RADIUS > dist > self.env.EPSILON:
-            self.inhibitionField[i] += self.env.INHIBITION_FACTOR
-            if self.inhibitionField[i] > self.env.INHIBITION_THRESHOLD:
-                self.inhibitionField[i] = self.env.INHIBITION_THRESHOLD
-            self.neighborField[i] = 1
+    def summarize(self):
+        for k in ti.static(range(self.SUMMARY_COLUMNS.index("divisions"))):
+            self.summaryField[k] = 0
+        for i in range(self.count[None]):
+            self.summaryField[ti.cast(self.phaseField[i], ti.i32)] += 1
+            inhibition = self.inhibitionField[i]
+            self.summaryField[ti.static(self.SUMMARY_COLUMNS.index("inhibition_sum"))] += inhibition
+            self.summaryField[ti.static(self.SUMMARY_COLUMNS.index("inhibition_sq_sum"))] += inhibition * inhibition
+            speed = ti.cast(self.speedField[i], ti.f32) * self.env.MAX_CELL_SPEED[None] * self.env.DOMAIN_SIZE
+            self.summaryField[ti.static(self.SUMMARY_COLUMNS.index("speed_sum"))] += speed
+            self.summaryField[ti.static(self.SUMMARY_COLUMNS.index("speed_sq_sum"))] += speed * speed
+            if ti.static(self.env.GENE_EXPRESSION):
+                for k in ti.static(range(len(self.GENES))):
+                    self.summaryField[ti.static(self.SUMMARY_COLUMNS.index("gene0_sum")) + k] += ti.cast(self.geneField[i][k], ti.f32)
+
+        self.summaryField[ti.static(self.SUMMARY_COLUMNS.index("divisions"))] = self.divisionCount[None]
+        self.summaryField[ti.static(self.SUMMARY_COLUMNS.index("deletions"))] = self.deletionCount[None]
+        self.divisionCount[None] = 0
+        self.deletionCount[None] = 0
+
+    @ti.func
+    def profile_edge(self):
+        for a in self.edgeRadiusField:
+            self.edgeRadiusField[a] = ti.math.inf
+        for r in self.radialCountField:
+            self.radialCountField[r] = 0
+
+        center = ti.Vector(self.env.WOUND_CENTER)
+        for i in range(self.count[None]):
+            d = self.displacement(self.posField[i], center)
+            radius = d.norm()
+            angle = ti.atan2(d[1], d[0]) % (2 * np.pi)
+            a = ti.min(int(angle / (2 * np.pi) * self.env.EDGE_ANGLE_BINS), self.env.EDGE_ANGLE_BINS - 1)
+            ti.atomic_min(self.edgeRadiusField[a], radius)
+
+            r = int(radius * self.env.DOMAIN_SIZE / self.env.WOUND_WIDTH * self.env.EDGE_RADIUS_BINS)
+            if r < self.env.EDGE_RADIUS_BINS:
+                ti.atomic_add(self.radialCountField[r], 1)
+
+    @ti.func
+    def wake_all(self):
+        if ti.static(self.env.SLEEPING_CELLS):
+            for gx, gy in self.awakeGridField:
+                self.awakeGridField[gx, gy] = 1
+
+    @ti.func
+    def clear_fields(self):
+        CellHandler.parent.clear_fields(self)
+        self.wake_all()
+
+    @ti.func
+    def copy_back_buffer(self):
+        # Deleted cells leave neighbors without contacts, so let everyone re-check their inhibition
+        CellHandler.parent.copy_back_buffer(self)
+        self.wake_all()
+
+    @ti.func
+    def handle_sleeping(self, i: ti.i32):
+        pass
+
+    @ti.func
+    def handleCellDependentBehavior(self, i: ti.i32):
+        self.handle_cell_cycle(i)
 
     @ti.func
     def handle_cell_cycle(self, i: ti.i32):
         # Use per-cell cycle duration
-        cycle_length = self.cycleDurField[i]
+        cycle_length = ti.cast(self.cycleDurField[i], ti.i32)
         g1_end = max(1, int(0.4 * cycle_length))
         s_end = max(g1_end + 1, g1_end + max(1, int(0.33 * cycle_length)))
         g2_end = max(s_end + 1, s_end + max(1, int(0.17 * cycle_length)))
@@ -101,69 +318,139 @@ class CellHandler(MovingParticleHandler):
         early_g1_end = max(2, g1_end // 20)
 
         # Phase Switching
-        cycleTime = self.env.step[None] - self.lastDivField[i]
-        prev_phase = self.phaseField[i]
+        cycleTime = self.stamp_age(self.lastDivField, i)
+        prev_phase = ti.cast(self.phaseField[i], ti.i32)
+        phase = prev_phase
+        program_done = False
+        if ti.static(self.env.GENE_EXPRESSION):
+            durations = ti.Vector([g1_end, s_end - g1_end, g2_end - s_end, cycle_length - g2_end])
+            program_done = self.express_genes(i, prev_phase, ti.max(durations, 1))
         if prev_phase == 0:  # If in G0, stay in G0 until contact inhibition is relieved
-            if self.inhibitionField[i] < self.env.INHIBITION_EXIT_THRESHOLD:
+            if self.inhibitionField[i] < self.env.INHIBITION_EXIT_THRESHOLD[None]:
                 # Leaving G0, reset cycle and enter G1
-                self.phaseField[i] = 1
-                self.lastDivField[i] = self.env.step[None]
+                phase = 1
+                self.lastDivField[i] = self.step_stamp()
                 cycleTime = 0
             else:
-                self.phaseField[i] = 0  # Stay in G0
+                phase = 0  # Stay in G0
         else:
             # Only allow entry to G0 during early G1
-            if cycleTime < early_g1_end and self.inhibitionField[i] >= self.env.INHIBITION_THRESHOLD:
-                self.phaseField[i] = 0  # Enter G0
+            if cycleTime < early_g1_end and self.inhibitionField[i] >= self.env.INHIBITION_THRESHOLD[None]:
+                phase = 0  # Enter G0
+            elif ti.static(self.env.GENE_DRIVEN_CYCLE):
+                if program_done and prev_phase < 4:
+                    phase = prev_phase + 1
             elif cycleTime < g1_end:
-                self.phaseField[i] = 1  # G1
+                phase = 1  # G1
             elif cycleTime < s_end:
-                self.phaseField[i] = 2  # S
+                phase = 2  # S
             elif cycleTime < g2_end:
-                self.phaseField[i] = 3  # G2
+                phase = 3  # G2
             else:
-                self.phaseField[i] = 4  # M
+                phase = 4  # M
+        self.phaseField[i] = self.env.FLAG_DTYPE(phase)
 
         # Cell Movement
-        if self.phaseField[i] == 3 or self.phaseField[i] == 0:
-            self.mvmtField[i][2] -= self.env.MAX_CELL_SPEED/40
-            if self.mvmtField[i][2] < 0:
-                self.mvmtField[i][2] = 0
+        speed = ti.cast(self.speedField[i], ti.f32)
+        if phase == 3 or phase == 0:
+            speed -= 1/40
+            if speed < 0:
+                speed = 0
 
-        if self.phaseField[i] == 1:
-            self.mvmtField[i][2] += self.env.MAX_CELL_SPEED/10
-            if self.mvmtField[i][2] > self.env.MAX_CELL_SPEED:
-                self.mvmtField[i][2] = self.env.MAX_CELL_SPEED
+        if phase == 1:
+            speed += 1/10
+            if speed > 1:
+                speed = 1
+        self.speedField[i] = self.env.FRACTION_DTYPE(speed)
 
         # Cell Division
-        if self.phaseField[i] == 4 and cycleTime >= cycle_length:
-            offset_range = self.env.REPRODUCTION_OFFSET * self.env.CELL_RADIUS
+        divide = phase == 4 and cycleTime >= cycle_length
+        if ti.static(self.env.GENE_DRIVEN_CYCLE):
+            divide = phase == 4 and prev_phase == 4 and program_done
+        if divide:
+            offset_range = self.env.REPRODUCTION_OFFSET[None] * self.env.CELL_RADIUS
             offset = ti.Vector([
                 ti.random() * offset_range - offset_range * 0.5,
                 ti.random() * offset_range - offset_range * 0.5])
-            new_pos = self.posField[i] + offset
-            self.create(new_pos[0], new_pos[1])
-            self.lastDivField[i] = self.env.step[None]
+            new_pos = self.wrap_position(self.posField[i] + offset)
+            if 0 < new_pos[0] < 1 and 0 < new_pos[1] < 1:
+                self.daughterPosField[i] = new_pos
+                self.scanField[i] = 1
+            self.lastDivField[i] = self.step_stamp()
+            if ti.static(self.env.GENE_DRIVEN_CYCLE):
+                self.phaseField[i] = self.env.FLAG_DTYPE(1)
+
+    @ti.func
+    def gene_rates(self, x, program: ti.i32, rate: ti.f32):
+        # Genes of the running program rise towards full expression, the others decay
+        dx = ti.Vector.zero(ti.f32, ti.static(len(self.GENES)))
+        for k in ti.static(range(len(self.GENES))):
+            if program == self.GENE_PHASES[k]:
+                dx[k] = rate * (1 - x[k])
+            else:
+                dx[k] = -self.env.GENE_DECAY[None] * x[k]
+        return dx
+
+    @ti.func
+    def express_genes(self, i: ti.i32, program: ti.i32, durations):
+        # Midpoint rule over GENE_SUBSTEPS steps. Program genes reach GENE_THRESHOLD from zero in the
+        # phase's duration, so a gene driven cycle keeps the timing of the step counter on average.
+        # Returns whether the running program's genes are all at the threshold
+        threshold = self.env.GENE_THRESHOLD[None]
+        duration = 1
+        for k in ti.static(range(4)):
+            if program == k + 1:
+                duration = durations[k]
+        rate = ti.log(1 / (1 - threshold)) / duration
+        dt = 1 / ti.static(self.env.GENE_SUBSTEPS)
+        x = ti.cast(self.geneField[i], ti.f32)
+        for _ in ti.static(range(self.env.GENE_SUBSTEPS)):
+            mid = x + 0.5 * dt * self.gene_rates(x, program, rate)
+            x += dt * self.gene_rates(mid, program, rate)
+        self.geneField[i] = ti.cast(x, self.env.FRACTION_DTYPE)
+
+        done = program > 0
+        for k in ti.static(range(len(self.GENES))):
+            if program == self.GENE_PHASES[k] and x[k] < threshold - 1e-3:  # Rounding would add a step to every phase
+                done = False
+        return done
 
     @ti.func
     def clear_field_index(self, index):
         CellHandler.parent.clear_field_index(self, index)
-        self.lastDivField[index] = -1
+        self.lastDivField[index] = self.env.STEP_DTYPE(-1)
         self.inhibitionField[index] = -1
-        self.neighborField[index] = -1
-        self.phaseField[index] = -1
-        self.mvmtField[index] = [-1, -1, -1]
-        self.cycleDurField[index] = -1
+        self.neighborField[index] = self.env.FLAG_DTYPE(-1)
+        self.phaseField[index] = self.env.FLAG_DTYPE(-1)
+        self.headingField[index] = -1
+        self.turnField[index] = self.env.FLAG_DTYPE(-1)
+        self.speedField[index] = -1
+        self.cycleDurField[index] = self.env.SHORT_DTYPE(-1)
+        self.idField[index] = -1
+        self.parentIdField[index] = -1
+        self.birthStepField[index] = -1
+        if ti.static(self.env.GENE_EXPRESSION):
+            self.geneField[index] = ti.Vector([-1] * ti.static(len(self.GENES)), self.env.FRACTION_DTYPE)
+        if ti.static(self.env.SLEEPING_CELLS):
+            self.settledPosField[index] = self.posField[index]
 
     @ti.func
     def initialize(self, idx: ti.i32, pos: ti.template()):
         CellHandler.parent.initialize(self, idx, pos)
-        self.lastDivField[idx] = self.env.step[None]
+        self.lastDivField[idx] = self.step_stamp()
         self.inhibitionField[idx] = 0
-        self.neighborField[idx] = 0
-        self.phaseField[idx] = 1
-        self.mvmtField[idx] = [ti.random(), 0, self.env.MAX_CELL_SPEED]
-        self.cycleDurField[idx] = self.env.CELL_CYCLE_DURATION[None] + int((ti.random() - 0.5) * 10)
+        self.neighborField[idx] = self.env.FLAG_DTYPE(0)
+        self.phaseField[idx] = self.env.FLAG_DTYPE(1)
+        self.headingField[idx] = ti.random()
+        self.turnField[idx] = self.env.FLAG_DTYPE(0)
+        self.speedField[idx] = 1
+        self.cycleDurField[idx] = self.env.SHORT_DTYPE(self.env.CELL_CYCLE_DURATION[None] + int((ti.random() - 0.5) * 2 * self.env.CELL_CYCLE_JITTER))
+        self.parentIdField[idx] = -1
+        self.birthStepField[idx] = self.env.step[None]
+        if ti.static(self.env.GENE_EXPRESSION):
+            self.geneField[idx] = ti.Vector.zero(self.env.FRACTION_DTYPE, ti.static(len(self.GENES)))
+        if ti.static(self.env.SLEEPING_CELLS):
+            self.settledPosField[idx] = pos
 
     @ti.func
     def write_buffer_index(self, buffer_i, i):
@@ -172,8 +459,17 @@ class CellHandler(MovingParticleHandler):
         self.inhibitionFieldBuffer[buffer_i] = self.inhibitionField[i]
         self.neighborFieldBuffer[buffer_i] = self.neighborField[i]
         self.phaseFieldBuffer[buffer_i] = self.phaseField[i]
-        self.mvmtFieldBuffer[buffer_i] = self.mvmtField[i]
+        self.headingFieldBuffer[buffer_i] = self.headingField[i]
+        self.turnFieldBuffer[buffer_i] = self.turnField[i]
+        self.speedFieldBuffer[buffer_i] = self.speedField[i]
         self.cycleDurFieldBuffer[buffer_i] = self.cycleDurField[i]
+        self.idFieldBuffer[buffer_i] = self.idField[i]
+        self.parentIdFieldBuffer[buffer_i] = self.parentIdField[i]
+        self.birthStepFieldBuffer[buffer_i] = self.birthStepField[i]
+        if ti.static(self.env.GENE_EXPRESSION):
+            self.geneFieldBuffer[buffer_i] = self.geneField[i]
+        if ti.static(self.env.SLEEPING_CELLS):
+            self.settledPosFieldBuffer[buffer_i] = self.settledPosField[i]
 
     @ti.func
     def copy_back_buffer_index(self, i):
@@ -182,8 +478,17 @@ class CellHandler(MovingParticleHandler):
         self.inhibitionField[i] = self.inhibitionFieldBuffer[i]
         self.neighborField[i] = self.neighborFieldBuffer[i]
         self.phaseField[i] = self.phaseFieldBuffer[i]
-        self.mvmtField[i] = self.mvmtFieldBuffer[i]
+        self.headingField[i] = self.headingFieldBuffer[i]
+        self.turnField[i] = self.turnFieldBuffer[i]
+        self.speedField[i] = self.speedFieldBuffer[i]
         self.cycleDurField[i] = self.cycleDurFieldBuffer[i]
+        self.idField[i] = self.idFieldBuffer[i]
+        self.parentIdField[i] = self.parentIdFieldBuffer[i]
+        self.birthStepField[i] = self.birthStepFieldBuffer[i]
+        if ti.static(self.env.GENE_EXPRESSION):
+            self.geneField[i] = self.geneFieldBuffer[i]
+        if ti.static(self.env.SLEEPING_CELLS):
+            self.settledPosField[i] = self.settledPosFieldBuffer[i]
 
     def export_state(self):
         return CellHandler.parent.export_state(self) | {
@@ -191,30 +496,89 @@ class CellHandler(MovingParticleHandler):
             "inhibitionField": self.inhibitionField.to_numpy(),
             "neighborField": self.neighborField.to_numpy(),
             "phaseField": self.phaseField.to_numpy(),
-            "mvmtField": self.mvmtField.to_numpy(),
+            "headingField": self.headingField.to_numpy(),
+            "turnField": self.turnField.to_numpy(),
+            "speedField": self.speedField.to_numpy(),
             "cycleDurField": self.cycleDurField.to_numpy(),
+            "idField": self.idField.to_numpy(),
+            "parentIdField": self.parentIdField.to_numpy(),
+            "birthStepField": self.birthStepField.to_numpy(),
+            "nextId": self.nextId.to_numpy(),
 
             "lastDivFieldBuffer": self.lastDivFieldBuffer.to_numpy(),
             "inhibitionFieldBuffer": self.inhibitionFieldBuffer.to_numpy(),
             "neighborFieldBuffer": self.neighborFieldBuffer.to_numpy(),
             "phaseFieldBuffer": self.phaseFieldBuffer.to_numpy(),
-            "mvmtFieldBuffer": self.mvmtFieldBuffer.to_numpy(),
+            "headingFieldBuffer": self.headingFieldBuffer.to_numpy(),
+            "turnFieldBuffer": self.turnFieldBuffer.to_numpy(),
+            "speedFieldBuffer": self.speedFieldBuffer.to_numpy(),
             "cycleDurFieldBuffer": self.cycleDurFieldBuffer.to_numpy(),
-        }
+            "idFieldBuffer": self.idFieldBuffer.to_numpy(),
+            "parentIdFieldBuffer": self.parentIdFieldBuffer.to_numpy(),
+            "birthStepFieldBuffer": self.birthStepFieldBuffer.to_numpy(),
+        } | ({
+            "geneField": self.geneField.to_numpy(),
+            "geneFieldBuffer": self.geneFieldBuffer.to_numpy(),
+        } if self.env.GENE_EXPRESSION else {}) | ({
+            "settledPosField": self.settledPosField.to_numpy(),
+            "settledPosFieldBuffer": self.settledPosFieldBuffer.to_numpy(),
+        } if self.env.SLEEPING_CELLS else {})
 
     def load_state(self, data):
         CellHandler.parent.load_state(self, data)
 
-        self.lastDivField.from_numpy(data["lastDivField"])
-        self.inhibitionField.from_numpy(data["inhibitionField"])
-        self.neighborField.from_numpy(data["neighborField"])
-        self.phaseField.from_numpy(data["phaseField"])
-        self.mvmtField.from_numpy(data["mvmtField"])
-        self.cycleDurField.from_numpy(data["cycleDurField"])
-
-        self.lastDivFieldBuffer.from_numpy(data["lastDivFieldBuffer"])
-        self.inhibitionFieldBuffer.from_numpy(data["inhibitionFieldBuffer"])
-        self.neighborFieldBuffer.from_numpy(data["neighborFieldBuffer"])
-        self.phaseFieldBuffer.from_numpy(data["phaseFieldBuffer"])
-        self.mvmtFieldBuffer.from_numpy(data["mvmtFieldBuffer"])
-        self.cycleDurFieldBuffer.from_numpy(data["cycleDurFieldBuffer"])
+        if "mvmtField" in data:  # Older saves pack heading, turning state and absolute speed together
+            data = dict(data)
+            for tag in ["", "Buffer"]:
+                mvmt = data["mvmtField" + tag]
+                data["headingField" + tag] = mvmt[:, 0]
+                data["turnField" + tag] = mvmt[:, 1]
+                data["speedField" + tag] = np.where(mvmt[:, 2] < 0, -1, mvmt[:, 2]/self.env.MAX_CELL_SPEED[None])
+
+        if "idField" not in data:  # Older saves have no lineage, so number their cells in storage order
+            data = dict(data)
+            count = int(data["count"])
+            for tag in ["", "Buffer"]:
+                rows = len(data["posField" + tag])
+                data["idField" + tag] = np.where(np.arange(rows) < count, np.arange(rows), -1)
+                data["parentIdField" + tag] = np.full(rows, -1)
+                data["birthStepField" + tag] = np.where(np.arange(rows) < count, 0, -1)
+            data["nextId"] = np.array(count)
+
+        self.load_field(self.lastDivField, data["lastDivField"])
+        self.load_field(self.inhibitionField, data["inhibitionField"])
+        self.load_field(self.neighborField, data["neighborField"])
+        self.load_field(self.phaseField, data["phaseField"])
+        self.load_field(self.headingField, data["headingField"])
+        self.load_field(self.turnField, data["turnField"])
+        self.load_field(self.speedField, data["speedField"])
+        self.load_field(self.cycleDurField, data["cycleDurField"])
+        self.load_field(self.idField, data["idField"])
+        self.load_field(self.parentIdField, data["parentIdField"])
+        self.load_field(self.birthStepField, data["birthStepField"])
+        self.nextId[None] = int(data["nextId"])
+        if self.env.GENE_EXPRESSION:
+            if "geneField" not in data:  # Saves made without gene expression start every cell with none
+                for tag in ["", "Buffer"]:
+                    rows = len(data["posField" + tag])
+                    genes = np.where(np.arange(rows)[:, None] < int(data["count"]), 0.0, -1.0)
+                    self.load_field(getattr(self, "geneField" + tag), np.repeat(genes, len(self.GENES), axis=1))
+            else:
+                self.load_field(self.geneField, data["geneField"])
+                self.load_field(self.geneFieldBuffer, data["geneFieldBuffer"])
+        if self.env.SLEEPING_CELLS:
+            tag = "settledPosField" if "settledPosField" in data else "posField"  # Other saves start with every cell settled
+            self.load_field(self.settledPosField, data[tag])
+            self.load_field(self.settledPosFieldBuffer, data[tag + "Buffer"])
+
+        self.load_field(self.lastDivFieldBuffer, data["lastDivFieldBuffer"])
+        self.load_field(self.inhibitionFieldBuffer, data["inhibitionFieldBuffer"])
+        self.load_field(self.neighborFieldBuffer, data["neighborFieldBuffer"])
+        self.load_field(self.phaseFieldBuffer, data["phaseFieldBuffer"])
+        self.load_field(self.headingFieldBuffer, data["headingFieldBuffer"])
+        self.load_field(self.turnFieldBuffer, data["turnFieldBuffer"])
+        self.load_field(self.speedFieldBuffer, data["speedFieldBuffer"])
+        self.load_field(self.cycleDurFieldBuffer, data["cycleDurFieldBuffer"])
+        self.load_field(self.idFieldBuffer, data["idFieldBuffer"])
+        self.load_field(self.parentIdFieldBuffer, data["parentIdFieldBuffer"])
+        self.load_field(self.birthStepFieldBuffer, data["birthStepFieldBuffer"])
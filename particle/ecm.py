@@ -1,4 +1,5 @@
 import taichi as ti
+import numpy as np
 
 from particle.particle import ParticleHandler
 
@@ -8,45 +9,130 @@ class ECMHandler(ParticleHandler):
     parent = ParticleHandler
 
     def __init__(self, env):
-        super().__init__(env, env.MAX_ECM_COUNT)
+        super().__init__(env, env.MAX_ECM_COUNT, env.INITIAL_ECM_CAPACITY)
 
-        self.ecmConnectPosField = ti.Vector.field(2, dtype=ti.f32, shape=self.MAX_COUNT)
+        self.freeCount = ti.field(dtype=ti.i32, shape=())  # Height of the free slot stack
 
-        self.ecmConnectPosFieldBuffer = ti.Vector.field(2, dtype=ti.f32, shape=self.MAX_COUNT)
+    def allocate_fields(self):
+        ECMHandler.parent.allocate_fields(self)
+
+        self.ecmConnectPosField = self.particle_field(ti.f32, 2)
+        self.depositStepField = self.particle_field(self.env.STEP_DTYPE)
+        self.freeField = self.particle_field(ti.i32)  # Stack of retired rows below count, reused by the next deposits
+
+        self.ecmConnectPosFieldBuffer = self.particle_field(ti.f32, 2)
+        self.depositStepFieldBuffer = self.particle_field(self.env.STEP_DTYPE)
+
+    def live_count(self):
+        return self.count[None] - self.freeCount[None]
+
+    @ti.func
+    def is_live(self, i):
+        return self.posField[i][0] >= 0
 
     @ti.func
     def update(self):
         ECMHandler.parent.update(self)
 
+        # Turnover: retire ECM older than the lifetime and push its row onto the free stack
+        n = self.count[None]
+        lifetime = self.env.ECM_LIFETIME[None]
+        for i in range(n):
+            self.scanField[i] = 0
+            if lifetime >= 0 and self.is_live(i) and self.stamp_age(self.depositStepField, i) >= lifetime:
+                self.scanField[i] = 1
+        self.prefix_sum(self.scanField, n)
+        free = self.freeCount[None]
+        for i in range(n):
+            slot = self.spawn_slot(self.scanField, i)
+            if slot >= 0:
+                self.clear_field_index(i)
+                self.freeField[free + slot] = i
+        self.freeCount[None] = free + self.scanTotal[None]
+
+    @ti.func
+    def deposit_slots(self, n: ti.i32):
+        # Rows available to deposits after the first n, freed ones included
+        return self.freeCount[None] + self.spawn_slots(n)
+
+    @ti.func
+    def deposit_index(self, slot: ti.i32, n: ti.i32, free: ti.i32):
+        # The first deposits pop the free stack, the rest are appended after row n
+        idx = n + slot - free
+        if slot < free:
+            idx = self.freeField[free - 1 - slot]
+        return idx
+
+    @ti.func
+    def finish_deposits(self, deposits: ti.i32, n: ti.i32, free: ti.i32):
+        reused = ti.min(deposits, free)
+        self.freeCount[None] = free - reused
+        self.count[None] = n + deposits - reused
+
+    @ti.func
+    def write_buffer(self):
+        # Compaction also closes the free slots
+        for i in range(self.count[None]):
+            if not self.is_live(i):
+                self.toDelete[i] = 1
+        ECMHandler.parent.write_buffer(self)
+        self.freeCount[None] = 0
+
+    @ti.func
+    def clear_fields(self):
+        ECMHandler.parent.clear_fields(self)
+        self.freeCount[None] = 0
+
     @ti.func
     def clear_field_index(self, index):
         ECMHandler.parent.clear_field_index(self, index)
         self.ecmConnectPosField[index] = [-1, -1]
+        self.depositStepField[index] = self.env.STEP_DTYPE(-1)
 
     @ti.func
     def initialize(self, idx: ti.i32, pos: ti.template()):
         ECMHandler.parent.initialize(self, idx, pos)
         self.ecmConnectPosField[idx] = self.posField[idx]
+        self.depositStepField[idx] = self.step_stamp()
 
     @ti.func
     def write_buffer_index(self, buffer_i, i):
         ECMHandler.parent.write_buffer_index(self, buffer_i, i)
         self.ecmConnectPosFieldBuffer[buffer_i] = self.ecmConnectPosField[i]
+        self.depositStepFieldBuffer[buffer_i] = self.depositStepField[i]
 
     @ti.func
     def copy_back_buffer_index(self, i):
         ECMHandler.parent.copy_back_buffer_index(self, i)
         self.ecmConnectPosField[i] = self.ecmConnectPosFieldBuffer[i]
+        self.depositStepField[i] = self.depositStepFieldBuffer[i]
 
     def export_state(self):
         return ECMHandler.parent.export_state(self) | {
             "ecmConnectPosField": self.ecmConnectPosField.to_numpy(),
+            "depositStepField": self.depositStepField.to_numpy(),
 
-            "ecmConnectPosFieldBuffer": self.ecmConnectPosFieldBuffer.to_numpy()
+            "ecmConnectPosFieldBuffer": self.ecmConnectPosFieldBuffer.to_numpy(),
+            "depositStepFieldBuffer": self.depositStepFieldBuffer.to_numpy()
         }
 
     def load_state(self, data):
         ECMHandler.parent.load_state(self, data)
-        self.ecmConnectPosField.from_numpy(data["ecmConnectPosField"])
 
-        self.ecmConnectPosFieldBuffer.from_numpy(data["ecmConnectPosFieldBuffer"])
\ No newline at end of file
+        if "depositStepField" not in data:  # Older saves have no deposit steps, so their ECM ages from step 0
+            data = dict(data)
+            count = int(data["count"])
+            for tag in ["", "Buffer"]:
+                rows = len(data["posField" + tag])
+                data["depositStepField" + tag] = np.where(np.arange(rows) < count, 0, -1)
+
+        self.load_field(self.ecmConnectPosField, data["ecmConnectPosField"])
+        self.load_field(self.depositStepField, data["depositStepField"])
+
+        self.load_field(self.ecmConnectPosFieldBuffer, data["ecmConnectPosFieldBuffer"])
+        self.load_field(self.depositStepFieldBuffer, data["depositStepFieldBuffer"])
+
+        # The free stack is not saved, the retired rows are found again by their cleared positions
+        free = np.nonzero(self.posField.to_numpy()[:self.count[None], 0] < 0)[0]
+        self.load_field(self.freeField, free)
+        self.freeCount[None] = len(free)
@@ -6,22 +6,37 @@ from particle.cell import CellHandler
 class FibroblastHandler(CellHandler):
     parent = CellHandler
 
+    SUMMARY_COLUMNS = CellHandler.SUMMARY_COLUMNS + ["ecm_deposits"]
+
     def __init__(self, env):
-        super().__init__(env, env.MAX_CELL_COUNT)
+        super().__init__(env, env.MAX_CELL_COUNT, env.INITIAL_CELL_CAPACITY)
+
+        self.depositCount = ti.field(dtype=ti.i32, shape=())  # ECM deposits since the last summary
+
+    def allocate_fields(self):
+        FibroblastHandler.parent.allocate_fields(self)
 
-        self.lastECMPosField = ti.Vector.field(2, dtype=ti.f32, shape=self.MAX_COUNT)
-        self.lastECMField = ti.field(dtype=ti.i32, shape=self.MAX_COUNT)
-        self.ecmPeriodField = ti.field(dtype=ti.f32, shape=self.MAX_COUNT)
+        self.lastECMPosField = self.particle_field(ti.f32, 2)
+        self.lastECMField = self.particle_field(self.env.STEP_DTYPE)
+        self.ecmPeriodField = self.particle_field(ti.f32)
+        self.depositField = self.particle_field(ti.i32)  # Scanned ECM deposit flags for this step
 
-        self.lastECMPosFieldBuffer = ti.Vector.field(2, dtype=ti.f32, shape=self.MAX_COUNT)
-        self.lastECMFieldBuffer = ti.field(dtype=ti.i32, shape=self.MAX_COUNT)
-        self.ecmPeriodFieldBuffer = ti.field(dtype=ti.f32, shape=self.MAX_COUNT)
+        self.lastECMPosFieldBuffer = self.particle_field(ti.f32, 2)
+        self.lastECMFieldBuffer = self.particle_field(self.env.STEP_DTYPE)
+        self.ecmPeriodFieldBuffer = self.particle_field(ti.f32)
 
     @ti.func
     def handleCellDependentBehavior(self, i: ti.i32):
         FibroblastHandler.parent.handleCellDependentBehavior(self, i)
         self.handle_ecm(i)
 
+    @ti.func
+    def handle_sleeping(self, i: ti.i32):
+        FibroblastHandler.parent.handle_sleeping(self, i)
+        self.depositField[i] = 0  # Saturated cells skip handle_ecm, which would clear last step's flag
+        if self.ecmPeriodField[i] < 99999999:  # Keep depositing until the surrounding ECM saturates
+            self.handle_ecm(i)
+
     @ti.func
     def handle_ecm(self, i: ti.i32):
         # ECM PERIOD CALCULATIONS
@@ -30,43 +45,68 @@ class FibroblastHandler(CellHandler):
         gridcell_x = ti.min(ti.max(int(pos_i[0] * self.env.GRID_RES), 0), self.env.GRID_RES - 1)
         gridcell_y = ti.min(ti.max(int(pos_i[1] * self.env.GRID_RES), 0), self.env.GRID_RES - 1)
         for offset in ti.static(ti.grouped(ti.ndrange((-1, 2), (-1, 2)))):
-            cx = gridcell_x + offset[0]
-            cy = gridcell_y + offset[1]
+            cx = self.wrap_gridcell(gridcell_x + offset[0])
+            cy = self.wrap_gridcell(gridcell_y + offset[1])
             if 0 <= cx < self.env.GRID_RES and 0 <= cy < self.env.GRID_RES:
                 count = self.env.ecmHandler.gridCount[cx, cy]
                 for j in range(count):
                     ecm_idx = self.env.ecmHandler.grid[cx, cy, j]
-                    dx = pos_i - self.env.ecmHandler.posField[ecm_idx]
+                    dx = self.displacement(pos_i, self.env.ecmHandler.posField[ecm_idx])
                     dist = dx.norm()
-                    if dist < self.env.ECM_DETECTION_RADIUS:
+                    if dist < self.env.ECM_DETECTION_RADIUS[None]:
                         ecm_nearby_count += 1
-        self.ecmPeriodField[i] = self.env.MIN_ECM_PERIOD+ecm_nearby_count
-        if ecm_nearby_count > self.env.ECM_THRESHOLD:
+        self.ecmPeriodField[i] = self.env.MIN_ECM_PERIOD[None]+ecm_nearby_count
+        if ecm_nearby_count > self.env.ECM_THRESHOLD[None]:
             self.ecmPeriodField[i] = 99999999
 
-        # ECM Deposition
-        ecmTime = self.env.step[None] - self.lastECMField[i]
+        # ECM Deposition (placed in spawn once every deposit this step has a slot)
+        self.depositField[i] = 0
+        ecmTime = self.stamp_age(self.lastECMField, i)
         if ecmTime >= self.ecmPeriodField[i]:
-            new_ecm_idx = self.env.ecmHandler.create(self.posField[i][0], self.posField[i][1])
-            if self.lastECMPosField[i][0] != -1:
-                self.env.ecmHandler.ecmConnectPosField[new_ecm_idx] = self.lastECMPosField[i]
-            # self.env.ecmHandler.calculateConnectPos(new_ecm_idx, self.lastECMPosField[i])
-            if new_ecm_idx != -1:
-                self.lastECMField[i] = self.env.step[None]
+            deposit_pos = self.wrap_position(self.posField[i])
+            if 0 < deposit_pos[0] < 1 and 0 < deposit_pos[1] < 1:
+                self.depositField[i] = 1
+
+    @ti.func
+    def spawn(self, n: ti.i32):
+        FibroblastHandler.parent.spawn(self, n)
+
+        ecm = self.env.ecmHandler
+        self.prefix_sum(self.depositField, n)
+        ecm_n = ecm.count[None]
+        ecm_free = ecm.freeCount[None]
+        deposits = ti.min(self.scanTotal[None], ecm.deposit_slots(ecm_n))
+        for i in range(n):
+            slot = self.spawn_slot(self.depositField, i)
+            if 0 <= slot < deposits:
+                new_ecm_idx = ecm.deposit_index(slot, ecm_n, ecm_free)
+                ecm.initialize(new_ecm_idx, self.wrap_position(self.posField[i]))
+                if self.lastECMPosField[i][0] != -1:
+                    ecm.ecmConnectPosField[new_ecm_idx] = self.lastECMPosField[i]
+                # self.env.ecmHandler.calculateConnectPos(new_ecm_idx, self.lastECMPosField[i])
+                self.lastECMField[i] = self.step_stamp()
                 self.lastECMPosField[i] = self.posField[i]
+        ecm.finish_deposits(deposits, ecm_n, ecm_free)
+        self.depositCount[None] += deposits
+
+    @ti.func
+    def summarize(self):
+        FibroblastHandler.parent.summarize(self)
+        self.summaryField[ti.static(self.SUMMARY_COLUMNS.index("ecm_deposits"))] = self.depositCount[None]
+        self.depositCount[None] = 0
 
     @ti.func
     def clear_field_index(self, index):
         FibroblastHandler.parent.clear_field_index(self, index)
         self.lastECMPosField[index] = [-1, -1]
-        self.lastECMField[index] = -1
+        self.lastECMField[index] = self.env.STEP_DTYPE(-1)
         self.ecmPeriodField[index] = -1
 
     @ti.func
     def initialize(self, idx: ti.i32, pos: ti.template()):
         FibroblastHandler.parent.initialize(self, idx, pos)
         self.lastECMPosField[idx] = [-1, -1]
-        self.lastECMField[idx] = self.env.step[None]
+        self.lastECMField[idx] = self.step_stamp()
         self.ecmPeriodField[idx] = 0
 
     @ti.func
@@ -97,10 +137,10 @@ class FibroblastHandler(CellHandler):
     def load_state(self, data):
         FibroblastHandler.parent.load_state(self, data)
 
-        self.lastECMPosField.from_numpy(data["lastECMPosField"])
-        self.lastECMField.from_numpy(data["lastECMField"])
-        self.ecmPeriodField.from_numpy(data["ecmPeriodField"])
+        self.load_field(self.lastECMPosField, data["lastECMPosField"])
+        self.load_field(self.lastECMField, data["lastECMField"])
+        self.load_field(self.ecmPeriodField, data["ecmPeriodField"])
 
-        self.lastECMPosFieldBuffer.from_numpy(data["lastECMPosFieldBuffer"])
-        self.lastECMFieldBuffer.from_numpy(data["lastECMFieldBuffer"])
-        self.ecmPeriodFieldBuffer.from_numpy(data["ecmPeriodFieldBuffer"])
\ No newline at end of file
+        self.load_field(self.lastECMPosFieldBuffer, data["lastECMPosFieldBuffer"])
+        self.load_field(self.lastECMFieldBuffer, data["lastECMFieldBuffer"])
+        self.load_field(self.ecmPeriodFieldBuffer, data["ecmPeriodFieldBuffer"])
\ No newline at end of file
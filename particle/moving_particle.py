@@ -7,26 +7,44 @@ from particle.particle import ParticleHandler
 class MovingParticleHandler(ParticleHandler):
     parent = ParticleHandler
 
-    def __init__(self, env, maxCount):
-        super().__init__(env, maxCount)
+    def allocate_fields(self):
+        MovingParticleHandler.parent.allocate_fields(self)
 
-        self.prevPosField = ti.Vector.field(2, dtype=ti.f32, shape=self.MAX_COUNT) # Previous Pos
+        self.prevPosField = self.particle_field(ti.f32, 2) # Previous Pos
 
-        self.prevPosFieldBuffer = ti.Vector.field(2, dtype=ti.f32, shape=self.MAX_COUNT)
+        self.prevPosFieldBuffer = self.particle_field(ti.f32, 2)
+
+    def __init__(self, env, maxCount, initialCount):
+        super().__init__(env, maxCount, initialCount)
+
+        # Collision Overlap (fraction of a cell diameter), reduced on device in handle_collisions for adaptive substeps
+        self.overlapSum = ti.field(dtype=ti.f32, shape=())
+        self.overlapPairs = ti.field(dtype=ti.i32, shape=())
+        self.substepCount = ti.field(dtype=ti.i32, shape=())  # Substeps run this step
+        self.relaxed = ti.field(dtype=ti.i32, shape=())  # Set once the overlap is under the tolerance. The host reads it every few substeps
 
     @ti.func
     def verlet_step(self): # Verlet Calculations for Motion (velocity calc)
         for i in range(self.count[None]):
+            if self.is_relaxed() or not self.is_awake(i):
+                continue
             pos = self.posField[i]
             prev = self.prevPosField[i]
 
-            new_pos = pos + (pos - prev) * self.env.FRICTION
+            new_pos = pos + (pos - prev) * self.env.FRICTION[None]
             self.prevPosField[i] = pos
             self.posField[i] = new_pos
 
     @ti.func
     def border_constraints(self):
         for i in range(self.count[None]):
+            if self.is_relaxed() or not self.is_awake(i):
+                continue
+            if ti.static(self.env.PERIODIC):  # Wrap around, keeping the velocity
+                shift = self.wrap_position(self.posField[i]) - self.posField[i]
+                self.posField[i] += shift
+                self.prevPosField[i] += shift
+                continue
             for j in ti.static(range(2)):
                 if self.posField[i][j] < 0:
                     self.posField[i][j] = 0
@@ -40,31 +58,68 @@ class MovingParticleHandler(ParticleHandler):
 
     @ti.func
     def handle_collisions(self): # Collisions
+        if ti.static(self.env.ADAPTIVE_SUBSTEPS):
+            if not self.relaxed[None]:
+                self.overlapSum[None] = 0
+                self.overlapPairs[None] = 0
         for i in range(self.count[None]):
+            if self.is_relaxed() or not self.is_awake(i):
+                continue
+            overlap_sum = 0.0
+            pairs = 0
             pos_i = self.posField[i]
             gridcell_x = ti.min(ti.max(int(pos_i[0] * self.env.GRID_RES), 0), self.env.GRID_RES - 1)
             gridcell_y = ti.min(ti.max(int(pos_i[1] * self.env.GRID_RES), 0), self.env.GRID_RES - 1)
 
             for offset in ti.static(ti.grouped(ti.ndrange((-1, 2), (-1, 2)))):
-                cx = gridcell_x + offset[0]
-                cy = gridcell_y + offset[1]
+                cx = self.wrap_gridcell(gridcell_x + offset[0])
+                cy = self.wrap_gridcell(gridcell_y + offset[1])
                 if 0 <= cx < self.env.GRID_RES and 0 <= cy < self.env.GRID_RES:
                     count = self.gridCount[cx, cy]
                     for j in range(count):
                         other = self.grid[cx, cy, j]
                         if other != i:
-                            dx = self.posField[i] - self.posField[other]
+                            dx = self.displacement(self.posField[i], self.posField[other])
                             dist = dx.norm()
                             min_dist = 2 * self.env.CELL_RADIUS
                             if min_dist > dist > self.env.EPSILON:
-                                movementOffset = self.env.CELL_RADIUS * self.env.CELL_REPULSION * ((min_dist - dist) / min_dist) * dx.normalized()
+                                overlap = (min_dist - dist) / min_dist
+                                overlap_sum += overlap
+                                pairs += 1
+                                movementOffset = self.env.CELL_RADIUS * self.env.CELL_REPULSION[None] * overlap * dx.normalized()
                                 self.posField[i] += movementOffset
-                                self.posField[other] -= movementOffset
-                            self.collide(i, other, dist)
+                                if self.is_awake(other):
+                                    self.posField[other] -= movementOffset
+                                else:  # Sleeping cells hold still and skip the pair themselves, so i takes both pushes
+                                    self.posField[i] += movementOffset
+            if ti.static(self.env.ADAPTIVE_SUBSTEPS):  # One atomic per cell rather than per pair
+                self.overlapSum[None] += overlap_sum
+                self.overlapPairs[None] += pairs
+
+        # Adaptive mode stops once collisions have relaxed below the overlap tolerance
+        if ti.static(self.env.ADAPTIVE_SUBSTEPS):
+            if not self.relaxed[None]:
+                self.substepCount[None] += 1
+                mean_overlap = self.overlapSum[None] / ti.max(self.overlapPairs[None], 1)
+                if self.substepCount[None] >= self.env.MIN_SUBSTEPS and mean_overlap < self.env.OVERLAP_TOLERANCE:
+                    self.relaxed[None] = 1
+
+    @ti.func
+    def is_awake(self, i):
+        return True
 
     @ti.func
-    def collide(self, i, other, dist):
-        pass
+    def is_relaxed(self):
+        relaxed = False
+        if ti.static(self.env.ADAPTIVE_SUBSTEPS):
+            relaxed = self.relaxed[None] == 1
+        return relaxed
+
+    @ti.func
+    def update(self):
+        MovingParticleHandler.parent.update(self)
+        self.substepCount[None] = 0  # The next step's substeps start over
+        self.relaxed[None] = 0
 
     @ti.func
     def clear_field_index(self, index):
@@ -86,6 +141,9 @@ class MovingParticleHandler(ParticleHandler):
         MovingParticleHandler.parent.copy_back_buffer_index(self, i)
         self.prevPosField[i] = self.prevPosFieldBuffer[i]
 
+    def mean_overlap(self):
+        return self.overlapSum[None] / max(self.overlapPairs[None], 1)
+
     def export_state(self):
         return MovingParticleHandler.parent.export_state(self) | {
             "prevPosField": self.prevPosField.to_numpy(),
@@ -96,6 +154,6 @@ class MovingParticleHandler(ParticleHandler):
     def load_state(self, data):
         MovingParticleHandler.parent.load_state(self, data)
 
-        self.prevPosField.from_numpy(data["prevPosField"])
+        self.load_field(self.prevPosField, data["prevPosField"])
 
-        self.prevPosFieldBuffer.from_numpy(data["prevPosFieldBuffer"])
\ No newline at end of file
+        self.load_field(self.prevPosFieldBuffer, data["prevPosFieldBuffer"])
\ No newline at end of file
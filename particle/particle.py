@@ -1,34 +1,151 @@
 import taichi as ti
+import numpy as np
+from taichi.lang import impl
+from taichi.lang.util import to_numpy_type
 
 @ti.data_oriented
 class ParticleHandler:
-    def __init__(self, env, maxCount):
+    def __init__(self, env, maxCount, initialCount):
         self.env = env
-        self.MAX_COUNT = maxCount
+        self.COUNT_LIMIT = maxCount # Hard cap on the particle count (-1 = unlimited)
+        self.MAX_COUNT = initialCount if maxCount == -1 else min(initialCount, maxCount) # Current capacity
+        self.SCAN_BLOCK_SIZE = 256
 
-        self.posField = ti.Vector.field(2, dtype=ti.f32, shape=self.MAX_COUNT) # Current Pos
-
-        self.posFieldBuffer = ti.Vector.field(2, dtype=ti.f32, shape=self.MAX_COUNT)
+        # Per-particle fields live in their own SNode tree so they can be reallocated on growth
+        self.fieldsBuilder = None
+        self.fieldsTree = None
+        self.build_fields()
 
         # ECM Grid
-        self.grid = ti.field(dtype=ti.i32, shape=(self.env.GRID_RES, self.env.GRID_RES, self.env.MAX_PARTICLES_PER_GRID_CELL))
-        self.gridCount = ti.field(dtype=ti.i32, shape=(self.env.GRID_RES, self.env.GRID_RES))
+        if self.env.SPARSE_GRID:  # Blocks are allocated by rebuild_grid where particles are and freed once they have left
+            self.grid = ti.field(dtype=ti.i32)
+            self.gridCount = ti.field(dtype=ti.i32)
+            gridBuilder = ti.FieldsBuilder()
+            self.gridBlock = self.env.grid_block(gridBuilder)
+            gridcells = self.gridBlock.dense(ti.ij, self.env.GRID_BLOCK_SIZE)
+            gridcells.place(self.gridCount)
+            gridcells.dense(ti.k, self.env.MAX_PARTICLES_PER_GRID_CELL).place(self.grid)
+            self.gridTree = gridBuilder.finalize()
+        else:
+            self.grid = ti.field(dtype=ti.i32, shape=(self.env.GRID_RES, self.env.GRID_RES, self.env.MAX_PARTICLES_PER_GRID_CELL))
+            self.gridCount = ti.field(dtype=ti.i32, shape=(self.env.GRID_RES, self.env.GRID_RES))
 
-        self.toDelete = ti.field(dtype=ti.i32, shape=self.MAX_COUNT)
         self.bufferCount = ti.field(dtype=ti.i32, shape=())
-
-        self.tmpWriteCount = ti.field(dtype=ti.i32, shape=())
+        self.scanTotal = ti.field(dtype=ti.i32, shape=())
+        self.deletionCount = ti.field(dtype=ti.i32, shape=())  # Deleted since the last summary
+        self.markedCount = ti.field(dtype=ti.i32, shape=())  # Marked by the last mark_for_deletion
+        self.gridOverflow = ti.field(dtype=ti.i32, shape=())
+        self.droppedCount = ti.field(dtype=ti.i32, shape=())  # Particles left out of full gridcells by rebuild_grid, summed until reset
 
         self.count = ti.field(dtype=ti.i32, shape=())
 
+    def build_fields(self):
+        self.fieldsBuilder = ti.FieldsBuilder()
+        self.allocate_fields()
+        self.fieldsTree = self.fieldsBuilder.finalize()
+
+        # The fields compaction moves, as (field, column, width, is_float) of a row packed with one int32 word
+        # per component. Attributes keep their order, so every process lays rows out the same
+        self.rowLayout = []
+        column = 0
+        for name in vars(self):
+            if hasattr(self, name + "Buffer"):
+                field = getattr(self, name)
+                width = getattr(field, "n", 1)
+                self.rowLayout.append((field, column, width, field.dtype in [ti.f16, ti.f32]))
+                column += width
+        self.ROW_WIDTH = column
+
+    def particle_field(self, dtype, n=1):
+        field = ti.field(dtype=dtype) if n == 1 else ti.Vector.field(n, dtype=dtype)
+        self.fieldsBuilder.dense(ti.i, self.MAX_COUNT).place(field)
+        return field
+
+    def allocate_fields(self):
+        self.posField = self.particle_field(ti.f32, 2) # Current Pos
+
+        self.posFieldBuffer = self.particle_field(ti.f32, 2)
+
+        self.toDelete = self.particle_field(ti.i32)
+
+        # Prefix sum scratch
+        self.scanField = self.particle_field(ti.i32)
+        self.scanBlockField = ti.field(dtype=ti.i32)
+        self.fieldsBuilder.dense(ti.i, self.MAX_COUNT // self.SCAN_BLOCK_SIZE + 1).place(self.scanBlockField)
+
+    def reserve(self, n):
+        # Grows capacity geometrically until n particles fit, copying live rows into the new fields
+        if self.COUNT_LIMIT != -1:
+            n = min(n, self.COUNT_LIMIT)
+        if n <= self.MAX_COUNT:
+            return False
+
+        capacity = max(self.MAX_COUNT, 1)
+        while capacity < n:
+            capacity *= 2
+        if self.COUNT_LIMIT != -1:
+            capacity = min(capacity, self.COUNT_LIMIT)
+
+        data = self.export_state()
+        self.fieldsTree.destroy()
+        self.MAX_COUNT = capacity
+        self.build_fields()
+        self.load_state(data)
+
+        # Compiled kernels hold the old fields and capacity, so force them to recompile
+        for kernel in impl.get_runtime().kernels:
+            kernel.reset()
+        return True
+
+    def grid_count_numpy(self):
+        # Sparse grids are padded to whole blocks
+        return self.gridCount.to_numpy()[:self.env.GRID_RES, :self.env.GRID_RES]
+
+    def load_field(self, field, array):
+        # Saved arrays may come from a different capacity or storage precision
+        fitted = np.zeros((self.MAX_COUNT,) + array.shape[1:], dtype=to_numpy_type(field.dtype))
+        n = min(len(array), self.MAX_COUNT)
+        fitted[:n] = array[:n]
+        field.from_numpy(fitted)
+
+    @ti.func
+    def is_live(self, i):
+        # Rows below count are all particles unless a handler keeps free slots there
+        return True
+
+    @ti.func
+    def is_relaxed(self):
+        # Whether the remaining substeps of this step can be skipped
+        return False
+
     @ti.func
     def rebuild_grid(self):
         # clear grid
-        for i, j in self.gridCount:
-            self.gridCount[i, j] = 0
+        if ti.static(self.env.SPARSE_GRID):
+            # Live blocks are kept and cleared, so the insert only allocates where particles moved in.
+            # Blocks that stayed empty since the last rebuild are freed
+            for i, j in self.gridBlock:
+                if self.is_relaxed():
+                    continue
+                empty = True
+                for a, b in ti.ndrange(self.env.GRID_BLOCK_SIZE, self.env.GRID_BLOCK_SIZE):
+                    x = i * self.env.GRID_BLOCK_SIZE + a
+                    y = j * self.env.GRID_BLOCK_SIZE + b
+                    if self.gridCount[x, y] > 0:
+                        empty = False
+                        self.gridCount[x, y] = 0
+                if empty:
+                    ti.deactivate(self.gridBlock, [ti.cast(i, ti.i32), ti.cast(j, ti.i32)])
+        else:
+            for i, j in self.gridCount:
+                if self.is_relaxed():
+                    continue
+                self.gridCount[i, j] = 0
 
         # insert particles
         for i in range(self.count[None]):
+            if self.is_relaxed() or not self.is_live(i):
+                continue
             pos = self.posField[i]
             cell_x = ti.min(ti.max(int(pos[0] * self.env.GRID_RES), 0), self.env.GRID_RES - 1)
             cell_y = ti.min(ti.max(int(pos[1] * self.env.GRID_RES), 0), self.env.GRID_RES - 1)
@@ -36,41 +153,93 @@ class ParticleHandler:
             index = ti.atomic_add(self.gridCount[cell_x, cell_y], 1)
             if index < self.env.MAX_PARTICLES_PER_GRID_CELL:
                 self.grid[cell_x, cell_y, index] = i
+            else:
+                self.droppedCount[None] += 1
 
     @ti.func
-    def mark_for_deletion(self, mouse_x: ti.f32, mouse_y: ti.f32, width: ti.f32, shape: ti.i32):   # 0 = circle, 1 = square, 2 = triangle, 3 = triangle
+    def in_shape(self, d, width, shape: ti.i32):   # 0 = circle, 1 = square, 2 = triangle, 3 = line, 4 = wound shape file
+        dx = d[0]
+        dy = d[1]
+        inside = 0
+
+        if shape == 0:  # Circle
+            dist = ti.math.length(ti.Vector([dx, dy]))
+            if dist < width/2:
+                inside = 1
+
+        elif shape == 1:  # Square
+            if ti.abs(dx) < width/2 and ti.abs(dy) < width/2:
+                inside = 1
+
+        elif shape == 2:  # Upright equilateral triangle
+            height = width
+            # shift so triangle base is at -height/2, tip is at +height/2
+            local_y = dy + height / 2
+            if 0 <= local_y <= height:
+                # proportion from base (0) to tip (height)
+                t = local_y / height
+                half_width = (1 - t) * width/2
+                if ti.abs(dx) <= half_width:
+                    inside = 1
+
+        elif shape == 3:
+            if ti.abs(dx) < width/2:
+                inside = 1
+
+        elif shape == 4:  # Mask covering a width x width square
+            u = dx / width + 0.5
+            v = dy / width + 0.5
+            if 0 <= u < 1 and 0 <= v < 1:
+                inside = self.env.woundMaskField[int(u * self.env.WOUND_MASK_RES), int(v * self.env.WOUND_MASK_RES)]
+
+        return inside
+
+    @ti.func
+    def mark_for_deletion(self, mouse_x: ti.f32, mouse_y: ti.f32, width: ti.f32, shape: ti.i32):
         width = width/self.env.DOMAIN_SIZE
+        self.markedCount[None] = 0
         for i in range(self.count[None]):
-            dx = self.posField[i][0] - mouse_x
-            dy = self.posField[i][1] - mouse_y
-            delete = 0
-
-            if shape == 0:  # Circle
-                dist = ti.math.length(ti.Vector([dx, dy]))
-                if dist < width/2:
-                    delete = 1
-
-            elif shape == 1:  # Square
-                if ti.abs(dx) < width/2 and ti.abs(dy) < width/2:
-                    delete = 1
-
-            elif shape == 2:  # Upright equilateral triangle
-                height = width
-                # shift so triangle base is at -height/2, tip is at +height/2
-                local_y = dy + height / 2
-                if 0 <= local_y <= height:
-                    # proportion from base (0) to tip (height)
-                    t = local_y / height
-                    half_width = (1 - t) * width/2
-                    if ti.abs(dx) <= half_width:
-                        delete = 1
-
-            elif shape == 3:
-                if ti.abs(dx) < width/2:
-                    delete = 1
-
-
+            d = self.displacement(self.posField[i], ti.Vector([mouse_x, mouse_y]))
+            delete = self.in_shape(d, width, shape)
             self.toDelete[i] = delete
+            self.markedCount[None] += delete
+
+    @ti.func
+    def mark_near_for_deletion(self, mouse_x: ti.f32, mouse_y: ti.f32, width: ti.f32, shape: ti.i32):
+        # Same as mark_for_deletion, but only visits gridcells under the shape's bounding box.
+        # Needs an up to date grid, and sets gridOverflow if some particles there were not in it
+        width = width/self.env.DOMAIN_SIZE
+        half_x = width/2
+        half_y = width/2
+        if shape == 3:  # Lines span the whole domain
+            half_y = 1.0
+        x0 = int(ti.floor((mouse_x - half_x) * self.env.GRID_RES))
+        x1 = int(ti.floor((mouse_x + half_x) * self.env.GRID_RES))
+        y0 = int(ti.floor((mouse_y - half_y) * self.env.GRID_RES))
+        y1 = int(ti.floor((mouse_y + half_y) * self.env.GRID_RES))
+        if ti.static(self.env.PERIODIC):  # Don't visit a wrapped gridcell twice
+            x1 = ti.min(x1, x0 + self.env.GRID_RES - 1)
+            y1 = ti.min(y1, y0 + self.env.GRID_RES - 1)
+        else:
+            x0 = ti.max(x0, 0)
+            y0 = ti.max(y0, 0)
+            x1 = ti.min(x1, self.env.GRID_RES - 1)
+            y1 = ti.min(y1, self.env.GRID_RES - 1)
+
+        self.markedCount[None] = 0
+        self.gridOverflow[None] = 0
+        for gx, gy in ti.ndrange((x0, x1 + 1), (y0, y1 + 1)):
+            cx = self.wrap_gridcell(gx)
+            cy = self.wrap_gridcell(gy)
+            count = self.gridCount[cx, cy]
+            if count > self.env.MAX_PARTICLES_PER_GRID_CELL:
+                self.gridOverflow[None] = 1
+            for j in range(ti.min(count, self.env.MAX_PARTICLES_PER_GRID_CELL)):
+                i = self.grid[cx, cy, j]
+                d = self.displacement(self.posField[i], ti.Vector([mouse_x, mouse_y]))
+                if self.in_shape(d, width, shape):
+                    self.toDelete[i] = 1
+                    self.markedCount[None] += 1
 
     @ti.func
     def create(self, posX: ti.f32, posY: ti.f32):
@@ -87,31 +256,74 @@ class ParticleHandler:
 
     @ti.func
     def update(self):
-        self.clamp_count()
+        pass
+
+    @ti.func
+    def prefix_sum(self, values: ti.template(), n: ti.i32):
+        # Inclusive scan of values[0:n] in place, total goes to scanTotal.
+        # Fixed-size blocks keep the result independent of how many threads run it
+        block_size = self.SCAN_BLOCK_SIZE
+        block_count = (n + block_size - 1) // block_size
+        for b in range(block_count):
+            total = 0
+            for i in range(b * block_size, ti.min((b + 1) * block_size, n)):
+                total += values[i]
+                values[i] = total
+            self.scanBlockField[b] = total
+
+        ti.loop_config(serialize=True)
+        for b in range(1, block_count):
+            self.scanBlockField[b] += self.scanBlockField[b - 1]
+
+        for i in range(block_size, n):
+            values[i] += self.scanBlockField[i // block_size - 1]
+
+        self.scanTotal[None] = 0
+        if block_count > 0:
+            self.scanTotal[None] = self.scanBlockField[block_count - 1]
+
+    @ti.func
+    def spawn_slot(self, scanned: ti.template(), i: ti.i32):
+        # Offset of particle i's spawn within an inclusive scan of 0/1 flags, or -1 if it spawns nothing
+        previous = 0
+        if i > 0:
+            previous = scanned[i - 1]
+        slot = -1
+        if scanned[i] > previous:
+            slot = previous
+        return slot
+
+    @ti.func
+    def spawn_slots(self, n: ti.i32):
+        # Free slots left for particles spawned after the first n, keeping create()'s headroom of one
+        return ti.max(self.MAX_COUNT - 1 - n, 0)
 
     @ti.func
     def write_buffer(self):
-        self.tmpWriteCount[None] = 0
-        for i in range(self.count[None]):
+        n = self.count[None]
+        for i in range(n):
+            self.scanField[i] = 1 - self.toDelete[i]
+        self.prefix_sum(self.scanField, n)
+        for i in range(n):
             if self.toDelete[i] == 0:
-                idx = ti.atomic_add(self.tmpWriteCount[None], 1)
-                self.write_buffer_index(idx, i)
-        self.bufferCount[None] = self.tmpWriteCount[None]
+                self.write_buffer_index(self.scanField[i] - 1, i)
+            self.toDelete[i] = 0
+        self.bufferCount[None] = self.scanTotal[None]
+        self.deletionCount[None] += n - self.scanTotal[None]
 
     @ti.func
     def copy_back_buffer(self):
         n = self.bufferCount[None]
         for i in range(n):
             self.copy_back_buffer_index(i)
-        for i in range(n, self.MAX_COUNT):
+        for i in range(n, self.count[None]):  # Only the rows vacated by the deletion
             self.clear_field_index(i)
         self.count[None] = n
 
     @ti.func
     def clear_fields(self):
+        # Rows past count are never read and are overwritten by initialize, so there is nothing to clear
         self.count[None] = 0
-        for index in range(self.MAX_COUNT):
-            self.clear_field_index(index)
 
     @ti.func
     def initialize(self, idx: ti.i32, pos: ti.template()):
@@ -130,9 +342,138 @@ class ParticleHandler:
         self.posField[index] = [-1, -1]
 
     @ti.func
-    def clamp_count(self):
-        if self.count[None] > self.MAX_COUNT:
-            self.count[None] = self.MAX_COUNT
+    def wrap_position(self, pos):
+        if ti.static(self.env.PERIODIC):
+            pos -= ti.floor(pos)
+        return pos
+
+    @ti.func
+    def displacement(self, a, b):
+        # a - b, taken to the nearest periodic image when the domain wraps
+        d = a - b
+        if ti.static(self.env.PERIODIC):
+            d -= ti.round(d)
+        return d
+
+    @ti.func
+    def wrap_gridcell(self, c):
+        if ti.static(self.env.PERIODIC):
+            c %= self.env.GRID_RES
+        return c
+
+    @ti.func
+    def step_stamp(self):
+        return ti.cast(self.env.step[None], self.env.STEP_DTYPE)
+
+    @ti.func
+    def steps_since(self, stamp):
+        elapsed = self.env.step[None] - ti.cast(stamp, ti.i32)
+        if ti.static(self.env.COMPACT_STORAGE):  # Compact stamps wrap every 2^16 steps
+            elapsed &= 0xFFFF
+        return elapsed
+
+    @ti.func
+    def stamp_age(self, stamps: ti.template(), i):
+        # steps_since of a stored stamp. Compact ages are held at MAX_STEP_AGE by moving the stamp forward,
+        # so they never wrap back to zero
+        age = self.steps_since(stamps[i])
+        if ti.static(self.env.COMPACT_STORAGE):
+            if age > self.env.MAX_STEP_AGE:
+                age = self.env.MAX_STEP_AGE
+                stamps[i] = ti.cast(self.env.step[None] - age, self.env.STEP_DTYPE)
+        return age
+
+    @ti.func
+    def tile_of(self, pos):
+        # Tile of a decomposed run that owns a position
+        tx = ti.min(ti.max(int(pos[0] * self.env.TILES_X), 0), self.env.TILES_X - 1)
+        ty = ti.min(ti.max(int(pos[1] * self.env.TILES_Y), 0), self.env.TILES_Y - 1)
+        return ty * self.env.TILES_X + tx
+
+    @ti.func
+    def near_tile(self, pos, tile):
+        # Whether a position is in a tile or its halo
+        halo = self.env.HALO_WIDTH / self.env.GRID_RES
+        tx = tile % self.env.TILES_X
+        ty = tile // self.env.TILES_X
+        return (tx / self.env.TILES_X - halo <= pos[0] <= (tx + 1) / self.env.TILES_X + halo and
+                ty / self.env.TILES_Y - halo <= pos[1] <= (ty + 1) / self.env.TILES_Y + halo)
+
+    @ti.func
+    def write_row(self, rows: ti.template(), slot, i):
+        for field, column, width, is_float in ti.static(self.rowLayout):
+            for c in ti.static(range(width)):
+                if ti.static(width == 1):
+                    rows[slot, column] = self.row_word(field[i], is_float)
+                else:
+                    rows[slot, column + c] = self.row_word(field[i][c], is_float)
+
+    @ti.func
+    def row_word(self, value, is_float: ti.template()):
+        word = 0
+        if ti.static(is_float):
+            word = ti.bit_cast(ti.cast(value, ti.f32), ti.i32)
+        else:
+            word = ti.cast(value, ti.i32)
+        return word
+
+    @ti.func
+    def read_row(self, rows: ti.template(), slot, i):
+        for field, column, width, is_float in ti.static(self.rowLayout):
+            for c in ti.static(range(width)):
+                value = self.row_value(rows[slot, column + c], field.dtype, is_float)
+                if ti.static(width == 1):
+                    field[i] = value
+                else:
+                    field[i][c] = value
+
+    @ti.func
+    def row_value(self, word, dtype: ti.template(), is_float: ti.template()):
+        value = ti.cast(word, dtype)
+        if ti.static(is_float):
+            value = ti.cast(ti.bit_cast(word, ti.f32), dtype)
+        return value
+
+    @ti.func
+    def pack_rows(self, tile: ti.i32, migrants: ti.i32, rows: ti.template()):
+        # Packs the live rows near a tile, or owned by it for migrants, into the first rows.shape[0] rows.
+        # Returns how many there are, so the caller can retry with more room
+        n = self.count[None]
+        for i in range(n):
+            self.scanField[i] = 0
+            if self.is_live(i):
+                if migrants:
+                    if self.tile_of(self.posField[i]) == tile:
+                        self.scanField[i] = 1
+                elif self.near_tile(self.posField[i], tile):
+                    self.scanField[i] = 1
+        self.prefix_sum(self.scanField, n)
+        for i in range(n):
+            slot = self.spawn_slot(self.scanField, i)
+            if 0 <= slot < rows.shape[0]:
+                self.write_row(rows, slot, i)
+        return self.scanTotal[None]
+
+    @ti.func
+    def unpack_rows(self, rows: ti.template(), n: ti.i32):
+        # Appends packed rows after the live particles
+        count = self.count[None]
+        n = ti.min(n, self.spawn_slots(count))
+        for slot in range(n):
+            self.read_row(rows, slot, count + slot)
+        self.count[None] = count + n
+
+    @ti.func
+    def mark_foreign(self, tile: ti.i32):
+        # Marks the rows other tiles own. They are handed over, so compacting them away is no deletion
+        self.markedCount[None] = 0
+        for i in range(self.count[None]):
+            foreign = 0
+            if self.is_live(i) and self.tile_of(self.posField[i]) != tile:
+                foreign = 1
+            self.toDelete[i] = foreign
+            self.markedCount[None] += foreign
+        self.deletionCount[None] -= self.markedCount[None]
 
     def export_state(self):
         return {
@@ -144,8 +485,9 @@ class ParticleHandler:
         }
 
     def load_state(self, data):
-        self.count.from_numpy(data["count"])
+        self.reserve(int(data["count"]))
+        self.count[None] = min(int(data["count"]), self.MAX_COUNT)
 
-        self.posField.from_numpy(data["posField"])
+        self.load_field(self.posField, data["posField"])
 
-        self.posFieldBuffer.from_numpy(data["posFieldBuffer"])
\ No newline at end of file
+        self.load_field(self.posFieldBuffer, data["posFieldBuffer"])
\ No newline at end of file
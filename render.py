@@ -0,0 +1,81 @@
+import taichi as ti
+import tomli
+import os
+import shutil
+import argparse
+import multiprocessing as mp
+from pathlib import Path
+from tools.imaging_handler import encode_video
+
+# Re-renders saved states with the current display settings of config.toml, in parallel, and encodes a video.
+# States come from state_interval (data_path/states/experiment_*/step_*) or from saves made with Alt.
+#
+#   python render.py <states> --mode view    frames as drawn by main.py
+#   python render.py <states> --mode image   frames as captured by ImagingHandler
+
+env = None
+gui = None
+
+def init_worker(config, mode):
+    global env, gui
+    ti.init(arch=ti.cpu, offline_cache=True)
+
+    from env import Env
+
+    env = Env(config)
+    if mode == "view":
+        gui = ti.GUI("Render", res=env.SCREEN_SIZE, show_gui=False)
+
+def render_frame(args):
+    state_dir, frame_path, mode = args
+    env.saveHandler.load_state(str(state_dir))
+    env.rebuild_grid_cells_kernel()
+
+    if mode == "view":
+        env.imagingHandler.draw(gui, env.fibroHandler.count[None], env.ecmHandler.count[None])
+        gui.show(str(frame_path))
+    else:
+        import imageio
+        imageio.imwrite(frame_path, env.imagingHandler.render_image())
+    return frame_path
+
+def find_states(path):
+    # A single save, or a directory of them in step order
+    path = Path(path)
+    if (path / "fibroblast_state.npz").exists():
+        return [path]
+    return sorted(p for p in path.iterdir() if (p / "fibroblast_state.npz").exists())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render saved simulation states to frames and a video.")
+    parser.add_argument("states", help="a saved state, or a directory of them")
+    parser.add_argument("--out", help="output directory (default: <states>/render)")
+    parser.add_argument("--mode", choices=["view", "image"], default="view")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="frames rendered in parallel")
+    parser.add_argument("--no-video", action="store_true", help="only write the frames")
+    args = parser.parse_args()
+
+    if not os.path.exists("config.toml"):
+        shutil.copyfile("defaultconfig.toml", "config.toml")
+        print(f"Created config.toml from defaultconfig.toml")
+
+    with open('config.toml', 'rb') as f:
+        config = tomli.load(f)
+
+    states = find_states(args.states)
+    if not states:
+        raise Exception("No saved states in " + args.states)
+
+    out = Path(args.out if args.out else Path(args.states) / "render").resolve()
+    (out / "frames").mkdir(parents=True, exist_ok=True)
+    frames = [(state, out / "frames" / f"frame_{k:06d}.png", args.mode) for k, state in enumerate(states)]
+
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(min(args.jobs, len(frames)), initializer=init_worker, initargs=(config, args.mode)) as pool:
+        for k, frame_path in enumerate(pool.imap_unordered(render_frame, frames)):
+            print(f"Rendered {k + 1}/{len(frames)}: {frame_path.name}")
+
+    if not args.no_video:
+        encode_video(out, config["data_collection"]["video_frame_rate"])
+        print(f"Wrote {out / 'out.mp4'}")
@@ -0,0 +1,116 @@
+import taichi as ti
+import tomli
+import os
+import shutil
+import csv
+import json
+import argparse
+import numpy as np
+
+# Fast approximate run of config.toml with the continuum surrogate (tools/continuum_handler.py) instead of particles.
+# Starts from the same setup as main.py and writes the same data/data.csv, for first-pass parameter screening.
+#
+#   python surrogate.py               run config.toml up to its end_step
+#   python surrogate.py --calibrate   fit crowding_diffusion to the agent trajectories stored by validate.py
+
+fieldnames = ["step", "fibroblast_count", "ecm_count", "wound_area", "wound_width"]
+
+def make_env(config):
+    from env import Env
+    from tools.continuum_handler import ContinuumHandler
+
+    env = Env(config)
+    env.experimental_setup()
+    env.continuumHandler = ContinuumHandler(env)
+    env.seed_continuum_kernel()
+    return env
+
+def run(config):
+    ti.init(arch=ti.gpu, offline_cache=True)
+    env = make_env(config)
+    continuum = env.continuumHandler
+    env.INITIAL_WOUND_AREA = env.statisticHandler.get_wound_area(continuum.density_numpy())
+
+    os.makedirs("data", exist_ok=True)
+    with open('data/data.csv', 'w') as csv_file:
+        csv_writer = csv.DictWriter(csv_file, fieldnames=fieldnames + env.statisticHandler.get_metric_columns())
+        csv_writer.writeheader()
+
+        while env.step[None] < env.END_STEP:
+            env.step_continuum_kernel()
+            step = env.step[None] - 1
+
+            if step % env.DATA_INTERVAL == 0:
+                density = continuum.density_numpy()
+                info = {
+                    "step": step,
+                    "fibroblast_count": round(continuum.cell_count()),
+                    "ecm_count": round(continuum.ecm_count()),
+                    "wound_width": env.statisticHandler.get_average_wound_width(density)
+                }
+                info.update(env.statisticHandler.get_wound_columns(density))
+                info.update(env.statisticHandler.get_summary(continuum.read_summary(), step))
+                csv_writer.writerow(info)
+
+            if step % env.PRINT_INTERVAL == 0:
+                print("Step: " + str(step) + " | Cells: " + str(round(continuum.cell_count())))
+
+def calibrate(config, candidates):
+    # Runs every validation scenario with each candidate and keeps the one closest to the agent trajectories
+    import validate
+
+    with open(validate.REFERENCE_PATH) as f:
+        reference = json.load(f)
+
+    errors = np.zeros(len(candidates))
+    for name in reference:
+        ti.init(arch=ti.cpu, offline_cache=True)
+        env = make_env(validate.scenario_config(config, name))
+        continuum = env.continuumHandler
+        start = continuum.export_state()
+
+        for k, value in enumerate(candidates):
+            continuum.load_state(start)
+            env.step[None] = 0
+            env.CROWDING_DIFFUSION[None] = value
+
+            cells = []
+            areas = []
+            while env.step[None] < env.END_STEP:
+                if env.step[None] % validate.SAMPLE_INTERVAL == 0:
+                    cells.append(continuum.cell_count())
+                    areas.append(env.statisticHandler.get_wound_area(continuum.density_numpy()))
+                env.step_continuum_kernel()
+
+            for metric, values in [("fibroblast_count", cells), ("wound_area", areas)]:
+                target = np.array(reference[name][metric]["mean"])
+                errors[k] += np.mean(((np.array(values) - target) / np.maximum(np.abs(target), 1)) ** 2)
+        print(f"Compared {name}")
+
+    for value, error in zip(candidates, errors):
+        print(f"crowding_diffusion = {value:<10.4g} error {error:.5f}")
+    print(f"Best: crowding_diffusion = {candidates[int(np.argmin(errors))]:.4g}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the continuum surrogate of the simulation.")
+    parser.add_argument("--calibrate", action="store_true", help="fit crowding_diffusion against the validation reference")
+    parser.add_argument("--candidates", type=float, nargs="+", default=np.geomspace(0.001, 1, 13).tolist(),
+                        help="crowding_diffusion values tried by --calibrate")
+    args = parser.parse_args()
+
+    if args.calibrate:
+        # The reference was recorded with the shipped defaults
+        with open('defaultconfig.toml', 'rb') as f:
+            calibrate(tomli.load(f), args.candidates)
+    else:
+        if not os.path.exists("config.toml"):
+            shutil.copyfile("defaultconfig.toml", "config.toml")
+            print(f"Created config.toml from defaultconfig.toml")
+
+        with open('config.toml', 'rb') as f:
+            config = tomli.load(f)
+
+        if config["experiment"]["end_step"] == -1:
+            raise Exception("Surrogate runs need a finite end_step.")
+        run(config)
@@ -0,0 +1,25 @@
+import os
+import sys
+import copy
+import tomli
+import taichi as ti
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ti.init(arch=ti.cpu, random_seed=0, offline_cache=True)
+
+@pytest.fixture
+def config():
+    # The shipped defaults, headless
+    with open(os.path.join(ROOT, "defaultconfig.toml"), "rb") as f:
+        config = tomli.load(f)
+    config["data_collection"]["live_plot"] = False
+    config["data_collection"]["lineage_log"] = False
+    return copy.deepcopy(config)
+
+@pytest.fixture(autouse=True)
+def in_root(monkeypatch):
+    # Saved states are looked up relative to the repository
+    monkeypatch.chdir(ROOT)
@@ -0,0 +1,25 @@
+import pytest
+
+from env import Env
+
+def compact_config(config, lifetime):
+    config["environment"]["compact_storage"] = True
+    config["ecm"]["ecm_lifetime"] = lifetime
+    return config
+
+def test_compact_ecm_retires_across_stamp_wrap(config):
+    env = Env(compact_config(config, 30000))
+    deposit_step = 2**16 - 5  # The stamp wraps a few steps later
+    env.step[None] = deposit_step
+    env.create_ecm_kernel(0.5, 0.5)
+
+    env.step[None] = deposit_step + 30000 - 3
+    env.update_kernel()
+    assert env.refresh_status()["ecm_count"] == 1
+    for _ in range(4):
+        env.update_kernel()
+    assert env.refresh_status()["ecm_count"] == 0
+
+def test_lifetime_beyond_compact_stamps_is_rejected(config):
+    with pytest.raises(Exception, match="ecm_lifetime"):
+        Env(compact_config(config, 2**16))
@@ -0,0 +1,35 @@
+import numpy as np
+
+from env import Env
+
+def rows_of(handler, indices):
+    state = handler.export_state()
+    return {tag: array[indices] for tag, array in state.items() if tag + "Buffer" in state}
+
+def test_packed_rows_load_back_unchanged(config):
+    config["environment"]["compact_storage"] = True  # Narrow ints and halves go through the int32 words too
+    source = Env(config)
+    target = Env(config)
+    for x, y in [(0.2, 0.2), (0.7, 0.2), (0.499, 0.2), (0.3, 0.7)]:
+        source.create_cell_kernel(x, y)
+    handler = source.fibroHandler
+    rows = np.zeros((4, handler.ROW_WIDTH), dtype=np.int32)
+
+    # Tile 1 is the lower right one of the default 2 x 2 tiles
+    assert source.pack_rows_kernel(handler, 1, 1, rows) == 1
+    assert source.pack_rows_kernel(handler, 1, 0, rows) == 2
+    target.unpack_rows_kernel(target.fibroHandler, rows, 2)
+
+    assert target.fibroHandler.count[None] == 2
+    expected = rows_of(handler, [1, 2])
+    for tag, array in rows_of(target.fibroHandler, [0, 1]).items():
+        assert np.array_equal(array, expected[tag]), tag
+
+def test_foreign_rows_are_handed_over(config):
+    env = Env(config)
+    for x, y in [(0.2, 0.2), (0.7, 0.2), (0.3, 0.7)]:
+        env.create_cell_kernel(x, y)
+    env.mark_foreign_kernel(env.fibroHandler, 0)
+    env.compact_cells_kernel()
+    assert env.fibroHandler.count[None] == 1
+    assert env.fibroHandler.deletionCount[None] == 0
@@ -0,0 +1,55 @@
+import os
+import numpy as np
+from multiprocessing import shared_memory
+
+from env import Env
+from tools.share_handler import ShareReader
+
+def test_reader_follows_a_growing_writer(config):
+    name = f"fiss_test_{os.getpid()}"
+    env = Env(config)
+    writer = env.shareHandler
+
+    reader = ShareReader(name)
+    assert reader.read() is None  # Started before the simulation
+
+    try:
+        writer.open(name)
+        assert reader.read() is None  # Nothing published yet
+        env.create_cell_kernel(0.5, 0.5)
+        writer.publish(0, env.refresh_status())
+        snapshot = reader.read()
+        assert snapshot["step"] == 0 and snapshot["cell_count"] == 1
+
+        # The writer replaces the segment when it grows, while the reader holds the old one
+        capacity = env.fibroHandler.MAX_COUNT
+        for k in range(capacity):
+            env.create_cell_kernel(0.1 + 0.8 * k / capacity, 0.3)
+        env.fibroHandler.reserve(2 * capacity)
+        for k in range(capacity):
+            env.create_cell_kernel(0.1 + 0.8 * k / capacity, 0.6)
+        status = env.refresh_status()
+        writer.publish(1, status)
+        assert not reader.valid(snapshot)
+        snapshot = reader.read()
+        assert snapshot["step"] == 1 and snapshot["cell_count"] == status["cell_count"] > capacity
+        assert np.allclose(snapshot["cell_pos"], env.fibroHandler.posField.to_numpy()[:status["cell_count"]])
+
+        # Between the old segment going away and the new one being ready there is no snapshot
+        writer.release()
+        assert reader.read() is None
+        memory = shared_memory.SharedMemory(name=name, create=True, size=4096)  # Header not written yet
+        try:
+            assert reader.read() is None
+        finally:
+            memory.close()
+            memory.unlink()
+
+        writer.allocate()
+        writer.publish(2, status)
+        assert reader.copy()["step"] == 2
+    finally:
+        writer.close()
+
+    assert reader.read() is None  # The run ended
+    reader.close()
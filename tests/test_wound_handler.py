@@ -0,0 +1,74 @@
+import numpy as np
+
+from env import Env
+
+def make_env(config):
+    env = Env(config)
+    env.experimental_setup()
+    return env
+
+def test_single_off_center_cell_has_no_wound(config):
+    env = Env(config)
+    env.create_cell_kernel(0.3, 0.7)
+    env.rebuild_grid_cells_kernel()
+    wound = env.woundHandler.measure()
+    assert wound["area"] == 0
+    assert wound["perimeter"] == 0
+    assert np.isnan(wound["centroid_x"])
+
+def test_single_centered_cell_has_no_wound(config):
+    env = make_env(config)
+    env.rebuild_grid_cells_kernel()
+    assert env.statisticHandler.get_wound_area() == 0
+
+def test_enclosed_hole_is_measured(config):
+    env = Env(config)
+    res = env.GRID_RES
+    counts = np.full((res, res), env.MAX_IMAGE_PIXEL_CELLS, dtype=np.int32)
+    cx, cy = env.woundHandler.CENTER
+    counts[cx - 5:cx + 5, cy - 3:cy + 3] = 0
+    dx = env.DOMAIN_SIZE / res
+    wound = env.woundHandler.measure(counts)
+    assert np.isclose(wound["area"], 60 * dx * dx / 1000000)
+    assert np.isclose(wound["perimeter"], 32 * dx)
+    assert np.isclose(wound["centroid_x"], cx * dx, atol=dx)
+
+def test_scratch_from_wall_to_wall_is_measured(config):
+    env = Env(config)
+    res = env.GRID_RES
+    counts = np.full((res, res), env.MAX_IMAGE_PIXEL_CELLS, dtype=np.int32)
+    cx, cy = env.woundHandler.CENTER
+    counts[cx - 4:cx + 4, :] = 0
+    dx = env.DOMAIN_SIZE / res
+    assert np.isclose(env.woundHandler.measure(counts)["area"], 8 * res * dx * dx / 1000000)
+
+def test_space_around_tissue_is_no_wound(config):
+    env = Env(config)
+    res = env.GRID_RES
+    counts = np.zeros((res, res), dtype=np.int32)
+    counts[:res // 3, :res // 3] = env.MAX_IMAGE_PIXEL_CELLS  # A colony in one corner
+    assert env.woundHandler.measure(counts)["area"] == 0
+
+def test_full_circle_wound_is_measured(config):
+    config["experiment"]["initial_mode"] = "full"
+    config["experiment"]["initial_wound"] = "circle"
+    env = make_env(config)
+    area = env.statisticHandler.get_wound_area()
+    radius_mm = env.WOUND_WIDTH / 2 / 1000
+    assert 0.9 * np.pi * radius_mm ** 2 < area < 1.1 * np.pi * radius_mm ** 2
+
+def test_sparse_grid_matches_dense(config):
+    config["experiment"]["initial_mode"] = "full"
+    config["experiment"]["initial_wound"] = "square"
+    wounds = []
+    for sparse in [False, True]:
+        config["environment"]["sparse_grid"] = sparse
+        env = make_env(config)
+        env.rebuild_grid_cells_kernel()
+        counts = env.fibroHandler.grid_count_numpy()
+        counts[:len(counts) // 4, :] = 0  # Empty blocks joining the wound across the border
+        wounds.append([env.woundHandler.measure(), env.woundHandler.measure(counts)])
+    for dense, sparse in zip(*wounds):
+        assert dense.keys() == sparse.keys()
+        for key in dense:
+            assert np.isclose(dense[key], sparse[key])
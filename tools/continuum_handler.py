@@ -0,0 +1,252 @@
+import taichi as ti
+import numpy as np
+
+@ti.data_oriented
+class ContinuumHandler:
+    # Mean-field surrogate of the agent model on the spatial grid, for fast approximate runs (see surrogate.py).
+    # Each gridcell holds quiescent (G0) and cycling cell densities, their mean inhibition and the ECM density,
+    # all in particles per gridcell. Env.topoField holds the total cell density
+    PHASE_FRACTIONS = [0.4, 0.33, 0.17, 0.1]  # Share of the cycle spent in G1, S, G2 and M (see handle_cell_cycle)
+
+    def __init__(self, env):
+        self.env = env
+        self.fibroHandler = self.env.fibroHandler
+        self.ecmHandler = self.env.ecmHandler
+        self.GRID_RES = env.GRID_RES
+
+        shape = (self.GRID_RES, self.GRID_RES)
+        self.quiescentField = ti.field(dtype=ti.f32, shape=shape)
+        self.cyclingField = ti.field(dtype=ti.f32, shape=shape)
+        self.inhibitionField = ti.field(dtype=ti.f32, shape=shape)
+        self.ecmField = ti.field(dtype=ti.f32, shape=shape)
+
+        self.quiescentFieldBuffer = ti.field(dtype=ti.f32, shape=shape)
+        self.cyclingFieldBuffer = ti.field(dtype=ti.f32, shape=shape)
+        self.inhibitionFieldBuffer = ti.field(dtype=ti.f32, shape=shape)
+
+        self.divisionCount = ti.field(dtype=ti.f32, shape=())  # Divisions since the last summary
+        self.depositCount = ti.field(dtype=ti.f32, shape=())  # ECM deposits since the last summary
+        self.summaryField = ti.field(dtype=ti.f32, shape=len(self.fibroHandler.SUMMARY_COLUMNS))
+
+        # Particles per gridcell seen within a radius, at unit density
+        gridcell_area = (1 / self.GRID_RES) ** 2
+        self.DISK_CELLS = np.pi * self.env.CELL_RADIUS ** 2 / gridcell_area
+
+    def density_numpy(self):
+        # Sparse grids are padded to whole blocks
+        return self.env.topoField.to_numpy()[:self.GRID_RES, :self.GRID_RES]
+
+    def export_state(self):
+        return {"quiescentField": self.quiescentField.to_numpy(), "cyclingField": self.cyclingField.to_numpy(),
+                "inhibitionField": self.inhibitionField.to_numpy(), "ecmField": self.ecmField.to_numpy()}
+
+    def load_state(self, data):
+        for tag, array in data.items():
+            getattr(self, tag).from_numpy(array)
+        cells = data["quiescentField"] + data["cyclingField"]
+        if self.env.SPARSE_GRID:  # Padded to whole blocks
+            cells = np.pad(cells, [(0, n - self.GRID_RES) for n in self.env.topoField.shape])
+        self.env.topoField.from_numpy(cells)
+        self.divisionCount[None] = 0
+        self.depositCount[None] = 0
+
+    @ti.func
+    def gridcell(self, pos):
+        return ti.Vector([ti.min(ti.max(int(pos[0] * self.GRID_RES), 0), self.GRID_RES - 1),
+                          ti.min(ti.max(int(pos[1] * self.GRID_RES), 0), self.GRID_RES - 1)])
+
+    @ti.func
+    def seed(self):
+        # Densities from the particles, so the surrogate starts from the same setup as an agent run
+        for i, j in ti.ndrange(self.GRID_RES, self.GRID_RES):
+            self.quiescentField[i, j] = 0
+            self.cyclingField[i, j] = 0
+            self.inhibitionField[i, j] = 0
+            self.ecmField[i, j] = 0
+
+        for i in range(self.fibroHandler.count[None]):
+            c = self.gridcell(self.fibroHandler.posField[i])
+            if self.fibroHandler.phaseField[i] == 0:
+                self.quiescentField[c] += 1
+            else:
+                self.cyclingField[c] += 1
+            self.inhibitionField[c] += self.fibroHandler.inhibitionField[i]
+
+        for i in range(self.ecmHandler.count[None]):
+            if self.ecmHandler.is_live(i):
+                self.ecmField[self.gridcell(self.ecmHandler.posField[i])] += 1
+
+        for i, j in ti.ndrange(self.GRID_RES, self.GRID_RES):
+            cells = self.quiescentField[i, j] + self.cyclingField[i, j]
+            if cells > 0:
+                self.inhibitionField[i, j] /= cells
+            self.env.topoField[i, j] = cells
+
+        self.divisionCount[None] = 0
+        self.depositCount[None] = 0
+
+    @ti.func
+    def neighbor(self, i, j, di, dj):
+        # Neighboring gridcell, or -1 outside a walled domain
+        ni = self.wrap(i + di)
+        nj = self.wrap(j + dj)
+        if not (0 <= ni < self.GRID_RES and 0 <= nj < self.GRID_RES):
+            ni = -1
+        return ti.Vector([ni, nj])
+
+    @ti.func
+    def wrap(self, c):
+        if ti.static(self.env.PERIODIC):
+            c %= self.GRID_RES
+        return c
+
+    @ti.func
+    def local_mean(self, field: ti.template(), i, j):
+        total = 0.0
+        for di, dj in ti.static(ti.ndrange((-1, 2), (-1, 2))):
+            n = self.neighbor(i, j, di, dj)
+            if n[0] >= 0:
+                total += field[n]
+        return total / 9
+
+    @ti.func
+    def crowding_diffusivity(self, cells):
+        # Collisions push crowded cells apart, modeled as diffusion that grows with density
+        confluence = cells * self.DISK_CELLS
+        return self.env.CROWDING_DIFFUSION[None] * ti.pow(confluence, self.env.CROWDING_EXPONENT[None])
+
+    @ti.func
+    def flux(self, a, b, motility, avoidance, population: ti.template()):
+        # Particles of one population moving from gridcell a to b in a step, antisymmetric in a and b
+        cells_a = self.env.topoField[a]
+        cells_b = self.env.topoField[b]
+        diffusivity = ti.min(0.5 * (self.crowding_diffusivity(cells_a) + self.crowding_diffusivity(cells_b)), 0.2)
+
+        # Crowding moves the local mix of populations down the total density gradient
+        share = 0.0
+        if cells_a > cells_b and cells_a > 0:
+            share = population[a] / cells_a
+        elif cells_b > 0:
+            share = population[b] / cells_b
+        flow = diffusivity * (cells_a - cells_b) * share
+
+        # Random motility and ECM avoidance only move cells that are not in G0
+        flow += motility * (population[a] - population[b])
+        if self.ecmField[a] > self.ecmField[b]:
+            flow += avoidance * population[a]
+        elif self.ecmField[b] > self.ecmField[a]:
+            flow -= avoidance * population[b]
+        return flow
+
+    @ti.func
+    def react(self, i, j):
+        cycle = ti.cast(self.env.CELL_CYCLE_DURATION[None], ti.f32)
+        early_g1 = ti.max(2, int(0.4 * cycle) // 20)
+        quiescent = self.quiescentField[i, j]
+        cycling = self.cyclingField[i, j]
+
+        # Neighbors within the inhibition radius are Poisson distributed around the local density
+        inhibition_disk = self.DISK_CELLS * self.env.INHIBITION_RADIUS[None] ** 2
+        neighbors = self.local_mean(self.env.topoField, i, j) * inhibition_disk
+        inhibition = self.inhibitionField[i, j] + self.env.INHIBITION_FACTOR[None] * (neighbors - ti.exp(-neighbors))
+        inhibition = ti.min(inhibition, self.env.INHIBITION_THRESHOLD[None])
+        self.inhibitionField[i, j] = inhibition
+
+        # G0 cells restart the cycle once inhibition is relieved, cycling cells stop in early G1
+        entering = 0.0
+        leaving = 0.0
+        if inhibition < self.env.INHIBITION_EXIT_THRESHOLD[None]:
+            leaving = quiescent
+        if inhibition >= self.env.INHIBITION_THRESHOLD[None]:
+            entering = cycling * early_g1 / cycle
+
+        # Growth rate of a population that doubles every cycle
+        divisions = (cycling - entering) * np.log(2) / cycle
+        self.divisionCount[None] += divisions
+
+        # Every cell deposits once per period, which grows with the ECM it detects
+        ecm_nearby = 9 * self.local_mean(self.ecmField, i, j)  # Cells only search the gridcells next to theirs
+        deposits = 0.0
+        if ecm_nearby <= self.env.ECM_THRESHOLD[None]:
+            deposits = (quiescent + cycling) / (self.env.MIN_ECM_PERIOD[None] + ecm_nearby)
+        self.depositCount[None] += deposits
+        decay = 0.0
+        if self.env.ECM_LIFETIME[None] > 0:
+            decay = self.ecmField[i, j] / self.env.ECM_LIFETIME[None]
+
+        self.quiescentFieldBuffer[i, j] = quiescent + entering - leaving
+        self.cyclingFieldBuffer[i, j] = cycling - entering + leaving + divisions
+        self.ecmField[i, j] += deposits - decay
+
+    @ti.func
+    def step(self):
+        for i, j in ti.ndrange(self.GRID_RES, self.GRID_RES):
+            self.react(i, j)
+        for i, j in ti.ndrange(self.GRID_RES, self.GRID_RES):
+            self.quiescentField[i, j] = self.quiescentFieldBuffer[i, j]
+            self.cyclingField[i, j] = self.cyclingFieldBuffer[i, j]
+            self.env.topoField[i, j] = self.quiescentField[i, j] + self.cyclingField[i, j]
+
+        # Transport, in gridcells per step
+        speed = self.env.MAX_CELL_SPEED[None] * self.GRID_RES
+        motility = 0.5 * speed * speed
+        avoidance = ti.min(self.env.ECM_AVOIDANCE_STRENGTH[None] * self.GRID_RES, 0.2)
+        for i, j in ti.ndrange(self.GRID_RES, self.GRID_RES):
+            a = ti.Vector([i, j])
+            quiescent = self.quiescentField[a]
+            cycling = self.cyclingField[a]
+            inhibition = self.inhibitionField[a] * self.env.topoField[a]  # Cells carry their inhibition along
+            for d in ti.static(range(4)):
+                n = self.neighbor(i, j, [1, -1, 0, 0][d], [0, 0, 1, -1][d])
+                if n[0] >= 0:
+                    flow_quiescent = self.flux(a, n, 0.0, 0.0, self.quiescentField)
+                    flow_cycling = self.flux(a, n, motility, avoidance, self.cyclingField)
+                    quiescent -= flow_quiescent
+                    cycling -= flow_cycling
+                    flow = flow_quiescent + flow_cycling
+                    inhibition -= flow * (self.inhibitionField[a] if flow > 0 else self.inhibitionField[n])
+            quiescent = ti.max(quiescent, 0.0)
+            cycling = ti.max(cycling, 0.0)
+            self.quiescentFieldBuffer[a] = quiescent
+            self.cyclingFieldBuffer[a] = cycling
+            self.inhibitionFieldBuffer[a] = self.inhibitionField[a]
+            if quiescent + cycling > 0:
+                self.inhibitionFieldBuffer[a] = inhibition / (quiescent + cycling)
+        for i, j in ti.ndrange(self.GRID_RES, self.GRID_RES):
+            self.quiescentField[i, j] = self.quiescentFieldBuffer[i, j]
+            self.cyclingField[i, j] = self.cyclingFieldBuffer[i, j]
+            self.inhibitionField[i, j] = self.inhibitionFieldBuffer[i, j]
+            self.env.topoField[i, j] = self.quiescentField[i, j] + self.cyclingField[i, j]
+
+    @ti.func
+    def summarize(self):
+        # Same layout as CellHandler.summarize. Speeds are taken as full speed in G1 and S and none otherwise
+        columns = ti.static(self.fibroHandler.SUMMARY_COLUMNS)
+        for k in ti.static(range(len(columns))):
+            self.summaryField[k] = 0
+        for i, j in ti.ndrange(self.GRID_RES, self.GRID_RES):
+            quiescent = self.quiescentField[i, j]
+            cycling = self.cyclingField[i, j]
+            inhibition = self.inhibitionField[i, j]
+            self.summaryField[ti.static(columns.index("g0"))] += quiescent
+            for k in ti.static(range(4)):
+                self.summaryField[ti.static(columns.index(["g1", "s", "g2", "m"][k]))] += cycling * self.PHASE_FRACTIONS[k]
+            self.summaryField[ti.static(columns.index("inhibition_sum"))] += inhibition * (quiescent + cycling)
+            self.summaryField[ti.static(columns.index("inhibition_sq_sum"))] += inhibition * inhibition * (quiescent + cycling)
+            moving = cycling * (self.PHASE_FRACTIONS[0] + self.PHASE_FRACTIONS[1])
+            self.summaryField[ti.static(columns.index("speed_sum"))] += moving
+            self.summaryField[ti.static(columns.index("speed_sq_sum"))] += moving
+        self.summaryField[ti.static(columns.index("divisions"))] = self.divisionCount[None]
+        self.summaryField[ti.static(columns.index("ecm_deposits"))] = self.depositCount[None]
+        self.divisionCount[None] = 0
+        self.depositCount[None] = 0
+
+    def read_summary(self):
+        self.env.summarize_continuum_kernel()
+        return self.summaryField.to_numpy()
+
+    def cell_count(self):
+        return float(self.density_numpy().sum())
+
+    def ecm_count(self):
+        return float(self.ecmField.to_numpy().sum())
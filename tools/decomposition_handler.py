@@ -0,0 +1,140 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+# Tiles hand particles to each other through POSIX shared memory. Every ordered pair of tiles has a segment
+# per exchange (halos, migrants) and handler, which the source packs on the device and the destination
+# unpacks after a barrier. Rows hold one int32 word per component of the fields compaction moves (see
+# ParticleHandler.rowLayout), so only halo and migrant rows are copied.
+#
+# Header (int64, shared by all tiles): count, generation and capacity for each exchange, handler, source
+# and destination. A source whose rows don't fit replaces its segment by a larger one of the next generation.
+# The two exchanges alternate, so by the time a source packs an exchange again, the barrier of the other
+# one has seen every destination finish reading it.
+
+HALOS, MIGRANTS = range(2)
+COUNT, GENERATION, CAPACITY = range(3)
+
+def header_size(tile_count):
+    return 2 * 2 * tile_count * tile_count * 3
+
+class DecompositionHandler:
+    def __init__(self, env, rank, channels):
+        self.env = env
+        self.rank = rank
+        self.name, headers, self.barrier = channels  # From decomposed.run_tiles
+
+        self.TILES_X = env.TILES_X
+        self.TILE_COUNT = env.TILES_X * env.TILES_Y
+        self.ID_BLOCK = 1 << 26  # Cell ids each tile can hand out without clashing with other tiles
+        # Rows in the halo ring around a tile when every gridcell there is full. Segments start this large
+        tile_cells = -(-env.GRID_RES // min(env.TILES_X, env.TILES_Y))
+        self.INITIAL_CAPACITY = 4 * (tile_cells + 2 * env.HALO_WIDTH) * (env.HALO_WIDTH + 1) * env.MAX_PARTICLES_PER_GRID_CELL
+
+        self.handlers = [env.fibroHandler, env.ecmHandler]
+        self.compact_kernels = [env.compact_cells_kernel, env.compact_ecm_kernel]
+        self.others = [tile for tile in range(self.TILE_COUNT) if tile != rank]
+
+        self.header = np.frombuffer(headers, dtype=np.int64).reshape(2, 2, self.TILE_COUNT, self.TILE_COUNT, 3)
+        self.outgoing = {}  # (exchange, handler, destination): (segment, rows)
+        self.incoming = {}  # (exchange, handler, source): (segment, rows, generation)
+        for exchange in [HALOS, MIGRANTS]:
+            for k in range(len(self.handlers)):
+                for tile in self.others:
+                    self.allocate(exchange, k, tile, self.INITIAL_CAPACITY)
+
+    def segment_name(self, exchange, k, src, dst, generation):
+        return f"{self.name}_{exchange}{k}_{src}_{dst}_{generation}"
+
+    def rows_view(self, memory, k, capacity):
+        return np.ndarray((capacity, self.handlers[k].ROW_WIDTH), dtype=np.int32, buffer=memory.buf)
+
+    def allocate(self, exchange, k, dst, capacity):
+        header = self.header[exchange, k, self.rank, dst]
+        generation = 0
+        if (exchange, k, dst) in self.outgoing:
+            generation = int(header[GENERATION]) + 1
+            self.release(self.outgoing, (exchange, k, dst), unlink=True)
+        name = self.segment_name(exchange, k, self.rank, dst, generation)
+        memory = shared_memory.SharedMemory(name=name, create=True, size=capacity * self.handlers[k].ROW_WIDTH * 4)
+        self.outgoing[exchange, k, dst] = (memory, self.rows_view(memory, k, capacity))
+        header[[GENERATION, CAPACITY]] = generation, capacity
+
+    def incoming_rows(self, exchange, k, src):
+        # The source's current segment, attached again after it grew
+        header = self.header[exchange, k, src, self.rank]
+        generation = int(header[GENERATION])
+        if (exchange, k, src) in self.incoming:
+            memory, rows, attached = self.incoming[exchange, k, src]
+            if attached == generation:
+                return rows
+            del memory, rows
+            self.release(self.incoming, (exchange, k, src))
+        memory = shared_memory.SharedMemory(name=self.segment_name(exchange, k, src, self.rank, generation))
+        rows = self.rows_view(memory, k, int(header[CAPACITY]))
+        self.incoming[exchange, k, src] = (memory, rows, generation)
+        return rows
+
+    @staticmethod
+    def release(entries, key, unlink=False):
+        memory = entries.pop(key)[0]  # The rows view goes with the entry, the segment can't close while it maps it
+        memory.close()
+        if unlink:
+            memory.unlink()
+
+    def send(self, exchange):
+        # Packs the rows for every other tile, growing segments that were too small
+        for k, handler in enumerate(self.handlers):
+            for tile in self.others:
+                n = self.env.pack_rows_kernel(handler, tile, int(exchange == MIGRANTS), self.outgoing[exchange, k, tile][1])
+                if n > self.header[exchange, k, self.rank, tile, CAPACITY]:
+                    self.allocate(exchange, k, tile, 2 * n)
+                    self.env.pack_rows_kernel(handler, tile, int(exchange == MIGRANTS), self.outgoing[exchange, k, tile][1])
+                self.header[exchange, k, self.rank, tile, COUNT] = n
+
+    def receive(self, exchange):
+        # Appends the rows the other tiles packed for this one, in tile order
+        self.barrier.wait()
+        for k, handler in enumerate(self.handlers):
+            counts = [int(self.header[exchange, k, tile, self.rank, COUNT]) for tile in self.others]
+            if sum(counts) == 0:
+                continue
+            handler.reserve(handler.count[None] + sum(counts) + 1)
+            for tile, n in zip(self.others, counts):
+                if n > 0:
+                    self.env.unpack_rows_kernel(handler, self.incoming_rows(exchange, k, tile)[:n], n)
+
+    def keep_own_rows(self):
+        for handler, compact_kernel in zip(self.handlers, self.compact_kernels):
+            self.env.mark_foreign_kernel(handler, self.rank)
+            if handler.markedCount[None] > 0:
+                compact_kernel()
+
+    def keep_own_tile(self):
+        self.keep_own_rows()
+        self.env.fibroHandler.nextId[None] += self.rank * self.ID_BLOCK
+
+    def exchange_halos(self):
+        # Appends copies of neighboring particles near this tile after the owned ones
+        owned = [handler.count[None] for handler in self.handlers]
+        self.send(HALOS)
+        self.receive(HALOS)
+        self.env.rebuild_grid_ecm_kernel()
+        return owned
+
+    def drop_halos(self, owned):
+        # Halo rows past the owned count are overwritten by the next births and deposits
+        for handler, count in zip(self.handlers, owned):
+            handler.count[None] = count
+
+    def migrate(self):
+        # Hands particles that left this tile to the tile that now owns them
+        self.send(MIGRANTS)
+        self.keep_own_rows()
+        self.receive(MIGRANTS)
+
+    def close(self):
+        self.barrier.wait()  # Every tile is done reading before the segments go
+        for key in list(self.incoming):
+            self.release(self.incoming, key)
+        for key in list(self.outgoing):
+            self.release(self.outgoing, key, unlink=True)
@@ -1,45 +1,122 @@
+import taichi as ti
 import numpy as np
-import imageio
 from pathlib import Path
 import subprocess
 
+@ti.data_oriented
 class ImagingHandler:
     def __init__(self, env):
         self.env = env
         self.fibroHandler = self.env.fibroHandler
-        self.GRID_RES = env.GRID_RES
-        self.MAX_COUNT_PER_CELL = self.env.MAX_IMAGE_PIXEL_CELLS
+        self.ecmHandler = self.env.ecmHandler
+        self.IMAGE_RES = self.env.IMAGE_RESOLUTION if self.env.IMAGE_RESOLUTION > 0 else env.GRID_RES
+        self.IMAGE_BLUR = self.env.IMAGE_BLUR
+        self.IMAGE_CONTENT = self.env.IMAGE_CONTENT
 
-        self.fibro_pixel_map = np.zeros(
-            (self.GRID_RES, self.GRID_RES), dtype=np.float32
-        )
+        # A pixel turns white at the density of MAX_IMAGE_PIXEL_CELLS per gridcell
+        self.PIXEL_CAP = self.env.MAX_IMAGE_PIXEL_CELLS * (env.GRID_RES / self.IMAGE_RES) ** 2
+        self.BLUR_REACH = int(np.ceil(3 * self.IMAGE_BLUR))
 
-    def capture_image(self, path):
+        # Splatted on the device, so a frame costs one transfer of the finished 8-bit image.
+        # Allocated by the first render, so runs that capture no images don't hold them
+        self.imageField = None
+        self.pixelField = None  # Rows top to bottom
+
+    @ti.func
+    def splat(self, pos, weight):
+        p = pos * self.IMAGE_RES
+        if ti.static(self.IMAGE_BLUR > 0):  # Gaussian footprint, normalized to carry the full weight
+            x0 = int(ti.floor(p[0]))
+            y0 = int(ti.floor(p[1]))
+            for dx, dy in ti.ndrange((-self.BLUR_REACH, self.BLUR_REACH + 1), (-self.BLUR_REACH, self.BLUR_REACH + 1)):
+                x = x0 + dx
+                y = y0 + dy
+                if 0 <= x < self.IMAGE_RES and 0 <= y < self.IMAGE_RES:
+                    d = ti.Vector([x + 0.5, y + 0.5]) - p
+                    falloff = ti.exp(-d.dot(d) / (2 * self.IMAGE_BLUR ** 2)) / (2 * np.pi * self.IMAGE_BLUR ** 2)
+                    self.imageField[x, y] += weight * falloff
+        else:
+            x = ti.min(ti.max(int(p[0]), 0), self.IMAGE_RES - 1)
+            y = ti.min(ti.max(int(p[1]), 0), self.IMAGE_RES - 1)
+            self.imageField[x, y] += weight
+
+    @ti.func
+    def render(self):
+        for x, y in self.imageField:
+            self.imageField[x, y] = 0
+
+        if ti.static(self.IMAGE_CONTENT == "ecm"):
+            for i in range(self.ecmHandler.count[None]):
+                if self.ecmHandler.is_live(i):
+                    self.splat(self.ecmHandler.posField[i], 1.0)
+        else:
+            for i in range(self.fibroHandler.count[None]):
+                weight = 1.0
+                if ti.static(self.IMAGE_CONTENT == "cycling"):  # Cells outside G0
+                    weight = ti.cast(self.fibroHandler.phaseField[i] != 0, ti.f32)
+                self.splat(self.fibroHandler.posField[i], weight)
+
+        for x, y in self.imageField:
+            value = ti.min(self.imageField[x, y] / self.PIXEL_CAP, 1.0) * 255
+            self.pixelField[self.IMAGE_RES - 1 - y, x] = ti.cast(value, ti.u8)
+
+    def draw(self, gui, cell_count=None, ecm_count=None, display_cells=True, display_phase=True, display_ecm=True):
+        # The live view of main.py, also used by render.py. Counts that aren't given are read along with the
+        # particles of the layers shown, so drawing needs no status read
+        radius = self.env.CELL_RADIUS * self.env.SCREEN_SIZE[0] * self.env.CELL_RADIUS_SCALAR
+        if display_ecm:
+            if ecm_count is None:
+                ecm_count = self.ecmHandler.count[None]
+            if self.env.DRAW_ECM_LINES:
+                gui.lines(self.ecmHandler.ecmConnectPosField.to_numpy()[:ecm_count],
+                          self.ecmHandler.posField.to_numpy()[:ecm_count],
+                          radius=1,
+                          color=0x353355)
+            else:
+                gui.circles(self.ecmHandler.posField.to_numpy()[:ecm_count], radius=radius, color=0x353355)
+
+        if display_cells:
+            if cell_count is None:
+                cell_count = self.fibroHandler.count[None]
+            positions = self.fibroHandler.posField.to_numpy()[:cell_count]
+            if display_phase:
+                gui.circles(positions, radius=radius, color=self.env.PHASE_COLORS[self.fibroHandler.phaseField.to_numpy()[:cell_count]])
+            else:
+                gui.circles(positions, radius=radius, color=0xffffff)
+
+    def capture_image(self, path, step=None):
+        import imageio  # Only needed when capturing data, so keep it out of startup
+
+        if step is None:
+            step = self.env.step[None]
         path = path + "/frames"
         save_dir = Path(path)
         save_dir.mkdir(parents=True, exist_ok=True)
 
-        grid_count_np = self.fibroHandler.gridCount.to_numpy()
-
-        self.fibro_pixel_map[:] = grid_count_np / self.MAX_COUNT_PER_CELL
-        np.clip(self.fibro_pixel_map, 0.0, 1.0, out=self.fibro_pixel_map)
+        imageio.imwrite(path + f"/frame_{step:06d}.png", self.render_image())
 
-        imageio.imwrite(
-            path + f"/frame_{self.env.step[None]:06d}.png",
-            (np.flipud(self.fibro_pixel_map.T) * 255).astype(np.uint8)
-        )
+    def render_image(self):
+        if self.imageField is None:
+            self.imageField = ti.field(dtype=ti.f32, shape=(self.IMAGE_RES, self.IMAGE_RES))
+            self.pixelField = ti.field(dtype=ti.u8, shape=(self.IMAGE_RES, self.IMAGE_RES))
+        self.env.render_image_kernel()
+        return self.pixelField.to_numpy()
 
     def save_video(self, path):
-        run_dir = Path(path)
-
-        cmd = [
-            "ffmpeg",
-            "-loglevel", "error",
-            "-framerate", f"{self.env.VIDEO_FRAME_RATE}",
-            "-pattern_type", "glob",
-            "-i", f"{path}/frames/frame_*.png",
-            "-pix_fmt", "yuv420p",
-            "out.mp4"
-        ]
-
-        subprocess.run(cmd, check=True, cwd=run_dir)
+        encode_video(path, self.env.VIDEO_FRAME_RATE)
+
+def encode_video(path, frame_rate):
+    # path/frames/frame_*.png to path/out.mp4
+    run_dir = Path(path)
+
+    cmd = [
+        "ffmpeg",
+        "-loglevel", "error",
+        "-framerate", f"{frame_rate}",
+        "-pattern_type", "glob",
+        "-i", f"{path}/frames/frame_*.png",
+        "-pix_fmt", "yuv420p",
+        "out.mp4"
+    ]
+
+    subprocess.run(cmd, check=True, cwd=run_dir)
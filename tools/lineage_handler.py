@@ -0,0 +1,37 @@
+import numpy as np
+
+LINEAGE_DTYPE = np.dtype([("id", np.int32), ("parent_id", np.int32), ("birth_step", np.int32)])
+
+def read_lineage(path):
+    # One record per division, in the order they happened
+    return np.fromfile(path, dtype=LINEAGE_DTYPE)
+
+class LineageHandler:
+    def __init__(self, env):
+        self.env = env
+        self.fibroHandler = self.env.fibroHandler
+
+        self.file = None
+
+    def open(self, path):
+        self.file = open(path, "wb")
+
+    def flush(self):
+        count = self.fibroHandler.lineageLogCount[None]
+        if self.file is not None and count > 0:
+            events = self.fibroHandler.lineageLogField.to_numpy()[:count]
+            np.ascontiguousarray(events, dtype=np.int32).tofile(self.file)
+            self.file.flush()
+
+        lost = self.fibroHandler.lineageLostCount[None]
+        if lost > 0:
+            print(f"Warning: {lost} divisions were missing from the lineage log, raise lineage_buffer_size.")
+
+        self.fibroHandler.lineageLogCount[None] = 0
+        self.fibroHandler.lineageLostCount[None] = 0
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
@@ -6,10 +6,12 @@ class SaveHandler:
     def __init__(self, handlers):
         self.handlers = handlers
 
-    def save_state(self):
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-
-        save_dir = Path("savestates") / f"save_{timestamp}"
+    def save_state(self, path=None):
+        if path is None:
+            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            save_dir = Path("savestates") / f"save_{timestamp}"
+        else:
+            save_dir = Path(path)
         save_dir.mkdir(parents=True, exist_ok=True)
 
         for tag, handler in self.handlers.items():
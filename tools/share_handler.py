@@ -0,0 +1,179 @@
+import taichi as ti
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+# Live snapshots of a running simulation in POSIX shared memory, for dashboards and notebooks.
+# The segment holds a header and two slots; the writer fills the older slot and then bumps the
+# sequence number, so a reader always finds the latest complete snapshot without any locking.
+#
+# Header (int64): magic, format, stale, sequence, cell capacity, ecm capacity, grid resolution,
+# then step, cell count and ecm count for each slot.
+# Slot: cell positions (f32, capacity x 2), cell phases (i8, capacity), ecm positions (f32, capacity x 2),
+# cell gridCount (i32, grid resolution x grid resolution). Freed ECM rows have negative positions.
+
+SHARE_MAGIC = 0x46495353  # "FISS"
+SHARE_FORMAT = 1
+HEADER_SIZE = 16
+HEADER_BYTES = HEADER_SIZE * 8
+MAGIC, FORMAT, STALE, SEQUENCE, CELL_CAPACITY, ECM_CAPACITY, GRID_RES = range(7)
+SLOT_COUNTS = 7  # Step, cell count and ecm count of slot k are at SLOT_COUNTS + 3k
+
+def slot_layout(cell_capacity, ecm_capacity, grid_res):
+    # (name, dtype, shape, byte offset) of each array in a slot, and the slot size
+    arrays = [("cell_pos", np.float32, (cell_capacity, 2)), ("cell_phase", np.int8, (cell_capacity,)),
+              ("ecm_pos", np.float32, (ecm_capacity, 2)), ("grid_count", np.int32, (grid_res, grid_res))]
+    layout = []
+    offset = 0
+    for name, dtype, shape in arrays:
+        layout.append((name, dtype, shape, offset))
+        offset += -(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 8) * 8  # Keep every array 8 byte aligned
+    return layout, offset
+
+def slot_views(buffer, header):
+    # Arrays of both slots, mapped onto the segment without copying
+    layout, slot_bytes = slot_layout(int(header[CELL_CAPACITY]), int(header[ECM_CAPACITY]), int(header[GRID_RES]))
+    return [{name: np.ndarray(shape, dtype=dtype, buffer=buffer, offset=HEADER_BYTES + k * slot_bytes + offset)
+             for name, dtype, shape, offset in layout} for k in range(2)]
+
+class ShareHandler:
+    def __init__(self, env):
+        self.env = env
+        self.fibroHandler = self.env.fibroHandler
+        self.ecmHandler = self.env.ecmHandler
+
+        self.name = None
+        self.memory = None
+
+        if self.env.SPARSE_GRID:  # Blocks whose gridcells each slot holds, so freed ones can be zeroed
+            self.sharedBlockField = ti.field(dtype=ti.i8, shape=(2, self.env.GRID_BLOCKS, self.env.GRID_BLOCKS))
+
+    def open(self, name):
+        self.name = name
+        self.allocate()
+
+    def allocate(self):
+        # Sized for the current capacities. Growth replaces the segment and marks the old one stale
+        sequence = 0
+        if self.memory is not None:
+            sequence = int(self.header[SEQUENCE])  # Carried over, so snapshots of the old segment never look current
+            self.release()
+        cell_capacity = self.fibroHandler.MAX_COUNT
+        ecm_capacity = self.ecmHandler.MAX_COUNT
+        layout, slot_bytes = slot_layout(cell_capacity, ecm_capacity, self.env.GRID_RES)
+
+        try:  # Left behind by a run that did not close it
+            shared_memory.SharedMemory(name=self.name).unlink()
+        except FileNotFoundError:
+            pass
+        self.memory = shared_memory.SharedMemory(name=self.name, create=True, size=HEADER_BYTES + 2 * slot_bytes)
+        self.header = np.ndarray(HEADER_SIZE, dtype=np.int64, buffer=self.memory.buf)
+        self.header[:] = 0
+        self.header[[CELL_CAPACITY, ECM_CAPACITY, GRID_RES]] = cell_capacity, ecm_capacity, self.env.GRID_RES
+        self.header[FORMAT] = SHARE_FORMAT
+        self.header[SEQUENCE] = sequence
+        self.slots = slot_views(self.memory.buf, self.header)
+        if self.env.SPARSE_GRID:  # The new segment starts zeroed
+            self.sharedBlockField.fill(0)
+        self.header[MAGIC] = SHARE_MAGIC  # Last, so readers never see a half written header
+
+    def publish(self, step, status):
+        if self.memory is None:
+            return
+        if self.fibroHandler.MAX_COUNT > self.header[CELL_CAPACITY] or self.ecmHandler.MAX_COUNT > self.header[ECM_CAPACITY]:
+            self.allocate()
+
+        sequence = int(self.header[SEQUENCE])
+        k = sequence % 2
+        slot = self.slots[k]
+        self.env.share_state_kernel(slot["cell_pos"], slot["cell_phase"], slot["ecm_pos"], slot["grid_count"], k)
+        self.header[SLOT_COUNTS + 3 * k:SLOT_COUNTS + 3 * k + 3] = step, status["cell_count"], status["ecm_slots"]
+        self.header[SEQUENCE] = sequence + 1
+
+    def release(self):
+        self.header[STALE] = 1
+        del self.header, self.slots  # The segment can't close while arrays still map it
+        self.memory.close()
+        self.memory.unlink()
+        self.memory = None
+
+    def close(self):
+        if self.memory is not None:
+            self.release()
+
+class ShareReader:
+    # Maps a running simulation's snapshots into NumPy without copying.
+    #
+    #   reader = ShareReader("fiss")
+    #   snapshot = reader.read()      # latest snapshot, or None while there is none
+    #   ...use snapshot["cell_pos"]...
+    #   reader.valid(snapshot)        # False once the writer may have reused the slot
+    #
+    # A snapshot's arrays stay valid until the next one is published. copy() returns one that is safe to keep.
+    # The reader may start before the simulation and outlive it. While the segment is missing or being
+    # replaced by a larger one, read() returns None and attaches again on a later call.
+    def __init__(self, name):
+        self.name = name
+        self.memory = None
+        self.attach()
+
+    def attach(self):
+        # Whether a finished segment was found
+        if self.memory is not None:
+            self.detach()
+        try:
+            memory = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:  # Not created yet, or unlinked by a growing or finished run
+            return False
+        resource_tracker.unregister(memory._name, "shared_memory")  # Otherwise exiting would unlink the writer's segment
+        header = np.ndarray(HEADER_SIZE, dtype=np.int64, buffer=memory.buf)
+        magic = int(header[MAGIC])
+        if magic != SHARE_MAGIC or header[FORMAT] != SHARE_FORMAT:
+            del header
+            memory.close()
+            if magic == 0:  # The writer sets it last
+                return False
+            raise Exception(f"{self.name} is not a simulation share of format {SHARE_FORMAT}.")
+        self.memory = memory
+        self.header = header
+        self.slots = slot_views(self.memory.buf, self.header)
+        return True
+
+    def detach(self):
+        del self.header, self.slots
+        try:
+            self.memory.close()
+        except BufferError:  # Snapshots still use the mapping, which goes away with them
+            pass
+        self.memory = None
+
+    def read(self):
+        if self.memory is None or self.header[STALE]:  # Replaced by a larger segment, or the run ended
+            if not self.attach():
+                return None
+        sequence = int(self.header[SEQUENCE])
+        if sequence == 0:
+            return None
+        k = (sequence - 1) % 2
+        step, cell_count, ecm_count = (int(v) for v in self.header[SLOT_COUNTS + 3 * k:SLOT_COUNTS + 3 * k + 3])
+        slot = self.slots[k]
+        return {"sequence": sequence, "step": step, "cell_count": cell_count, "ecm_count": ecm_count,
+                "cell_pos": slot["cell_pos"][:cell_count], "cell_phase": slot["cell_phase"][:cell_count],
+                "ecm_pos": slot["ecm_pos"][:ecm_count], "grid_count": slot["grid_count"]}
+
+    def valid(self, snapshot):
+        if self.memory is None:
+            return False
+        return not self.header[STALE] and self.header[SEQUENCE] == snapshot["sequence"]
+
+    def copy(self):
+        while True:
+            snapshot = self.read()
+            if snapshot is None:
+                return None
+            copied = {key: np.copy(value) if isinstance(value, np.ndarray) else value for key, value in snapshot.items()}
+            if self.valid(snapshot):
+                return copied
+
+    def close(self):
+        if self.memory is not None:
+            self.detach()
@@ -1,6 +1,18 @@
 import numpy as np
 
+from particle.cell import CellHandler
+
 class StatisticHandler:
+    # Columns written to data.csv for each entry of data_collection.metrics
+    METRIC_COLUMNS = {
+        "phases": ["g0", "g1", "s", "g2", "m"],
+        "inhibition": ["inhibition_mean", "inhibition_var"],
+        "speed": ["speed_mean", "speed_var"],
+        "events": ["divisions_per_step", "deletions_per_step", "ecm_deposits_per_step"],  # Means since the previous row
+        "genes": [f"gene{k}" for k in range(len(CellHandler.GENES))],  # Mean expression, in CellHandler.GENES order
+        "wound": ["wound_perimeter", "wound_centroid_x", "wound_centroid_y", "percent_closure"],
+    }
+
     def __init__(self, env):
         self.env = env
         self.fibroHandler = self.env.fibroHandler
@@ -12,23 +24,22 @@ class StatisticHandler:
             (self.GRID_RES, self.GRID_RES), dtype=np.float32
         )
 
-        self.WOUND_THRESHOLD = 0.10
-
-    def get_wound_area(self):
-        grid_count_np = self.env.fibroHandler.gridCount.to_numpy()
+        self.WOUND_THRESHOLD = self.env.WOUND_THRESHOLD
 
-        self.fibro_pixel_map[:] = grid_count_np / self.MAX_COUNT_PER_CELL
-        wound_mask = self.fibro_pixel_map < self.WOUND_THRESHOLD
+        # Previous edge sample, for the front velocity
+        self.last_edge_step = None
+        self.last_edge_um = None
 
-        pixel_count = np.sum(wound_mask)
-        dx = self.env.DOMAIN_SIZE / self.env.GRID_RES
-        area_um2 = pixel_count * dx * dx
-        area_mm2 = area_um2 / 1000000
+        # Last step of the previous summary, runs start at step 0
+        self.last_summary_step = -1
 
-        return area_mm2
+    def get_wound_area(self, grid_count_np=None):
+        # Only the sparse region connected to the wound center (see WoundHandler), in mm²
+        return self.env.woundHandler.measure(grid_count_np)["area"]
 
-    def get_wound_width(self, row):
-        grid_count_np = self.env.fibroHandler.gridCount.to_numpy()
+    def get_wound_width(self, row, grid_count_np=None):
+        if grid_count_np is None:
+            grid_count_np = self.env.fibroHandler.grid_count_numpy()
 
         self.fibro_pixel_map[:] = grid_count_np / self.MAX_COUNT_PER_CELL
         wound_mask = self.fibro_pixel_map < self.WOUND_THRESHOLD
@@ -48,5 +59,106 @@ class StatisticHandler:
 
         return width_um
 
-    def get_percent_closure(self):
-        return 100*(self.env.INITIAL_WOUND_AREA - self.get_wound_area())/self.env.INITIAL_WOUND_AREA
\ No newline at end of file
+    def get_average_wound_width(self, grid_count_np=None):
+        if grid_count_np is None:
+            grid_count_np = self.env.fibroHandler.grid_count_numpy()
+
+        sum = 0
+        count = int(self.GRID_RES/10)
+        for i in range(count):
+            sum += self.get_wound_width(i, grid_count_np)
+        return sum/count
+
+    def get_percent_closure(self, area=None):
+        if area is None:
+            area = self.get_wound_area()
+        if not self.env.INITIAL_WOUND_AREA:  # No wound to close
+            return np.nan
+        return 100*(self.env.INITIAL_WOUND_AREA - area)/self.env.INITIAL_WOUND_AREA
+
+    def get_wound_columns(self, grid_count_np=None):
+        # wound_area and the columns of the wound metric, all from one segmentation
+        wound = self.env.woundHandler.measure(grid_count_np)
+        values = {"wound_area": wound["area"]}
+        if "wound" in self.env.METRICS:
+            values.update({"wound_perimeter": wound["perimeter"], "wound_centroid_x": wound["centroid_x"],
+                           "wound_centroid_y": wound["centroid_y"], "percent_closure": self.get_percent_closure(wound["area"])})
+        return values
+
+    @classmethod
+    def metric_columns(cls, metrics):
+        return [column for metric in metrics for column in cls.METRIC_COLUMNS[metric]]
+
+    def get_metric_columns(self):
+        return self.metric_columns(self.env.METRICS)
+
+    def read_summary(self):
+        # Raw sums and event counts since the last read; summaries of disjoint tiles can be added
+        self.env.summarize_kernel()
+        return self.fibroHandler.summaryField.to_numpy()
+
+    def get_summary(self, summary_np=None, step=None):
+        # step is the last simulated step, the event counts are averaged over the steps since the previous summary
+        if summary_np is None:
+            summary_np = self.read_summary()
+        if step is None:
+            step = self.env.step[None] - 1
+        steps = max(step - self.last_summary_step, 1)
+        self.last_summary_step = step
+
+        raw = dict(zip(self.fibroHandler.SUMMARY_COLUMNS, summary_np.tolist()))
+        n = max(sum(raw[phase] for phase in self.METRIC_COLUMNS["phases"]), 1)
+
+        values = {phase: int(raw[phase]) for phase in self.METRIC_COLUMNS["phases"]}
+        for metric in ["inhibition", "speed"]:
+            mean = raw[metric + "_sum"] / n
+            values[metric + "_mean"] = mean
+            values[metric + "_var"] = max(raw[metric + "_sq_sum"] / n - mean * mean, 0.0)
+        for event in self.METRIC_COLUMNS["events"]:
+            values[event] = raw[event.removesuffix("_per_step")] / steps
+        for gene in self.METRIC_COLUMNS["genes"]:
+            values[gene] = raw[gene + "_sum"] / n
+
+        # Wound columns need the grid and come from get_wound_columns
+        return {column: values[column] for column in self.get_metric_columns() if column in values}
+
+    @staticmethod
+    def edge_profile_columns(angle_bins, radius_bins):
+        return (["step"] + [f"edge_{a}" for a in range(angle_bins)] +
+                [f"edge_velocity_{a}" for a in range(angle_bins)] +
+                [f"density_{r}" for r in range(radius_bins)])
+
+    def get_edge_profile_columns(self):
+        return self.edge_profile_columns(self.env.EDGE_ANGLE_BINS, self.env.EDGE_RADIUS_BINS)
+
+    def read_edge_profile(self):
+        # Nearest cell distance per sector and cell count per distance bin; tiles combine by min and sum
+        self.env.profile_edge_kernel()
+        return self.fibroHandler.edgeRadiusField.to_numpy(), self.fibroHandler.radialCountField.to_numpy()
+
+    def get_edge_profile(self, profile=None, step=None):
+        if profile is None:
+            profile = self.read_edge_profile()
+        edge_np, radial_count_np = profile
+
+        # Sectors without any cells have no edge
+        edge_um = np.where(np.isfinite(edge_np), edge_np * self.env.DOMAIN_SIZE, np.nan)
+
+        # Front velocity in um per step, positive while the edge advances into the wound
+        if step is None:
+            step = self.env.step[None]
+        if self.last_edge_step is None or step == self.last_edge_step:
+            velocity = np.full_like(edge_um, np.nan)
+        else:
+            velocity = (self.last_edge_um - edge_um) / (step - self.last_edge_step)
+        self.last_edge_step = step
+        self.last_edge_um = edge_um
+
+        # Cells per mm^2 in each annulus
+        bin_width_mm = self.env.WOUND_WIDTH / self.env.EDGE_RADIUS_BINS / 1000
+        inner = np.arange(self.env.EDGE_RADIUS_BINS) * bin_width_mm
+        annulus_mm2 = np.pi * ((inner + bin_width_mm) ** 2 - inner ** 2)
+        density = radial_count_np / annulus_mm2
+
+        values = [step] + edge_um.tolist() + velocity.tolist() + density.tolist()
+        return dict(zip(self.get_edge_profile_columns(), values))
@@ -0,0 +1,229 @@
+import taichi as ti
+import numpy as np
+
+@ti.data_oriented
+class WoundHandler:
+    # The wound is the connected region of sparse gridcells (below WOUND_THRESHOLD of max_image_pixel_cells)
+    # that contains the wound center and is enclosed by tissue. Empty margins and other gaps are not part of it.
+    # A scratch may run from wall to wall, but a region that reaches across the domain in both directions is
+    # the space around the tissue (e.g. around a single colony) rather than a hole in it, so it is no wound.
+    # Labelled on the device with a lock-free union-find, so one kernel and one small read per measurement
+    SEGMENT_COLUMNS = ["area", "perimeter", "offset_x_sum", "offset_y_sum", "columns", "rows"]  # Gridcells, edges, offsets from the center and extent
+
+    def __init__(self, env):
+        self.env = env
+        self.GRID_RES = env.GRID_RES
+        self.WOUND_LIMIT = env.WOUND_THRESHOLD * env.MAX_IMAGE_PIXEL_CELLS  # Cells per gridcell
+        self.CENTER = (min(int(env.WOUND_CENTER[0] * self.GRID_RES), self.GRID_RES - 1),
+                       min(int(env.WOUND_CENTER[1] * self.GRID_RES), self.GRID_RES - 1))
+        self.BLOCK = env.GRID_BLOCK_SIZE
+        self.BLOCKS = env.GRID_BLOCKS
+        self.BLOCK_NODE = self.GRID_RES * self.GRID_RES  # Union-find id of block 0 in sparse runs, after the gridcells
+        self.LINKS = [(1, 0), (0, 1)] if not env.SPARSE_GRID else [(1, 0), (-1, 0), (0, 1), (0, -1)]  # Empty blocks are only reached from their neighbors
+
+        # Union-find parent per gridcell, -1 if covered. Sparse runs only label the gridcells of live blocks;
+        # every other block is empty, so it is labelled as a whole
+        if env.SPARSE_GRID:
+            self.labelField = ti.field(dtype=ti.i32)
+            labelBuilder = ti.FieldsBuilder()
+            self.labelBlock = env.grid_block(labelBuilder)
+            self.labelBlock.dense(ti.ij, self.BLOCK).place(self.labelField)
+            self.labelTree = labelBuilder.finalize()
+            self.blockLabelField = ti.field(dtype=ti.i32, shape=self.BLOCKS * self.BLOCKS)
+        else:
+            self.labelField = ti.field(dtype=ti.i32, shape=(self.GRID_RES, self.GRID_RES))
+        self.countField = None  # Counts handed in from the host, allocated by the first measure that has them
+        self.countTree = None
+        self.segmentField = ti.field(dtype=ti.f32, shape=len(self.SEGMENT_COLUMNS))
+        self.spanField = ti.field(dtype=ti.i32, shape=(2, self.GRID_RES))  # Columns and rows the region reaches
+
+    @ti.func
+    def node(self, x, y):
+        # Union-find id of gridcell (x, y), or of its block if the block is empty
+        p = x * self.GRID_RES + y
+        if ti.static(self.env.SPARSE_GRID):
+            if not ti.is_active(self.labelBlock, [x // self.BLOCK, y // self.BLOCK]):
+                p = self.BLOCK_NODE + (x // self.BLOCK) * self.BLOCKS + y // self.BLOCK
+        return p
+
+    @ti.func
+    def label(self, p):
+        value = -1
+        if p < self.BLOCK_NODE:
+            value = self.labelField[p // self.GRID_RES, p % self.GRID_RES]
+        else:
+            if ti.static(self.env.SPARSE_GRID):
+                value = self.blockLabelField[p - self.BLOCK_NODE]
+        return value
+
+    @ti.func
+    def min_label(self, p, value):
+        # atomic_min on the label of p, returns the old one
+        old = -1
+        if p < self.BLOCK_NODE:
+            old = ti.atomic_min(self.labelField[p // self.GRID_RES, p % self.GRID_RES], value)
+        else:
+            if ti.static(self.env.SPARSE_GRID):
+                old = ti.atomic_min(self.blockLabelField[p - self.BLOCK_NODE], value)
+        return old
+
+    @ti.func
+    def find(self, p):
+        while self.label(p) != p:
+            parent = self.label(p)
+            self.min_label(p, self.label(parent))  # Path halving, safe alongside other finds
+            p = parent
+        return p
+
+    @ti.func
+    def union(self, p, q):
+        # Roots are linked to the smaller one. A failed atomic_min leaves the other root to merge next
+        done = False
+        while not done:
+            p = self.find(p)
+            q = self.find(q)
+            if p == q:
+                done = True
+            else:
+                high = ti.max(p, q)
+                low = ti.min(p, q)
+                old = self.min_label(high, low)
+                done = old == high
+                p = old
+                q = low
+
+    @ti.func
+    def neighbor(self, x, y, dx, dy):
+        # Union-find id of the gridcell next to (x, y), -2 past a non-periodic border
+        nx = x + dx
+        ny = y + dy
+        if ti.static(self.env.PERIODIC):
+            nx = (nx + self.GRID_RES) % self.GRID_RES
+            ny = (ny + self.GRID_RES) % self.GRID_RES
+        q = -2
+        if 0 <= nx < self.GRID_RES and 0 <= ny < self.GRID_RES:
+            q = self.node(nx, ny)
+        return q
+
+    @ti.func
+    def offset(self, c, center):
+        d = c - center
+        if ti.static(self.env.PERIODIC):  # Nearest image of the gridcell
+            d = (d + self.GRID_RES // 2) % self.GRID_RES - self.GRID_RES // 2
+        return d
+
+    @ti.func
+    def load_counts(self, counts: ti.types.ndarray()):
+        # Sparse runs only allocate the blocks that hold cells
+        if ti.static(self.env.SPARSE_GRID):
+            for bx, by in self.countBlock:
+                ti.deactivate(self.countBlock, [ti.cast(bx, ti.i32), ti.cast(by, ti.i32)])
+        for x, y in ti.ndrange(self.GRID_RES, self.GRID_RES):
+            if ti.static(not self.env.SPARSE_GRID) or counts[x, y] != 0:
+                self.countField[x, y] = counts[x, y]
+
+    @ti.func
+    def segment(self, counts: ti.template()):
+        # A struct-for over counts only visits the gridcells of live blocks in sparse runs
+        if ti.static(self.env.SPARSE_GRID):
+            for bx, by in self.labelBlock:
+                ti.deactivate(self.labelBlock, [ti.cast(bx, ti.i32), ti.cast(by, ti.i32)])
+        for x, y in counts:
+            if x < self.GRID_RES and y < self.GRID_RES:
+                self.labelField[x, y] = x * self.GRID_RES + y if counts[x, y] < self.WOUND_LIMIT else -1
+        if ti.static(self.env.SPARSE_GRID):
+            for b in self.blockLabelField:
+                self.blockLabelField[b] = -1
+                if ti.static(self.WOUND_LIMIT > 0):
+                    if not ti.is_active(self.labelBlock, [b // self.BLOCKS, b % self.BLOCKS]):
+                        self.blockLabelField[b] = self.BLOCK_NODE + b
+
+        for x, y in counts:
+            if x < self.GRID_RES and y < self.GRID_RES and self.labelField[x, y] >= 0:
+                for link in ti.static(self.LINKS):
+                    q = self.neighbor(x, y, link[0], link[1])
+                    if q >= 0 and self.label(q) >= 0:
+                        self.union(x * self.GRID_RES + y, q)
+        if ti.static(self.env.SPARSE_GRID):
+            for b in self.blockLabelField:
+                if self.blockLabelField[b] >= 0:
+                    for link in ti.static([(1, 0), (0, 1)]):
+                        nx = b // self.BLOCKS + link[0]
+                        ny = b % self.BLOCKS + link[1]
+                        if ti.static(self.env.PERIODIC):
+                            nx %= self.BLOCKS
+                            ny %= self.BLOCKS
+                        if nx < self.BLOCKS and ny < self.BLOCKS and self.blockLabelField[nx * self.BLOCKS + ny] >= 0:
+                            self.union(self.BLOCK_NODE + b, self.BLOCK_NODE + nx * self.BLOCKS + ny)
+
+        for x, y in counts:
+            if x < self.GRID_RES and y < self.GRID_RES and self.labelField[x, y] >= 0:
+                self.labelField[x, y] = self.find(x * self.GRID_RES + y)
+        if ti.static(self.env.SPARSE_GRID):
+            for b in self.blockLabelField:
+                if self.blockLabelField[b] >= 0:
+                    self.blockLabelField[b] = self.find(self.BLOCK_NODE + b)
+
+        for k in self.segmentField:
+            self.segmentField[k] = 0
+        for a, b in self.spanField:
+            self.spanField[a, b] = 0
+        root = self.label(self.node(self.CENTER[0], self.CENTER[1]))
+        for x, y in counts:
+            if root >= 0 and x < self.GRID_RES and y < self.GRID_RES:
+                if self.labelField[x, y] == root:
+                    self.segmentField[0] += 1
+                    self.segmentField[2] += self.offset(x, self.CENTER[0])
+                    self.segmentField[3] += self.offset(y, self.CENTER[1])
+                    self.spanField[0, x] = 1
+                    self.spanField[1, y] = 1
+                elif self.labelField[x, y] < 0:  # Edges of covered gridcells facing the wound
+                    for link in ti.static([(1, 0), (-1, 0), (0, 1), (0, -1)]):
+                        q = self.neighbor(x, y, link[0], link[1])
+                        if q >= 0 and self.label(q) == root:
+                            self.segmentField[1] += 1
+        if ti.static(self.env.SPARSE_GRID):
+            for b in self.blockLabelField:
+                if root >= 0 and self.blockLabelField[b] == root:
+                    x0 = b // self.BLOCKS * self.BLOCK
+                    y0 = b % self.BLOCKS * self.BLOCK
+                    width = ti.min(self.BLOCK, self.GRID_RES - x0)
+                    height = ti.min(self.BLOCK, self.GRID_RES - y0)
+                    self.segmentField[0] += width * height
+                    for a in range(width):
+                        self.segmentField[2] += self.offset(x0 + a, self.CENTER[0]) * height
+                        self.spanField[0, x0 + a] = 1
+                    for a in range(height):
+                        self.segmentField[3] += self.offset(y0 + a, self.CENTER[1]) * width
+                        self.spanField[1, y0 + a] = 1
+
+        for a, b in self.spanField:
+            self.segmentField[4 + a] += self.spanField[a, b]
+
+    def measure(self, grid_count_np=None):
+        # Area (mm²), perimeter along the cell front (µm) and centroid (µm) of the wound
+        counts = self.env.fibroHandler.gridCount
+        if grid_count_np is not None:
+            if self.countField is None:
+                if self.env.SPARSE_GRID:
+                    self.countField = ti.field(dtype=ti.f32)
+                    countBuilder = ti.FieldsBuilder()
+                    self.countBlock = self.env.grid_block(countBuilder)
+                    self.countBlock.dense(ti.ij, self.BLOCK).place(self.countField)
+                    self.countTree = countBuilder.finalize()
+                else:
+                    self.countField = ti.field(dtype=ti.f32, shape=(self.GRID_RES, self.GRID_RES))
+            self.env.load_wound_counts_kernel(np.ascontiguousarray(grid_count_np, dtype=np.float32))
+            counts = self.countField
+        self.env.segment_wound_kernel(counts)
+
+        area, perimeter, offset_x_sum, offset_y_sum, columns, rows = self.segmentField.to_numpy().tolist()
+        if columns == self.GRID_RES and rows == self.GRID_RES:  # Not enclosed by tissue
+            area = perimeter = 0
+        dx = self.env.DOMAIN_SIZE / self.GRID_RES
+        centroid = [np.nan, np.nan]
+        if area > 0:
+            centroid = [((self.CENTER[k] + offset / area) % self.GRID_RES + 0.5) * dx
+                        for k, offset in enumerate([offset_x_sum, offset_y_sum])]
+        return {"area": area * dx * dx / 1000000, "perimeter": perimeter * dx,
+                "centroid_x": centroid[0], "centroid_y": centroid[1]}
@@ -0,0 +1,30 @@
+import numpy as np
+from pathlib import Path
+
+def polygon_mask(vertices, res):
+    # Even-odd rule at pixel centers, vertices in [-0.5, 0.5] with y pointing up
+    centers = (np.arange(res) + 0.5) / res - 0.5
+    x, y = np.meshgrid(centers, centers, indexing="ij")
+    inside = np.zeros((res, res), dtype=bool)
+    for (x0, y0), (x1, y1) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        if y0 == y1:
+            continue
+        crosses = (y0 > y) != (y1 > y)
+        inside ^= crosses & (x < x0 + (y - y0) * (x1 - x0) / (y1 - y0))
+    return inside
+
+def image_mask(image, res):
+    if image.ndim == 3:
+        image = image[..., :3].mean(axis=2)
+    # Image rows run top to bottom, the mask is indexed [x, y] with y up
+    image = np.flipud(image).T
+    sx = (np.arange(res) * image.shape[0]) // res
+    sy = (np.arange(res) * image.shape[1]) // res
+    return image[np.ix_(sx, sy)] > 127
+
+def load_wound_mask(path, res):
+    if Path(path).suffix.lower() in [".txt", ".csv"]:
+        vertices = np.loadtxt(path, delimiter="," if path.endswith(".csv") else None, ndmin=2)
+        return polygon_mask(vertices, res)
+    import imageio
+    return image_mask(np.asarray(imageio.imread(path)), res)
@@ -0,0 +1,181 @@
+import taichi as ti
+import tomli
+import os
+import re
+import json
+import shutil
+import copy
+import time
+import argparse
+import multiprocessing as mp
+
+import validate
+
+# Benchmarks the [environment] grid and substep settings on this machine and picks the fastest safe ones.
+# Grid layouts are timed on a full tissue; the fastest one that drops no particles from the grid and still
+# passes validate.py wins. Layouts with another grid scale than the reference are only held to the metrics
+# that don't depend on the grid (see validate.GRID_METRICS). Substeps are then lowered as far as collisions
+# stay resolved (mean overlap under overlap_tolerance) and validate.py passes. Each validation runs every
+# scenario, so tuning takes a while.
+#
+#   python tune.py           print the recommendation
+#   python tune.py --write   also write it into config.toml
+
+GRID_SCALE_FACTORS = [1.0, 1.25, 1.5, 2.0]
+MAX_PARTICLES_PER_GRID_CELL = [4, 6, 8, 12, 16]
+
+def tuning_config(config, grid_scale_factor, max_particles):
+    config = copy.deepcopy(config)
+    config["experiment"]["initial_mode"] = "full"
+    config["environment"]["grid_scale_factor"] = grid_scale_factor
+    config["environment"]["max_particles_per_grid_cell"] = max_particles
+    config["data_collection"]["capture_data"] = False
+    config["data_collection"]["lineage_log"] = False
+    return config
+
+def run_burst(env, substeps, steps):
+    # Seconds per step, particles dropped from the grids and mean overlap after the collisions
+    env.fibroHandler.droppedCount[None] = 0
+    env.ecmHandler.droppedCount[None] = 0
+    overlap = 0.0
+    elapsed = 0.0
+    for _ in range(steps):
+        ti.sync()
+        start = time.perf_counter()
+        env.simulate_substeps(substeps)
+        env.reserve_capacity()
+        env.update_kernel()
+        env.rebuild_grid_ecm_kernel()
+        ti.sync()
+        elapsed += time.perf_counter() - start
+        overlap += env.fibroHandler.mean_overlap()
+    return elapsed / steps, env.fibroHandler.droppedCount[None] + env.ecmHandler.droppedCount[None], overlap / steps
+
+def benchmark_grid(args):
+    config, warmup, steps = args
+    ti.init(arch=ti.gpu, offline_cache=True)
+
+    from env import Env
+
+    env = Env(config)
+    env.experimental_setup()
+    run_burst(env, env.SUBSTEPS, warmup)  # Compilation and growth
+    return run_burst(env, env.SUBSTEPS, steps)
+
+def benchmark_substeps(args):
+    config, warmup, steps = args
+    config["environment"]["adaptive_substeps"] = True  # The collisions only measure the overlap in adaptive mode
+    config["environment"]["min_substeps"] = config["environment"]["max_substeps"]  # But every count runs in full
+    ti.init(arch=ti.gpu, offline_cache=True)
+
+    from env import Env
+
+    env = Env(config)
+    env.experimental_setup()
+    run_burst(env, env.SUBSTEPS, warmup)
+
+    # Every count starts from the same state
+    handlers = [env.fibroHandler, env.ecmHandler]
+    start = [handler.export_state() for handler in handlers]
+    step = env.step[None]
+
+    def restore():
+        for handler, data in zip(handlers, start):
+            handler.load_state(data)
+        env.step[None] = step
+        env.rebuild_grid_ecm_kernel()
+
+    results = []
+    for substeps in range(1, env.MAX_SUBSTEPS + 1):
+        restore()
+        run_burst(env, substeps, warmup)  # Loading can regrow the fields, which recompiles the kernels
+        restore()
+        results.append((substeps,) + run_burst(env, substeps, steps))
+    return results
+
+def passes_validation(settings, reference, args):
+    # The reference was recorded with the shipped defaults, so only the tuned settings change.
+    # Another grid_scale_factor changes GRID_RES and with it the metrics that depend on the grid,
+    # so those layouts are held to the metrics that don't
+    with open('defaultconfig.toml', 'rb') as f:
+        config = tomli.load(f)
+    metrics = validate.METRICS
+    if settings["grid_scale_factor"] != config["environment"]["grid_scale_factor"]:
+        metrics = [metric for metric in validate.METRICS if metric not in validate.GRID_METRICS]
+    config["environment"].update(settings)
+
+    print("Validating " + ", ".join(f"{key} = {value}" for key, value in settings.items()) + " on " + ", ".join(metrics))
+    results = validate.run_all(config, list(reference), args.seeds, args.jobs)
+    return validate.compare(reference, results, args.alpha, args.tolerance, metrics)
+
+def write_settings(settings):
+    # Edits the values in place so the comments in config.toml are kept
+    with open('config.toml') as f:
+        text = f.read()
+    for key, value in settings.items():
+        text = re.sub(rf"^({key}\s*=\s*)[^\s#]+", rf"\g<1>{value}", text, count=1, flags=re.MULTILINE)
+    with open('config.toml', 'w') as f:
+        f.write(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the fastest grid and substep settings that drop no particles.")
+    parser.add_argument("--write", action="store_true", help="write the recommended settings into config.toml")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed steps before each burst")
+    parser.add_argument("--steps", type=int, default=10, help="timed steps per burst")
+    parser.add_argument("--seeds", type=int, default=3, help="validation runs per scenario")
+    parser.add_argument("--jobs", type=int, default=max(1, os.cpu_count() // 4), help="validation runs in parallel")
+    parser.add_argument("--alpha", type=float, default=0.01, help="family-wise false failure rate of the validation")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="relative difference the validation always accepts")
+    args = parser.parse_args()
+
+    if not os.path.exists("config.toml"):
+        shutil.copyfile("defaultconfig.toml", "config.toml")
+        print(f"Created config.toml from defaultconfig.toml")
+
+    with open('config.toml', 'rb') as f:
+        config = tomli.load(f)
+    with open(validate.REFERENCE_PATH) as f:
+        reference = json.load(f)
+
+    # One process per layout, since the grid layout is compiled into the kernels
+    layouts = [(g, m) for g in GRID_SCALE_FACTORS for m in MAX_PARTICLES_PER_GRID_CELL]
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        results = pool.map(benchmark_grid, [(tuning_config(config, g, m), args.warmup, args.steps) for g, m in layouts])
+
+    print("grid_scale_factor  max_particles_per_grid_cell  ms/step  dropped")
+    for (g, m), (seconds, dropped, overlap) in zip(layouts, results):
+        print(f"{g:<18} {m:<28} {seconds * 1000:<8.1f} {dropped}")
+
+    # Fastest first, so only the layouts ahead of the winner are validated
+    safe = sorted((seconds, layout) for layout, (seconds, dropped, overlap) in zip(layouts, results) if dropped == 0)
+    if not safe:
+        raise Exception("Every grid layout dropped particles, try larger max_particles_per_grid_cell values.")
+    substeps = config["environment"]["substeps"]
+    for seconds, (grid_scale_factor, max_particles) in safe:
+        if passes_validation({"grid_scale_factor": grid_scale_factor, "max_particles_per_grid_cell": max_particles, "substeps": substeps}, reference, args):
+            break
+    else:
+        raise Exception("No grid layout that keeps every particle passes validate.py.")
+
+    with ctx.Pool(1) as pool:
+        substep_results = pool.apply(benchmark_substeps, ((tuning_config(config, grid_scale_factor, max_particles), args.warmup, args.steps),))
+
+    print("substeps  ms/step  mean overlap")
+    for count, seconds, dropped, overlap in substep_results:
+        print(f"{count:<9} {seconds * 1000:<8.1f} {overlap:.4f}")
+
+    # Fewest first. The configured count passed with this layout already, so it is the fallback
+    tolerance = config["environment"]["overlap_tolerance"]
+    resolved = [count for count, seconds, dropped, overlap in substep_results if overlap < tolerance and dropped == 0 and count < substeps]
+    for count in resolved:
+        if passes_validation({"grid_scale_factor": grid_scale_factor, "max_particles_per_grid_cell": max_particles, "substeps": count}, reference, args):
+            substeps = count
+            break
+
+    settings = {"grid_scale_factor": grid_scale_factor, "max_particles_per_grid_cell": max_particles, "substeps": substeps}
+    print("Recommended: " + ", ".join(f"{key} = {value}" for key, value in settings.items()))
+    if args.write:
+        write_settings(settings)
+        print("Written to config.toml")
@@ -0,0 +1,174 @@
+import taichi as ti
+import tomli
+import os
+import sys
+import copy
+import json
+import argparse
+import multiprocessing as mp
+import numpy as np
+from statistics import NormalDist
+
+import decomposed
+
+# Headless regression check of the shipped scenarios against stored reference trajectories.
+# Every scenario is run for several seeds on the CPU, and each sampled point of each metric is
+# compared to the reference with a Welch test, Bonferroni corrected over all points compared.
+#
+#   python validate.py            compare against the reference
+#   python validate.py --record   run the current code and store its trajectories as the reference
+#
+# Tiled scenarios run a scenario through decomposed.py and are compared against the single process
+# reference, so they check that the decomposition gives the same results. They are never recorded.
+
+REFERENCE_PATH = "defaultstates/validation_reference.json"
+METRICS = ["fibroblast_count", "ecm_count", "wound_area", "wound_width"]
+GRID_METRICS = ["ecm_count", "wound_area", "wound_width"]  # Measured on the grid or sensed through it, so they change with GRID_RES
+SAMPLE_INTERVAL = 10
+
+# name: (initial_mode, initial_wound, steps)
+SCENARIOS = {
+    "single": ("single", "none", 600),
+    "full_none": ("full", "none", 60),
+    "full_circle": ("full", "circle", 60),
+    "full_square": ("full", "square", 60),
+    "full_triangle": ("full", "triangle", 60),
+    "full_line": ("full", "line", 60),
+}
+TILED_SCENARIOS = {"tiled_single": "single", "tiled_full_circle": "full_circle"}  # name: scenario whose reference it is held to
+
+def reference_name(name):
+    return TILED_SCENARIOS.get(name, name)
+
+def scenario_config(config, name):
+    mode, wound, steps = SCENARIOS[reference_name(name)]
+    config = copy.deepcopy(config)
+    config["experiment"]["initial_mode"] = mode
+    config["experiment"]["initial_wound"] = wound
+    config["experiment"]["end_step"] = steps
+    config["data_collection"]["capture_data"] = False
+    config["data_collection"]["save_video"] = False
+    config["data_collection"]["lineage_log"] = False
+    return config
+
+def run_scenario(args):
+    name, seed, config = args
+    ti.init(arch=ti.cpu, random_seed=seed, offline_cache=True)
+
+    from env import Env
+
+    env = Env(config)
+    env.experimental_setup()
+
+    trajectory = {metric: [] for metric in METRICS}
+    status = env.refresh_status()
+    step = status["step"]
+    while step < env.END_STEP:
+        if step % SAMPLE_INTERVAL == 0:
+            env.rebuild_grid_cells_kernel()
+            trajectory["fibroblast_count"].append(status["cell_count"])
+            trajectory["ecm_count"].append(status["ecm_count"])
+            trajectory["wound_area"].append(env.statisticHandler.get_wound_area())
+            trajectory["wound_width"].append(env.statisticHandler.get_average_wound_width())
+
+        env.simulate_substeps()
+
+        env.reserve_capacity(status)
+        env.update_kernel()
+        env.rebuild_grid_ecm_kernel()
+        step += 1
+        if step % SAMPLE_INTERVAL == 0 or step % env.STATUS_INTERVAL == 0:  # Only read the device when needed
+            status = env.read_status()
+        else:
+            status["flags"] = 0
+
+    return name, seed, trajectory
+
+def run_all(config, names, seeds, jobs):
+    # Each run gets its own process, so taichi starts fresh with the run's seed
+    runs = [(name, seed, scenario_config(config, name)) for name in names if name in SCENARIOS for seed in range(seeds)]
+    results = {name: {metric: [] for metric in METRICS} for name in names}
+    ctx = mp.get_context("spawn")
+    with ctx.Pool(jobs) as pool:
+        for name, seed, trajectory in pool.imap_unordered(run_scenario, runs):
+            print(f"Finished {name} (seed {seed})")
+            for metric in METRICS:
+                results[name][metric].append(trajectory[metric])
+    # Tiled runs start a process per tile themselves, which pool workers can't
+    for name in [name for name in names if name in TILED_SCENARIOS]:
+        for seed in range(seeds):
+            trajectory = decomposed.run_tiles(scenario_config(config, name), seed, SAMPLE_INTERVAL)
+            print(f"Finished {name} (seed {seed})")
+            for metric in METRICS:
+                results[name][metric].append(trajectory[metric])
+    return {name: {metric: np.array(runs) for metric, runs in metrics.items()} for name, metrics in results.items()}
+
+def envelope(samples):
+    # Per sampled step, over seeds
+    return {"mean": samples.mean(axis=0).tolist(), "std": samples.std(axis=0, ddof=1).tolist() if len(samples) > 1 else [0.0] * samples.shape[1],
+            "n": len(samples)}
+
+def compare(reference, results, alpha, tolerance, metrics=METRICS):
+    # Welch t statistics per sampled step. Relative tolerance keeps runs with no spread
+    # (a single seed, or deterministic scenarios) from failing on rounding
+    points = sum(len(reference[reference_name(name)][metric]["mean"]) for name in results for metric in metrics)
+    critical = NormalDist().inv_cdf(1 - alpha / (2 * max(points, 1)))
+
+    passed = True
+    for name, runs in results.items():
+        for metric in metrics:
+            ref = reference[reference_name(name)][metric]
+            samples = runs[metric]
+            ref_mean = np.array(ref["mean"])
+            ref_var = np.array(ref["std"]) ** 2 / ref["n"]
+            mean = samples.mean(axis=0)
+            var = samples.var(axis=0, ddof=1) / len(samples) if len(samples) > 1 else np.zeros_like(mean)
+            floor = (tolerance * np.maximum(np.abs(ref_mean), 1)) ** 2
+            t = np.abs(mean - ref_mean) / np.sqrt(ref_var + var + floor)
+
+            worst = int(np.argmax(t))
+            ok = t[worst] <= critical
+            passed &= bool(ok)
+            print(f"{'PASS' if ok else 'FAIL'} {name:14} {metric:17} max |t| {t[worst]:6.2f} at step {worst * SAMPLE_INTERVAL:4} "
+                  f"(reference {ref_mean[worst]:.4g}, got {mean[worst]:.4g})")
+
+    print(f"Critical |t| {critical:.2f} over {points} points")
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare simulation trajectories against the stored reference.")
+    parser.add_argument("--record", action="store_true", help="store the trajectories of the current code as the reference")
+    parser.add_argument("--seeds", type=int, default=3, help="runs per scenario")
+    parser.add_argument("--jobs", type=int, default=max(1, os.cpu_count() // 4), help="runs in parallel")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS) + list(TILED_SCENARIOS), choices=list(SCENARIOS) + list(TILED_SCENARIOS))
+    parser.add_argument("--alpha", type=float, default=0.01, help="family-wise false failure rate")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="relative difference always accepted")
+    args = parser.parse_args()
+
+    # The shipped defaults, not config.toml, so local experiments don't move the reference
+    with open('defaultconfig.toml', 'rb') as f:
+        config = tomli.load(f)
+
+    names = args.scenarios
+    if args.record:
+        names = [name for name in names if name in SCENARIOS]
+    results = run_all(config, names, args.seeds, args.jobs)
+
+    if args.record:
+        reference = {}
+        if os.path.exists(REFERENCE_PATH):
+            with open(REFERENCE_PATH) as f:
+                reference = json.load(f)
+        for name, metrics in results.items():
+            reference[name] = {metric: envelope(samples) for metric, samples in metrics.items()}
+        with open(REFERENCE_PATH, 'w') as f:
+            json.dump(reference, f, indent=1)
+        print(f"Recorded {', '.join(results)} in {REFERENCE_PATH}")
+    else:
+        with open(REFERENCE_PATH) as f:
+            reference = json.load(f)
+        missing = [name for name in results if reference_name(name) not in reference]
+        if missing:
+            raise Exception("No reference for " + ", ".join(missing) + ", record one with --record.")
+        sys.exit(0 if compare(reference, results, args.alpha, args.tolerance) else 1)